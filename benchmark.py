@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os, sys, time, json, random, struct, bisect, threading, tempfile, subprocess, signal, socket, asyncio, urllib.parse
+import click
+
+from nanodb import KNOWN_ACCOUNTS, GENESIS_OPEN_BLOCK_HASH, GENESIS_PUBLIC_KEY, GENESIS_BALANCE_RAW
+from rainumbers import hex2bin, decode_account, format_amount, AmountFormatter
+
+"""
+Explorer benchmarks, without needing a copy of the real ledger:
+
+    generate    write a synthetic RaiBlocks LMDB database
+    makedb      the same, converted to SQLite with conv2sqlite.py
+    run         replay a mix of page requests against the explorer 
+                (in-process, through the WSGI app) and report throughput,
+                latency and SQL statements per request
+    http        the same over HTTP, with the explorer running under one of
+                the servers and concurrent keep-alive client connections
+    amounts     time amount formatting (format_amount() vs AmountFormatter)
+
+The synthetic ledger has a skewed activity: accounts are ranked, and 
+the k-th account sends and receives with weight 1/(k+1)^skew, so the 
+first accounts (genesis, the named accounts) get long chains, like 
+exchanges and faucets, while most accounts have a few blocks.
+"""
+
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_BLOCKS_PER_ACCOUNT = 10
+DEFAULT_SKEW = 1.0
+
+# Request kind -> percentage of requests
+DEFAULT_MIX = 'block=50,account=15,account_blocks=25,search=10'
+
+# Request kind -> explorer endpoint, for the SQL statement counts
+ENDPOINTS = {
+    'block': 'explorer.block',
+    'account': 'explorer.account',
+    'account_blocks': 'explorer.account_blocks',
+    'search': 'explorer.account_or_block',
+}
+
+# Allowed increase of the (average) number of SQL statements per request 
+# with --compare. The counts vary slightly between runs, as some values 
+# are cached per connection, so more with more threads.
+SQL_SLACK = 0.5
+
+# Run settings that have to match the baseline for --compare
+COMPARED_SETTINGS = ['threads', 'mix', 'page_cache']
+
+ZERO_HASH = bytes(32)
+
+# Synthetic ledger
+
+def weighted_chooser(n, skew, rnd):
+    """Return a function picking an index in [0, n) with weight 1/(index+1)^skew"""
+    cum_weights = []
+    total = 0.0
+    for i in range(n):
+        total += 1.0 / (i + 1)**skew
+        cum_weights.append(total)
+    return lambda: min(n - 1, bisect.bisect(cum_weights, rnd.random() * total))
+    
+def generate_ledger(lmdbfile, num_accounts=DEFAULT_ACCOUNTS, blocks_per_account=DEFAULT_BLOCKS_PER_ACCOUNT, 
+        skew=DEFAULT_SKEW, seed=1):
+    """
+    Write a synthetic ledger to a new LMDB database file, in the same format
+    as the RaiBlocks node (block, accounts, pending and frontiers sub-databases).
+    Returns (<number of blocks>, <number of opened accounts>, <number of pending blocks>)
+    """
+    import lmdb
+    
+    rnd = random.Random(seed)
+    random_bytes = lambda n: rnd.getrandbits(8*n).to_bytes(n, 'big')
+    
+    genesis = hex2bin(GENESIS_PUBLIC_KEY)
+    named = [decode_account(address) for address in sorted(KNOWN_ACCOUNTS)]
+    accounts = [genesis] + [a for a in named if a != genesis]
+    accounts += [random_bytes(32) for i in range(max(0, num_accounts - len(accounts)))]
+    choose_account = weighted_chooser(len(accounts), skew, rnd)
+    
+    blocks = {}         # hash -> (type, fields)
+    chains = {}         # account -> [hash, ...]
+    balances = {}       # account -> raw
+    pending = []        # [(destination, send hash, sender, amount)]
+    opened = []         # accounts, in order of opening
+    
+    open_hash = hex2bin(GENESIS_OPEN_BLOCK_HASH)
+    blocks[open_hash] = ('open', dict(source=genesis, representative=genesis, account=genesis))
+    chains[genesis] = [open_hash]
+    balances[genesis] = GENESIS_BALANCE_RAW
+    opened.append(genesis)
+    
+    def add_block(account, type, fields):
+        h = random_bytes(32)
+        blocks[h] = (type, fields)
+        chains.setdefault(account, []).append(h)
+        return h
+        
+    # Each send is (eventually) followed by a receive or open
+    num_sends = max(1, num_accounts * blocks_per_account // 2)
+    
+    for i in range(num_sends):
+        
+        sender = accounts[choose_account()]
+        if balances.get(sender, 0) == 0:
+            sender = opened[rnd.randrange(len(opened))]
+            if balances[sender] == 0:
+                sender = genesis
+        if rnd.random() < 0.5:
+            destination = accounts[choose_account()]
+        else:
+            destination = accounts[rnd.randrange(len(accounts))]
+            
+        amount = rnd.randint(1, max(1, balances[sender] // 5))
+        balances[sender] -= amount
+        h = add_block(sender, 'send', dict(previous=chains[sender][-1], destination=destination, balance=balances[sender]))
+        pending.append((destination, h, sender, amount))
+        
+        # Pocket a random pending send
+        if rnd.random() < 0.9:
+            destination, send_hash, sender, amount = pending.pop(rnd.randrange(len(pending)))
+            if destination in chains:
+                add_block(destination, 'receive', dict(previous=chains[destination][-1], source=send_hash))
+                balances[destination] += amount
+            else:
+                add_block(destination, 'open', dict(source=send_hash, representative=genesis, account=destination))
+                balances[destination] = amount
+                opened.append(destination)
+                
+        if rnd.random() < 0.05:
+            account = opened[rnd.randrange(len(opened))]
+            add_block(account, 'change', dict(previous=chains[account][-1], representative=accounts[choose_account()]))
+            
+    successors = {}
+    for chain in chains.values():
+        for h, next_hash in zip(chain, chain[1:]):
+            successors[h] = next_hash
+            
+    env = lmdb.Environment(lmdbfile, subdir=False, map_size=16*1024*1024*1024, max_dbs=16)
+    subdbs = dict((name, env.open_db(name.encode('ascii'))) 
+        for name in ['send', 'receive', 'open', 'change', 'accounts', 'pending', 'frontiers'])
+        
+    with env.begin(write=True) as txn:
+        
+        for h, (type, fields) in blocks.items():
+            signature, work = random_bytes(64), random_bytes(8)
+            successor = successors.get(h, ZERO_HASH)
+            if type == 'send':
+                value = fields['previous'] + fields['destination'] + fields['balance'].to_bytes(16, 'big')
+            elif type == 'receive':
+                value = fields['previous'] + fields['source']
+            elif type == 'open':
+                value = fields['source'] + fields['representative'] + fields['account']
+            else:
+                value = fields['previous'] + fields['representative']
+            txn.put(h, value + signature + work + successor, db=subdbs[type])
+            
+        for account, chain in chains.items():
+            value = chain[-1] + genesis + chain[0] + balances[account].to_bytes(16, 'big') + \
+                struct.pack('<QQ', 1500000000, len(chain))
+            txn.put(account, value, db=subdbs['accounts'])
+            txn.put(chain[-1], account, db=subdbs['frontiers'])
+            
+        for destination, h, sender, amount in pending:
+            txn.put(destination + h, sender + amount.to_bytes(16, 'big'), db=subdbs['pending'])
+            
+    env.close()
+    
+    return len(blocks), len(chains), len(pending)
+    
+def convert_ledger(lmdbfile, dbfile):
+    """Convert an LMDB ledger to SQLite with conv2sqlite.py (all steps)"""
+    conv2sqlite = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conv2sqlite.py')
+    subprocess.check_call([sys.executable, conv2sqlite, 'convert', '-d', dbfile, '-l', lmdbfile])
+    
+# Request replay
+
+def parse_mix(mix):
+    res = {}
+    for item in mix.split(','):
+        kind, percentage = item.split('=')
+        if kind not in ENDPOINTS:
+            raise click.BadParameter('Unknown request kind "%s", must be one of %s' % (kind, ', '.join(ENDPOINTS)))
+        res[kind] = float(percentage)
+    return res
+    
+def generate_requests(db, num_requests, mix, skew, seed):
+    """
+    Return a list of (kind, method, path, form) requests. Account pages 
+    (and their block lists) are picked with the same kind of skew as the
+    ledger, by descending chain length; blocks uniformly.
+    """
+    
+    rnd = random.Random(seed)
+    cur = db.cursor()
+    
+    max_block_id = next(cur.execute('select max(id) from blocks'))[0]
+    accounts = list(cur.execute('select account, chain_length from account_info order by chain_length desc, account'))
+    choose_account = weighted_chooser(len(accounts), skew, rnd)
+    
+    kinds = list(mix)
+    cum_weights = []
+    total = 0.0
+    for kind in kinds:
+        total += mix[kind]
+        cum_weights.append(total)
+        
+    requests = []
+    for i in range(num_requests):
+        kind = kinds[bisect.bisect(cum_weights, rnd.random() * total)]
+        if kind == 'block':
+            requests.append((kind, 'GET', '/block/%d' % rnd.randint(0, max_block_id), None))
+        elif kind == 'account':
+            account_id, chain_length = accounts[choose_account()]
+            requests.append((kind, 'GET', '/account/%d' % account_id, None))
+        elif kind == 'account_blocks':
+            # Mostly the first page, as loaded by the account page
+            account_id, chain_length = accounts[choose_account()]
+            start = chain_length - 1
+            if rnd.random() < 0.3:
+                start = rnd.randint(0, chain_length - 1)
+            requests.append((kind, 'GET', '/account_blocks/%d/%d/50' % (account_id, start), None))
+        else:
+            if rnd.random() < 0.5:
+                value = next(cur.execute('select hash from blocks where id = ?', (rnd.randint(0, max_block_id),)))[0][:12]
+            else:
+                account_id, chain_length = accounts[rnd.randrange(len(accounts))]
+                value = next(cur.execute('select address from accounts where id = ?', (account_id,)))[0][:12]
+            requests.append((kind, 'POST', '/account_or_block', dict(value=value)))
+            
+    return requests
+    
+def replay(app, requests, threads):
+    """
+    Perform the requests with a test client per thread, returning the 
+    elapsed time and a list of (kind, status, latency)
+    """
+    
+    results = []
+    lock = threading.Lock()
+    
+    def worker(requests):
+        client = app.test_client()
+        res = []
+        for kind, method, path, form in requests:
+            t0 = time.perf_counter()
+            if method == 'GET':
+                response = client.get(path)
+            else:
+                response = client.post(path, data=form)
+            response.get_data()
+            res.append((kind, response.status_code, time.perf_counter() - t0))
+        with lock:
+            results.extend(res)
+            
+    workers = [threading.Thread(target=worker, args=(requests[i::threads],)) for i in range(threads)]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+        
+    return time.perf_counter() - t0, results
+    
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+    
+def summarize(elapsed, results, metrics):
+    """
+    Per request kind (plus 'all'): count, errors, p50/p99 latency (ms), SQL 
+    statements per request (only with metrics); plus the overall 
+    throughput (req/s) for 'all'
+    """
+    
+    summary = {}
+    for kind in [None] + list(ENDPOINTS):
+        latencies = sorted(latency for k, status, latency in results if kind is None or k == kind)
+        if len(latencies) == 0:
+            continue
+        summary[kind or 'all'] = dict(
+            requests=len(latencies),
+            errors=sum(1 for k, status, latency in results if (kind is None or k == kind) and status >= 400),
+            p50_ms=percentile(latencies, 0.5) * 1000,
+            p99_ms=percentile(latencies, 0.99) * 1000,
+        )
+        if metrics is not None:
+            if kind is None:
+                histograms = list(metrics.statements.values())
+            else:
+                histograms = [metrics.statements[ENDPOINTS[kind]]] if ENDPOINTS[kind] in metrics.statements else []
+            statements = sum(h.sum for h in histograms)
+            counted = sum(sum(h.counts) for h in histograms)
+            summary[kind or 'all']['sql_per_request'] = 1.0 * statements / counted if counted > 0 else 0.0
+    summary['all']['requests_per_second'] = len(results) / elapsed
+    return summary
+    
+def relative_change(value, base):
+    return '%+.0f%%' % (100.0 * (value / base - 1)) if base > 0 else '-'
+    
+def print_summary(summary, baseline=None):
+    print('%-15s %8s %8s %9s %9s %9s %9s' % ('Requests', 'count', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)', 'SQL/req'))
+    for kind, s in summary.items():
+        rate = '%.1f' % s['requests_per_second'] if 'requests_per_second' in s else ''
+        sql = '%.1f' % s['sql_per_request'] if 'sql_per_request' in s else '-'
+        print('%-15s %8d %8d %9s %9.1f %9.1f %9s' % (kind, s['requests'], s['errors'], rate, 
+            s['p50_ms'], s['p99_ms'], sql))
+        if baseline is not None and kind in baseline:
+            b = baseline[kind]
+            rate = relative_change(s['requests_per_second'], b['requests_per_second']) if 'requests_per_second' in s else ''
+            print('%-15s %8s %8s %9s %9s %9s %9s' % ('  vs baseline', '', '', rate,
+                relative_change(s['p50_ms'], b['p50_ms']),
+                relative_change(s['p99_ms'], b['p99_ms']),
+                relative_change(s['sql_per_request'], b['sql_per_request'])))
+                
+def regressions(summary, baseline, tolerance, sql_slack=SQL_SLACK):
+    """
+    Return descriptions of the regressions relative to a baseline summary:
+    throughput lower by more than the tolerance (a fraction), or more than
+    sql_slack additional SQL statements per request.
+    """
+    res = []
+    s, b = summary['all'], baseline['all']
+    if s['requests_per_second'] < b['requests_per_second'] * (1 - tolerance):
+        res.append('%.1f req/s, baseline %.1f' % (s['requests_per_second'], b['requests_per_second']))
+    for kind, s in summary.items():
+        if kind not in baseline:
+            continue
+        b = baseline[kind]
+        if s['sql_per_request'] > b['sql_per_request'] + sql_slack:
+            res.append('%s: %.1f SQL statements per request, baseline %.1f' % (kind, s['sql_per_request'], b['sql_per_request']))
+    return res
+    
+# HTTP benchmark: an explorer server in a separate process, with 
+# concurrent keep-alive client connections
+
+HTTP_SERVERS = ['debug', 'werkzeug', 'waitress', 'gunicorn', 'async']
+
+def server_command(server, dbfile, port, threads, workers, page_cache):
+    """Command line for running an explorer server"""
+    scriptdir = os.path.dirname(os.path.abspath(__file__))
+    if server == 'async':
+        # Has no page cache
+        return [sys.executable, os.path.join(scriptdir, 'explorer_async.py'), 
+            '-t', str(threads), '--port', str(port), dbfile]
+    cmd = [sys.executable, os.path.join(scriptdir, 'explorer.py')]
+    if server == 'debug':
+        cmd += ['debug']
+    else:
+        cmd += ['serve', '--server', server, '-t', str(threads), '-w', str(workers)]
+    if not page_cache:
+        cmd += ['--no-page-cache']
+    return cmd + ['--port', str(port), dbfile]
+    
+def start_server(cmd, host, port, timeout=60):
+    """Start a server (in its own process group) and wait until it accepts connections"""
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if process.poll() is not None:
+            raise click.ClickException('Server exited with status %d: %s' % (process.returncode, ' '.join(cmd)))
+        try:
+            socket.create_connection((host, port), 1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise click.ClickException('Server did not start within %ds: %s' % (timeout, ' '.join(cmd)))
+    
+def stop_server(process):
+    # The debug server and gunicorn run the application in child processes
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        
+async def http_request(reader, writer, host, method, path, form):
+    """
+    Perform a request on an open connection, reading (and discarding) the 
+    response. Returns (status, keep_alive).
+    """
+    body = urllib.parse.urlencode(form).encode('ascii') if form is not None else b''
+    head = '%s %s HTTP/1.1\r\nHost: %s\r\n' % (method, path, host)
+    if method == 'POST':
+        head += 'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: %d\r\n' % len(body)
+    writer.write(head.encode('ascii') + b'\r\n' + body)
+    await writer.drain()
+    
+    version, status = (await reader.readuntil(b'\r\n')).split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        if line == b'\r\n':
+            break
+        name, value = line.decode('latin1').split(':', 1)
+        headers[name.strip().lower()] = value.strip().lower()
+        
+    connection = headers.get('connection')
+    keep_alive = connection == 'keep-alive' or (version == b'HTTP/1.1' and connection != 'close')
+    
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        # Until the server closes the connection
+        await reader.read()
+        keep_alive = False
+        
+    return int(status), keep_alive
+    
+async def http_client(host, port, requests, results):
+    """
+    Perform requests one after the other over a keep-alive connection,
+    reconnecting when the server closes it. Failed requests get status 599.
+    """
+    reader = writer = None
+    for kind, method, path, form in requests:
+        t0 = time.perf_counter()
+        status = 599
+        # A kept-alive connection may have been closed by the server in 
+        # the meantime, so retry once on a new connection
+        for attempt in range(2):
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                status, keep_alive = await http_request(reader, writer, host, method, path, form)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                keep_alive = False
+            if not keep_alive and writer is not None:
+                writer.close()
+                writer = None
+            if status != 599:
+                break
+        results.append((kind, status, time.perf_counter() - t0))
+    if writer is not None:
+        writer.close()
+        
+async def http_replay(host, port, requests, clients):
+    """Perform the requests over the given number of concurrent client connections"""
+    results = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*[http_client(host, port, requests[i::clients], results) for i in range(clients)])
+    return time.perf_counter() - t0, results
+    
+# Commands
+
+@click.command()
+@click.option('-a', '--accounts', default=DEFAULT_ACCOUNTS, help='Number of accounts', show_default=True)
+@click.option('-b', '--blocks-per-account', default=DEFAULT_BLOCKS_PER_ACCOUNT, help='Average number of blocks per account', show_default=True)
+@click.option('-s', '--skew', default=DEFAULT_SKEW, help='Activity skew exponent (0 = uniform)', show_default=True)
+@click.option('--seed', default=1, show_default=True)
+@click.argument('lmdbfile')
+def generate(accounts, blocks_per_account, skew, seed, lmdbfile):
+    """Write a synthetic ledger to LMDBFILE"""
+    if os.path.exists(lmdbfile):
+        raise click.UsageError('%s already exists' % lmdbfile)
+    t0 = time.time()
+    num_blocks, num_accounts, num_pending = generate_ledger(lmdbfile, accounts, blocks_per_account, skew, seed)
+    print('Wrote %d blocks, %d opened accounts, %d pending blocks to %s in %.1fs' % 
+        (num_blocks, num_accounts, num_pending, lmdbfile, time.time() - t0))
+        
+@click.command()
+@click.option('-a', '--accounts', default=DEFAULT_ACCOUNTS, help='Number of accounts', show_default=True)
+@click.option('-b', '--blocks-per-account', default=DEFAULT_BLOCKS_PER_ACCOUNT, help='Average number of blocks per account', show_default=True)
+@click.option('-s', '--skew', default=DEFAULT_SKEW, help='Activity skew exponent (0 = uniform)', show_default=True)
+@click.option('--seed', default=1, show_default=True)
+@click.argument('dbfile')
+def makedb(accounts, blocks_per_account, skew, seed, dbfile):
+    """Create a synthetic SQLite database DBFILE (generate + conv2sqlite.py convert)"""
+    if os.path.exists(dbfile):
+        raise click.UsageError('%s already exists' % dbfile)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        lmdbfile = os.path.join(tmpdir, 'data.ldb')
+        num_blocks, num_accounts, num_pending = generate_ledger(lmdbfile, accounts, blocks_per_account, skew, seed)
+        print('Generated %d blocks, %d opened accounts, %d pending blocks' % (num_blocks, num_accounts, num_pending))
+        convert_ledger(lmdbfile, dbfile)
+        
+@click.command()
+@click.option('-n', '--requests', 'num_requests', default=2000, help='Number of requests', show_default=True)
+@click.option('-w', '--warmup', default=200, help='Number of (unmeasured) warmup requests', show_default=True)
+@click.option('-t', '--threads', default=1, help='Number of client threads (and database connections)', show_default=True)
+@click.option('-m', '--mix', default=DEFAULT_MIX, help='Percentage of requests per kind', show_default=True)
+@click.option('-s', '--skew', default=DEFAULT_SKEW, help='Account popularity skew exponent', show_default=True)
+@click.option('--page-cache', is_flag=True, help='Keep the page cache enabled (measures rendering by default)')
+@click.option('--seed', default=1, show_default=True)
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Write the results to a JSON file')
+@click.option('-c', '--compare', type=click.Path(exists=True, dir_okay=False), help='Compare with results of an earlier run (JSON), failing on regressions')
+@click.option('--tolerance', default=0.1, help='Allowed relative throughput decrease with --compare', show_default=True)
+@click.option('--sql-slack', default=SQL_SLACK, help='Allowed increase of SQL statements per request with --compare', show_default=True)
+@click.argument('dbfile')
+def run(num_requests, warmup, threads, mix, skew, page_cache, seed, output, compare, tolerance, sql_slack, dbfile):
+    """Replay a mix of explorer requests against DBFILE"""
+    
+    from explorer import create_app
+    from metrics import RequestMetrics
+    
+    mix = parse_mix(mix)
+    
+    baseline = None
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+        settings = dict(threads=threads, mix=mix, page_cache=page_cache)
+        for name in COMPARED_SETTINGS:
+            if baseline.get(name) != settings[name]:
+                raise click.UsageError('Can only compare with a run using the same %s (baseline %s, now %s)' % 
+                    (name, baseline.get(name), settings[name]))
+        baseline = baseline['summary']
+    
+    app = create_app(dbfile, pool_size=threads, page_cache=page_cache)
+    state = app.extensions['explorer']
+        
+    with state.pool.connection() as db:
+        requests = generate_requests(db, warmup + num_requests, mix, skew, seed)
+        
+    replay(app, requests[:warmup], threads)
+    
+    # Fresh metrics for the measured requests, with statement counting active
+    state.metrics = RequestMetrics(state.metrics.prefix)
+    state.metrics.activate()
+    
+    elapsed, results = replay(app, requests[warmup:], threads)
+    summary = summarize(elapsed, results, state.metrics)
+    
+    print('%d requests in %.1fs, %d thread(s)' % (len(results), elapsed, threads))
+    print_summary(summary, baseline)
+    
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(dict(dbfile=dbfile, requests=num_requests, threads=threads, mix=mix, 
+                page_cache=page_cache, seed=seed, summary=summary), f, indent=1)
+                
+    if baseline is not None:
+        problems = regressions(summary, baseline, tolerance, sql_slack)
+        for problem in problems:
+            print('REGRESSION %s' % problem)
+        if len(problems) > 0:
+            sys.exit(1)
+            
+@click.command()
+@click.option('-n', '--count', default=100000, help='Number of amounts', show_default=True)
+@click.option('-p', '--precision', default=2, show_default=True)
+@click.option('--seed', default=1, show_default=True)
+def amounts(count, precision, seed):
+    """Time the formatting of random amounts (of all magnitudes)"""
+    
+    rnd = random.Random(seed)
+    values = [rnd.getrandbits(rnd.randint(1, 128)) for i in range(count)]
+    
+    def swap_separators(s):
+        # As previously done per value by the explorer for '.' separators
+        return s.replace('.', '#').replace(',', '.').replace('#', ',')
+        
+    print('%-45s %10s %12s' % ('Formatting %d amounts' % count, 'time (s)', 'us/amount'))
+    
+    for thousands, decimal in ((',', '.'), ('.', ',')):
+        formatter = AmountFormatter(precision, thousands, decimal)
+        
+        t0 = time.perf_counter()
+        if thousands == ',':
+            expected = [format_amount(v, precision) for v in values]
+        else:
+            expected = [swap_separators(format_amount(v, precision)) for v in values]
+        t1 = time.perf_counter()
+        single = [formatter(v) for v in values]
+        t2 = time.perf_counter()
+        batch = formatter.many(values)
+        t3 = time.perf_counter()
+        
+        assert single == batch
+        # format_amount() rounds the float quotient, so can differ on the last digit
+        differences = sum(1 for a, b in zip(expected, batch) if a != b)
+        
+        for name, t in (('format_amount()', t1 - t0), ('AmountFormatter()', t2 - t1), ('AmountFormatter.many()', t3 - t2)):
+            print('%-45s %10.3f %12.2f' % ('%s, separators "%s" "%s"' % (name, thousands, decimal), t, t / count * 1e6))
+        print('%d differences in the last digit' % differences)
+        
+@click.command()
+@click.option('--server', type=click.Choice(HTTP_SERVERS), default='waitress', help='Server to run the explorer with (debug = "explorer.py debug", async = explorer_async.py with hypercorn)', show_default=True)
+@click.option('-c', '--clients', default=8, help='Number of concurrent keep-alive client connections', show_default=True)
+@click.option('-n', '--requests', 'num_requests', default=2000, help='Number of requests', show_default=True)
+@click.option('-w', '--warmup', default=200, help='Number of (unmeasured) warmup requests', show_default=True)
+@click.option('-t', '--threads', default=8, help='Request handling threads per worker process (database threads for async)', show_default=True)
+@click.option('-p', '--processes', default=1, help='Number of worker processes (gunicorn only)', show_default=True)
+@click.option('-m', '--mix', default=DEFAULT_MIX, help='Percentage of requests per kind', show_default=True)
+@click.option('-s', '--skew', default=DEFAULT_SKEW, help='Account popularity skew exponent', show_default=True)
+@click.option('--page-cache', is_flag=True, help='Keep the page cache enabled (measures rendering by default)')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--port', default=7790, help='Port to run the server on', show_default=True)
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Write the results to a JSON file')
+@click.argument('dbfile')
+def http(server, clients, num_requests, warmup, threads, processes, mix, skew, page_cache, seed, port, output, dbfile):
+    """
+    Run an explorer server for DBFILE and replay a mix of requests against
+    it over HTTP, with concurrent keep-alive clients. The server is started
+    with the same Python interpreter, which needs the server package.
+    """
+    
+    from nanodb import NanoDatabase
+    
+    host = '127.0.0.1'
+    mix = parse_mix(mix)
+    
+    db = NanoDatabase(dbfile)
+    requests = generate_requests(db, warmup + num_requests, mix, skew, seed)
+    db.close()
+    
+    cmd = server_command(server, dbfile, port, threads, processes, page_cache)
+    process = start_server(cmd, host, port)
+    try:
+        asyncio.run(http_replay(host, port, requests[:warmup], clients))
+        elapsed, results = asyncio.run(http_replay(host, port, requests[warmup:], clients))
+    finally:
+        stop_server(process)
+        
+    summary = summarize(elapsed, results, None)
+    
+    print('%s: %d requests in %.1fs, %d client connection(s)' % (' '.join([os.path.basename(cmd[1])] + cmd[2:]), len(results), elapsed, clients))
+    print_summary(summary)
+    
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(dict(dbfile=dbfile, server=server, command=cmd[1:], clients=clients, requests=num_requests,
+                threads=threads, processes=processes, mix=mix, page_cache=page_cache, seed=seed, summary=summary), f, indent=1)
+                
+@click.group()
+def cli():
+    pass
+    
+cli.add_command(generate)
+cli.add_command(makedb)
+cli.add_command(run)
+cli.add_command(http)
+cli.add_command(amounts)
+
+if __name__ == '__main__':
+    cli()
@@ -24,13 +24,14 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import sys, collections, os
+import sys, collections, os, time, uuid
 from struct import unpack
 import click
 import lmdb, apsw
 import progressbar
 
 from rainumbers import hex2bin, bin2hex, bin2balance_mxrb, bin2balance_raw, encode_account
+from nanodb import NanoDatabase, compute_ledger_stats, flatten_ledger_stats, hash_prefix
 from nanodb import KNOWN_ACCOUNTS, GENESIS_OPEN_BLOCK_HASH, GENESIS_ACCOUNT, GENESIS_PUBLIC_KEY, GENESIS_BALANCE_XRB, GENESIS_BALANCE_RAW
 from toposort import topological_sort, generate_block_dependencies
 
@@ -62,6 +63,18 @@ drop table if exists accounts;
 drop table if exists blocks;
 drop table if exists block_validation;
 drop table if exists block_info;
+drop table if exists account_info;
+drop table if exists pending;
+drop table if exists ledger_stats;
+drop table if exists metadata;
+
+create table metadata
+(
+    name        text not null,      -- see store_metadata()
+    value       text not null,
+    
+    primary key(name)
+);
 
 create table accounts
 (
@@ -82,6 +95,7 @@ create table blocks
 (
     id          integer not null,
     hash        text not null,
+    hash_prefix integer not null,   -- first 8 bytes of hash as signed 64-bit integer, see nanodb.hash_prefix()
     type        text not null,
 
     -- All blocks
@@ -128,12 +142,48 @@ create table block_info
     primary key(block)
 );
 
+-- Imported from the LMDB "pending" table, i.e. send blocks not pocketed yet
+create table pending
+(
+    destination     integer not null,   -- [account]
+    block           integer not null,   -- [block]      send block
+    sender          integer not null,   -- [account]
+    amount          text not null,      -- raw, integer represented as string
+    
+    primary key(destination, block)
+);
+
+create table account_info
+(
+    account         integer not null,
+    
+    head_block      integer not null,   -- [block]      Last block in the account chain
+    chain_length    integer not null,
+    balance         blob not null,      -- current balance, in raw, as 16-byte big-endian integer
+                                        -- (blobs compare with memcmp(), so this sorts exactly)
+
+    primary key(account)
+);
+
 commit;
 """
 
+LEDGER_STATS_SCHEMA = """
+drop table if exists ledger_stats;
+
+create table ledger_stats
+(
+    name        text not null,      -- e.g. "blocks_by_type.send", see nanodb.compute_ledger_stats()
+    value       text not null,      -- integer represented as string (amounts are in raw)
+    
+    primary key(name)
+);
+"""
+
 DROP_INDICES = """
 drop index if exists accounts_address;
 
+drop index if exists blocks_hash_prefix;
 drop index if exists blocks_source;
 drop index if exists blocks_destination;
 drop index if exists blocks_account;
@@ -146,11 +196,19 @@ drop index if exists block_info_account;
 drop index if exists block_info_chain_index;
 drop index if exists block_info_global_index;
 drop index if exists block_info_sister;
+drop index if exists block_info_account_global_index;
+
+drop index if exists account_info_balance;
+
+drop index if exists pending_block;
 """
 
 CREATE_INDICES = """
 create index accounts_address on accounts (address);
 
+-- Search on (partial) hash
+create index blocks_hash_prefix on blocks (hash_prefix);
+
 create index blocks_source on blocks (source);
 create index blocks_destination on blocks (destination);
 create index blocks_account on blocks (account);
@@ -163,6 +221,13 @@ create index block_info_account on block_info (account);
 create index block_info_chain_index on block_info (chain_index);
 create index block_info_global_index on block_info (global_index);
 create index block_info_sister on block_info (sister);
+-- For balance lookups at a point in (global) time
+create index block_info_account_global_index on block_info (account, global_index);
+
+-- Rich list
+create index account_info_balance on account_info (balance, account);
+
+create index pending_block on pending (block);
 
 analyze;
 """
@@ -295,8 +360,8 @@ def process_open_entry(sqlcur, key, value):
     work = '%08x' % work
     successor_id = get_block_id(successor)
 
-    sqlcur.execute('insert into blocks (id, hash, type, source, representative, account, next) values (?,?,?,?,?,?,?)',
-        (block_id, hash, 'open', source_id, representative_id, account_id, successor_id))
+    sqlcur.execute('insert into blocks (id, hash, hash_prefix, type, source, representative, account, next) values (?,?,?,?,?,?,?,?)',
+        (block_id, hash, hash_prefix(hash), 'open', source_id, representative_id, account_id, successor_id))
         
     sqlcur.execute('insert into block_validation (id, signature, work) values (?,?,?)', 
         (block_id, signature, work))
@@ -330,8 +395,8 @@ def process_change_entry(sqlcur, key, value):
     work = '%08x' % work
     successor_id = get_block_id(successor)
 
-    sqlcur.execute('insert into blocks (id, hash, type, previous, representative, next) values (?,?,?,?,?,?)',
-        (block_id, hash, 'change', previous_id, representative_id, successor_id))
+    sqlcur.execute('insert into blocks (id, hash, hash_prefix, type, previous, representative, next) values (?,?,?,?,?,?,?)',
+        (block_id, hash, hash_prefix(hash), 'change', previous_id, representative_id, successor_id))
         
     sqlcur.execute('insert into block_validation (id, signature, work) values (?,?,?)', 
         (block_id, signature, work))
@@ -365,8 +430,8 @@ def process_receive_entry(sqlcur, key, value):
     work = '%08x' % work
     successor_id = get_block_id(successor)
 
-    sqlcur.execute('insert into blocks (id, hash, type, previous, source, next) values (?,?,?,?,?,?)',
-        (block_id, hash, 'receive', previous_id, source_id, successor_id))
+    sqlcur.execute('insert into blocks (id, hash, hash_prefix, type, previous, source, next) values (?,?,?,?,?,?,?)',
+        (block_id, hash, hash_prefix(hash), 'receive', previous_id, source_id, successor_id))
         
     sqlcur.execute('insert into block_validation (id, signature, work) values (?,?,?)', 
         (block_id, signature, work))
@@ -407,16 +472,59 @@ def process_send_entry(sqlcur, key, value):
     successor_id = get_block_id(successor)
 
     # Note that we store balance_raw (a Python long) as a string
-    sqlcur.execute('insert into blocks (id, hash, type, previous, destination, balance, balance_raw, next) values (?,?,?,?,?,?,?,?)',
-        (block_id, hash, 'send', previous_id, destination_id, balance_mxrb, str(balance_raw), successor_id))
+    sqlcur.execute('insert into blocks (id, hash, hash_prefix, type, previous, destination, balance, balance_raw, next) values (?,?,?,?,?,?,?,?,?)',
+        (block_id, hash, hash_prefix(hash), 'send', previous_id, destination_id, balance_mxrb, str(balance_raw), successor_id))
         
     sqlcur.execute('insert into block_validation (id, signature, work) values (?,?,?)', 
         (block_id, signature, work))
 
 
+def process_pending_entry(sqlcur, key, value):
+
+    # secure.hpp, class pending_info
+
+    assert len(key) == 64
+    destination = key[:32]
+    block = key[32:]
+
+    sender = value[:32]
+    amount = value[32:48]
+    assert len(value[48:]) == 0
+
+    destination_id = get_account_id(encode_account(destination))
+    block_id = get_block_id(block)
+    sender_id = get_account_id(encode_account(sender))
+    amount = bin2balance_raw(amount)
+
+    # Note that we store amount (a Python long) as a string
+    sqlcur.execute('insert into pending (destination, block, sender, amount) values (?,?,?,?)',
+        (destination_id, block_id, sender_id, str(amount)))
+
+
+def store_metadata(sqlcur, lmdbfile):
+    """
+    Record where and when the database was generated. Besides being
+    informative this identifies the conversion, which NanoDatabase.generation()
+    uses (e.g. so the explorer can tell that cached pages are outdated).
+    """
+    st = os.stat(lmdbfile)
+    metadata = dict(
+        conversion_id = uuid.uuid4().hex,
+        converted_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        command = ' '.join(sys.argv),
+        lmdb_file = os.path.abspath(lmdbfile),
+        lmdb_size = str(st.st_size),
+        lmdb_mtime = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(st.st_mtime)),
+    )
+    sqlcur.execute('begin')
+    for name, value in metadata.items():
+        sqlcur.execute('insert into metadata (name, value) values (?,?)', (name, value))
+    sqlcur.execute('commit')
+
 @click.command()
 @click.option('-d', '--dbfile', default=DEFAULT_SQLITE_DB, help='SQLite database file', show_default=True)
-def create(dbfile):
+@click.option('-l', '--lmdb', 'lmdbfile', default=RAIBLOCKS_LMDB_DB, help='RaiBlocks LMDB database file', show_default=True)
+def create(dbfile, lmdbfile):
 
     """Create SQLite database from the RaiBlocks LMDB database"""
 
@@ -425,14 +533,15 @@ def create(dbfile):
         'open'      : process_open_entry,
         'receive'   : process_receive_entry,
         'send'      : process_send_entry,
+        'pending'   : process_pending_entry,
         #'vote': process_vote_entry,
     }
 
-    print("Reading the Nano database at %s" % RAIBLOCKS_LMDB_DB)
+    print("Reading the Nano database at %s" % lmdbfile)
 
     # Open the RaiBlocks database
     env = lmdb.Environment(
-        RAIBLOCKS_LMDB_DB, subdir=False,
+        lmdbfile, subdir=False,
         map_size=10*1024*1024*1024, max_dbs=16,
         readonly=True)
 
@@ -444,10 +553,12 @@ def create(dbfile):
     #sqlcur.execute('PRAGMA synchronous=NORMAL;')    
     sqlcur.execute(SCHEMA)
     sqlcur.execute(DROP_INDICES)
+    
+    store_metadata(sqlcur, lmdbfile)
 
-    # Process blocks per type
+    # Process blocks per type, followed by the pending blocks
 
-    for subdbname in ['change', 'open', 'receive', 'send']:
+    for subdbname in ['change', 'open', 'receive', 'send', 'pending']:
 
         subdb = env.open_db(subdbname.encode())
 
@@ -835,12 +946,102 @@ def derive_block_info(dbfile):
 
 @click.command()
 @click.option('-d', '--dbfile', default=DEFAULT_SQLITE_DB, help='SQLite database file', show_default=True)
+def derive_account_info(dbfile):
+    """Store for each account its head block, chain length and current balance"""
+    
+    print('Deriving per-account info')
+    
+    sqldb = apsw.Connection(dbfile)
+    sqlcur = sqldb.cursor()
+    sqlcur.execute('delete from account_info')
+    
+    # Key: account id
+    # Value: (chain index, block id, balance) of the last block seen so far
+    account_to_head = {}
+    
+    bar = progressbar.ProgressBar('Finding account head blocks')
+    i = 0
+    
+    sqlcur.execute('select account, chain_index, block, balance from block_info')
+    
+    for account, chain_index, block, balance in sqlcur:
+        
+        head = account_to_head.get(account)
+        if head is None or chain_index > head[0]:
+            account_to_head[account] = (chain_index, block, balance)
+            
+        i += 1
+        bar.update(i)
+            
+    bar.finish()
+    
+    bar = progressbar.ProgressBar('Storing per-account info')
+    i = 0
+    
+    sqlcur.execute('begin')
+    
+    for account, (chain_index, block, balance) in account_to_head.items():
+        
+        # String -> 16-byte big-endian integer
+        balance = int(balance).to_bytes(16, 'big')
+        
+        sqlcur.execute('insert into account_info (account, head_block, chain_length, balance) values (?,?,?,?)',
+            (account, block, chain_index+1, balance))
+            
+        i += 1
+        bar.update(i)
+    
+    sqlcur.execute('commit')
+    
+    bar.finish()
+
+@click.command()
+@click.option('-d', '--dbfile', default=DEFAULT_SQLITE_DB, help='SQLite database file', show_default=True)
+def compute_stats(dbfile):
+    """Compute ledger statistics, as returned by NanoDatabase.stats()"""
+    
+    print('Computing ledger statistics')
+    
+    sqldb = apsw.Connection(dbfile)
+    sqlcur = sqldb.cursor()
+    
+    stats = compute_ledger_stats(sqlcur)
+    
+    sqlcur.execute('begin')
+    sqlcur.execute(LEDGER_STATS_SCHEMA)
+    for name, value in flatten_ledger_stats(stats):
+        sqlcur.execute('insert into ledger_stats (name, value) values (?,?)', (name, value))
+    sqlcur.execute('commit')
+
+@click.command()
+@click.option('-d', '--dbfile', default=DEFAULT_SQLITE_DB, help='SQLite database file', show_default=True)
+def check_pending(dbfile):
+    """Cross-check the imported pending blocks against the derived sister blocks"""
+    
+    print('Checking pending blocks')
+    
+    db = NanoDatabase(dbfile)
+    res = db.check_pending()
+    
+    for problem, blocks in res.items():
+        if len(blocks) > 0:
+            print('%d pending blocks %s, e.g. %s' % (len(blocks), problem.replace('_', ' '), blocks[:10]))
+    
+    if sum(len(blocks) for blocks in res.values()) == 0:
+        print('No inconsistencies found')
+
+@click.command()
+@click.option('-d', '--dbfile', default=DEFAULT_SQLITE_DB, help='SQLite database file', show_default=True)
+@click.option('-l', '--lmdb', 'lmdbfile', default=RAIBLOCKS_LMDB_DB, help='RaiBlocks LMDB database file', show_default=True)
 @click.pass_context
-def convert(ctx, dbfile):
+def convert(ctx, dbfile, lmdbfile):
     "Convert LMDB database to SQLite (all steps)"
-    ctx.forward(create)
-    ctx.forward(derive_block_info)
-    ctx.forward(create_indices)
+    ctx.invoke(create, dbfile=dbfile, lmdbfile=lmdbfile)
+    ctx.invoke(derive_block_info, dbfile=dbfile)
+    ctx.invoke(derive_account_info, dbfile=dbfile)
+    ctx.invoke(create_indices, dbfile=dbfile)
+    ctx.invoke(compute_stats, dbfile=dbfile)
+    ctx.invoke(check_pending, dbfile=dbfile)
 
 @click.group()
 def cli():
@@ -849,11 +1050,12 @@ def cli():
 cli.add_command(convert)
 cli.add_command(create)
 cli.add_command(derive_block_info)
+cli.add_command(derive_account_info)
 cli.add_command(create_indices)
 cli.add_command(drop_indices)
 cli.add_command(analyze)
+cli.add_command(compute_stats)
+cli.add_command(check_pending)
 
 if __name__ == '__main__':
     cli()
-
-# XXX add some metadata in the db on when it was generated, command, etc.
\ No newline at end of file
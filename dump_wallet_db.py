@@ -24,10 +24,10 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import sys, os, time
+import os, time, collections, multiprocessing
 from enum import Enum
 from struct import unpack
-import lmdb, numpy
+import click, lmdb
 from rainumbers import *
 
 """
@@ -162,22 +162,17 @@ value (min, max, median):  241 273 257.0
 DATADIR = 'RaiBlocks'
 DBPREFIX = 'data.ldb'
 
+RAIBLOCKS_LMDB_DB = os.path.join(os.environ.get('HOME', ''), DATADIR, DBPREFIX)
+
 SUBDBS = ['accounts', 'blocks_info', 'change', 'checksum', 'frontiers', 'meta', 'open', 'pending', 'receive', 'representation', 'send', 'unchecked', 'unsynced', 'vote']
 #SUBDBS = ['open']
 
-if len(sys.argv) > 1:
-    subdbs = sys.argv[1:]
-    for subdb in subdbs:
-        if subdb not in SUBDBS:
-            print('Invalid sub-db "%s"' % subdb)
-            print('Must be one or more of %s' % SUBDBS)
-            sys.exit(-1)
-            
-    SUBDBS = subdbs
+# Quantiles reported for key and value lengths
+QUANTILES = [0.01, 0.5, 0.99]
 
-
-env = lmdb.Environment(
-        os.path.join(os.environ['HOME'],DATADIR,DBPREFIX), subdir=False, readonly=True,
+def open_env(lmdbfile):
+    return lmdb.Environment(
+        lmdbfile, subdir=False, readonly=True,
         map_size=10*1024*1024*1024, max_dbs=16)
 
 # XXX not used yet
@@ -191,231 +186,397 @@ class BlockType(Enum):
     CHANGE = 5
     
     
-def find_block_type(blockhash, value=False):
+block_locator = None
+
+def find_block_type(env, blockhash, value=False):
+    """
+    Return the sub-database holding the block with the given (hex) hash,
+    or None. With value=True returns (<sub-db name>, <value>).
+    """
     
-    assert isinstance(blockhash, str)
+    global block_locator
     
-    blockhash = hex2bin(blockhash)
+    assert isinstance(blockhash, str)
     
-    # Roughly in order of decreasing occurrence
-    for subdbname in ['send', 'receive', 'open', 'change', 'vote']:
+    if block_locator is None or block_locator.env is not env:
+        from nanolmdb import BlockLocator, BLOCK_TYPES
+        # Exact lookups, all in the same read transaction
+        block_locator = BlockLocator(env, BLOCK_TYPES + ['vote'])
         
-        subdb = env.open_db(subdbname.encode())
+    res = block_locator.locate(hex2bin(blockhash))
+    if res is None:
+        return None
+    if value:
+        return res[0], bytes(res[1])
+    return res[0]
+    
+#print(find_block_type(env, '870E346AB08AC27A4B6413323BA129654783835DE9132FC0BF7ACE0D22273625'))
 
-        with env.begin(write=False) as tx:
-            
-            cur = tx.cursor(subdb)
-            if cur.set_range(blockhash):
-                if value:
-                    return subdbname, cur.value()
-                return subdbname
+
+class LengthStats:
+    
+    """
+    Streaming statistics of key or value lengths: as lengths are small 
+    integers an exact histogram takes little memory, and gives min, max 
+    and quantiles without storing the individual lengths
+    """
+    
+    def __init__(self):
+        self.histogram = collections.Counter()
+        self.count = 0
+        
+    def add(self, length):
+        self.histogram[length] += 1
+        self.count += 1
+        
+    def min(self):
+        return min(self.histogram)
+        
+    def max(self):
+        return max(self.histogram)
+        
+    def nth(self, n):
+        """The n-th smallest length (0-based)"""
+        seen = 0
+        for length in sorted(self.histogram):
+            seen += self.histogram[length]
+            if seen > n:
+                return length
+        raise IndexError(n)
+        
+    def quantile(self, q):
+        return self.nth(min(self.count - 1, int(q * self.count)))
+        
+    def median(self):
+        # Same as numpy.median()
+        if self.count % 2 == 1:
+            return float(self.nth(self.count // 2))
+        return (self.nth(self.count // 2 - 1) + self.nth(self.count // 2)) / 2.0
+        
+    def summary(self):
+        return '[%d, %d]; median = %.1f; %s' % (self.min(), self.max(), self.median(),
+            ', '.join('p%g = %d' % (100*q, self.quantile(q)) for q in QUANTILES))
             
-    return None
+    def histogram_lines(self, max_lines=10):
+        """Most common lengths, as lines of text"""
+        return ['%6d bytes: %d' % (length, n) for length, n in self.histogram.most_common(max_lines)]
+        
+
+def print_record(subdbname, key, value):
+    """Print the decoded contents of a record"""
     
-#print(find_block_type('870E346AB08AC27A4B6413323BA129654783835DE9132FC0BF7ACE0D22273625'))
-#doh
+    if subdbname == 'accounts':                      
+        # secure.cpp, rai::account_info::serialize()
 
+        head_block = value[:32]
+        representative = value[32:64]
+        open_block = value[64:96]
+        balance = value[96:112]
+        modified = unpack('<Q', value[112:120])[0]
+        block_count = unpack('<Q', value[120:128])[0]
+        assert len(value[128:]) == 0
+        
+        print('Account %s (%s)' % (bin2hex(key), encode_account(key)))
+        print('... head block %s' % bin2hex(head_block))
+        print('... representative %s (%s)' % (bin2hex(representative), encode_account(representative)))
+        print('... open block %s' % bin2hex(open_block))
+        print('... balance %s (%.6f Mxrb)' % (bin2hex(balance), bin2balance_mxrb(balance)))
+        print('... modified %d (%s LOCAL)' % (modified, time.asctime(time.localtime(modified))))
+        print('... block_count %d' % block_count)
+        
+    elif subdbname == 'blocks_info':                      
+        # secure.hpp, class rai::block_info
+        # XXX unclear what is stored exactly
 
+        account = value[:32]
+        balance = value[32:48]
+        assert len(value[48:]) == 0
+        
+        print('Block info %s' % bin2hex(key))
+        print('... account %s (%s)' % (bin2hex(account), encode_account(account)))
+        print('... balance %s (%.6f Mxrb)' % (bin2hex(balance), bin2balance_mxrb(balance)))
+        
+    elif subdbname == 'frontiers':       
+        # Key is last block in the account chain
+
+        account = value[:32]
+        assert len(value[32:]) == 0
+        
+        print('Frontier %s' % bin2hex(key))
+        print('... account %s (%s)' % (bin2hex(account), encode_account(account)))
+        
+    elif subdbname == 'change':
+        # blocks.cpp, deserialize_block(stream, type), rai::change_block members
+        
+        previous_block = value[:32]
+        representative = value[32:64]
+        signature = value[64:128]
+        work = unpack('<Q', value[128:136])[0]
+        successor = value[136:168]
+        assert len(value[168:]) == 0
+        
+        print('Change block %s' % bin2hex(key))
+        print('... previous block %s' % bin2hex(previous_block))
+        print('... representative %s (%s)' % (bin2hex(representative), encode_account(representative)))
+        print('... signature %s' % bin2hex(signature))
+        print('... work %08x' % work)
+        print('... successor %s' % bin2hex(successor))
+    
+    elif subdbname == 'open':
+        # blocks.cpp, deserialize_block(stream, type), rai::open_block members
+        
+        source_block = value[:32]
+        representative = value[32:64]
+        account = value[64:96]
+        signature = value[96:160]
+        work = unpack('<Q', value[160:168])[0]
+        successor = value[168:200]
+        assert len(value[200:]) == 0
+        
+        print('Open block %s' % bin2hex(key))
+        print('... source block %s' % bin2hex(source_block))
+        print('... representative %s (%s)' % (bin2hex(representative), encode_account(representative)))
+        print('... account %s (%s)' % (bin2hex(account), encode_account(account)))
+        print('... signature %s' % bin2hex(signature))
+        print('... work %08x' % work)
+        print('... successor %s' % bin2hex(successor))
+    
+    elif subdbname == 'pending':       
+        # secure.hpp, class pending_info
 
+        assert len(key) == 64
+        destination = key[:32]
+        block = key[32:]
 
+        sender = value[:32]
+        amount = value[32:48]
+        assert len(value[48:]) == 0
+        
+        print('pending %s' % bin2hex(key))
+        print('.k. destination %s (%s)' % (bin2hex(destination), encode_account(destination)))
+        print('.k. block %s' % bin2hex(block))
+        print('... sender %s (%s)' % (bin2hex(sender), encode_account(sender)))
+        print('... amount %s (%.6f Mxrb)' % (bin2hex(amount), bin2balance_mxrb(amount)))
+        #print('... destination %s (%s)' % (bin2hex(destination), encode_account(destination)))
+        
+    elif subdbname == 'receive':
+        # blocks.cpp, deserialize_block(stream, type), rai::receive_block members
+        
+        previous_block = value[:32]
+        source_block = value[32:64]
+        signature = value[64:128]
+        work = unpack('<Q', value[128:136])[0]
+        successor = value[136:168]
+        assert len(value[168:]) == 0
+        
+        print('Receive block %s' % bin2hex(key))
+        print('... previous block %s' % bin2hex(previous_block))
+        print('... source block %s' % bin2hex(source_block))
+        print('... signature %s' % bin2hex(signature))
+        print('... work %08x' % work)
+        print('... successor %s' % bin2hex(successor))
+        
+    elif subdbname == 'representation':
+        
+        weight = value[:16]
+        assert len(value[16:]) == 0
+        
+        print('Representation %s (%s)' % (bin2hex(key), encode_account(key)))
+        print('... weight %.6f' % bin2balance_mxrb(weight))
+        
+    elif subdbname == 'send':
+        # blocks.cpp, deserialize_block(stream, type), rai::send_block members
+        
+        previous_block = value[:32]
+        destination = value[32:64]
+        balance = value[64:80]
+        signature = value[80:144]
+        work = unpack('<Q', value[144:152])[0]
+        successor = value[152:184]
+        assert len(value[184:]) == 0
+        
+        print('Send block %s' % bin2hex(key))
+        print('... previous block %s' % bin2hex(previous_block))
+        print('... destination %s (%s)' % (destination, encode_account(destination)))
+        print('... balance %s (%.6f Mxrb)' % (bin2hex(balance), bin2balance_mxrb(balance)))
+        print('... signature %s' % bin2hex(signature))
+        print('... work %08x' % work)
+        print('... successor %s' % bin2hex(successor))
+        
+    elif subdbname == 'unchecked':
+        
+        block = value
+        
+        print('Unchecked block %s' % bin2hex(key))
+        print('... %s' % bin2hex(block))
 
+    elif subdbname == 'unsynced':
+        
+        block = value
         
-for subdbname in SUBDBS:
+        print('Unsynced block %s' % bin2hex(key))
+        print('... %s' % bin2hex(block))
+        
+    elif subdbname == 'vote':
+        # secure.cpp, vote::serialize()
+        
+        account = value[:32]
+        signature = value[32:96]
+        sequence_number = unpack('<Q', value[96:104])[0]
+        successor = value[152:184]
+        #assert len(value[184:]) == 0
+        
+        print('Vote block %s' % bin2hex(key))
+        print('... voting account %s (%s)' % (bin2hex(account), encode_account(account)))
+        print('... signature %s' % bin2hex(signature))
+        print('... sequence_number %08x' % sequence_number)
+        print('... block %s' % bin2hex(value[104:]))
+            
+def print_stats(subdbname, num_records, key_stats, value_stats, stat=None, histograms=False):
     
+    print('*** %s ***' % subdbname)
+    if stat is not None:
+        print('%d records (%d pages: %d branch, %d leaf, %d overflow; depth %d)' % (num_records, 
+            stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'], 
+            stat['branch_pages'], stat['leaf_pages'], stat['overflow_pages'], stat['depth']))
+    else:
+        print('%d records' % num_records)
+    if key_stats is not None and key_stats.count > 0:
+        print('key (min, max, median)  : %s' % key_stats.summary())
+        print('value (min, max, median): %s' % value_stats.summary())
+        if histograms:
+            print('key lengths:')
+            print('\n'.join(key_stats.histogram_lines()))
+            print('value lengths:')
+            print('\n'.join(value_stats.histogram_lines()))
+            
+def has_subdb(env, subdbname):
+    """
+    Sub-database names are keys in the main database; older node versions
+    lack some of them
+    """
+    with env.begin(write=False) as tx:
+        return tx.get(subdbname.encode()) is not None
+        
+def dump_subdb(env, subdbname):
+    """Print all records of a sub-database, followed by statistics"""
+    
+    if not has_subdb(env, subdbname):
+        print('*** %s ***' % subdbname)
+        print('Not present')
+        return
+        
     subdb = env.open_db(subdbname.encode())
+    
+    key_stats = LengthStats()
+    value_stats = LengthStats()
+    num_records = 0
 
     with env.begin(write=False) as tx:
         cur = tx.cursor(subdb)
         cur.first()
         
-        key_len = []
-        value_len = []
-        num_records = 0
-        
         for key, value in cur:
             
             klen = len(key)
             vlen = len(value)
-            key_len.append(klen)
-            value_len.append(vlen)
+            key_stats.add(klen)
+            value_stats.add(vlen)
               
             print('%s [%d bytes] -> %s [%d bytes]' % \
                 (bin2hex(key), klen, bin2hex(value), vlen))
                 
-            if subdbname == 'accounts':                      
-                # secure.cpp, rai::account_info::serialize()
+            print_record(subdbname, key, value)
+            
+            num_records += 1
+            
+    print_stats(subdbname, num_records, key_stats, value_stats)
     
-                head_block = value[:32]
-                representative = value[32:64]
-                open_block = value[64:96]
-                balance = value[96:112]
-                modified = unpack('<Q', value[112:120])[0]
-                block_count = unpack('<Q', value[120:128])[0]
-                assert len(value[128:]) == 0
-                
-                print('Account %s (%s)' % (bin2hex(key), encode_account(key)))
-                print('... head block %s' % bin2hex(head_block))
-                print('... representative %s (%s)' % (bin2hex(representative), encode_account(representative)))
-                print('... open block %s' % bin2hex(open_block))
-                print('... balance %s (%.6f Mxrb)' % (bin2hex(balance), bin2balance_mxrb(balance)))
-                print('... modified %d (%s LOCAL)' % (modified, time.asctime(time.localtime(modified))))
-                print('... block_count %d' % block_count)
-                
-            elif subdbname == 'blocks_info':                      
-                # secure.hpp, class rai::block_info
-                # XXX unclear what is stored exactly
+def subdb_stats(args):
+    """
+    Statistics of a sub-database, without printing records (run in a 
+    worker process, with its own environment and read transaction). 
+    The number of records comes from stat(); the lengths are only 
+    gathered when scan is True.
+    Returns (<sub-db name>, <stat() result>, <key LengthStats>, <value LengthStats>)
+    """
     
-                account = value[:32]
-                balance = value[32:48]
-                assert len(value[48:]) == 0
-                
-                print('Block info %s' % bin2hex(key))
-                print('... account %s (%s)' % (bin2hex(account), encode_account(account)))
-                print('... balance %s (%.6f Mxrb)' % (bin2hex(balance), bin2balance_mxrb(balance)))
-                
-            elif subdbname == 'frontiers':       
-                # Key is last block in the account chain
+    lmdbfile, subdbname, scan = args
     
-                account = value[:32]
-                assert len(value[32:]) == 0
-                
-                print('Frontier %s' % bin2hex(key))
-                print('... account %s (%s)' % (bin2hex(account), encode_account(account)))
-                
-            elif subdbname == 'change':
-                # blocks.cpp, deserialize_block(stream, type), rai::change_block members
-                
-                previous_block = value[:32]
-                representative = value[32:64]
-                signature = value[64:128]
-                work = unpack('<Q', value[128:136])[0]
-                successor = value[136:168]
-                assert len(value[168:]) == 0
-                
-                print('Change block %s' % bin2hex(key))
-                print('... previous block %s' % bin2hex(previous_block))
-                print('... representative %s (%s)' % (bin2hex(representative), encode_account(representative)))
-                print('... signature %s' % bin2hex(signature))
-                print('... work %08x' % work)
-                print('... successor %s' % bin2hex(successor))
-            
-            elif subdbname == 'open':
-                # blocks.cpp, deserialize_block(stream, type), rai::open_block members
-                
-                source_block = value[:32]
-                representative = value[32:64]
-                account = value[64:96]
-                signature = value[96:160]
-                work = unpack('<Q', value[160:168])[0]
-                successor = value[168:200]
-                assert len(value[200:]) == 0
+    env = open_env(lmdbfile)
+    subdb = env.open_db(subdbname.encode())
+    
+    key_stats = value_stats = None
+    
+    with env.begin(write=False, buffers=True) as tx:
+        stat = tx.stat(subdb)
+        if scan:
+            key_stats = LengthStats()
+            value_stats = LengthStats()
+            # Only the lengths are used, so no need to copy the data
+            for key, value in tx.cursor(subdb):
+                key_stats.add(len(key))
+                value_stats.add(len(value))
                 
-                print('Open block %s' % bin2hex(key))
-                print('... source block %s' % bin2hex(source_block))
-                print('... representative %s (%s)' % (bin2hex(representative), encode_account(representative)))
-                print('... account %s (%s)' % (bin2hex(account), encode_account(account)))
-                print('... signature %s' % bin2hex(signature))
-                print('... work %08x' % work)
-                print('... successor %s' % bin2hex(successor))
-            
-            elif subdbname == 'pending':       
-                # secure.hpp, class pending_info
+    env.close()
+    
+    return subdbname, stat, key_stats, value_stats
+    
+def print_all_stats(lmdbfile, subdbnames, processes, scan, histograms):
+    """Statistics of all sub-databases, gathered in parallel"""
+    
+    # Largest sub-databases first, for a better balance over the processes
+    env = open_env(lmdbfile)
+    entries = {}
+    for name in subdbnames:
+        if has_subdb(env, name):
+            with env.begin(write=False) as tx:
+                entries[name] = tx.stat(env.open_db(name.encode(), txn=tx))['entries']
+    env.close()
+    order = sorted(entries, key=lambda name: -entries[name])
+    
+    results = {}
+    if len(order) > 0:
+        with multiprocessing.Pool(min(processes, len(order))) as pool:
+            results = dict((res[0], res) for res in pool.imap_unordered(subdb_stats, [(lmdbfile, name, scan) for name in order]))
+        
+    for name in subdbnames:
+        if name not in results:
+            print('*** %s ***' % name)
+            print('Not present')
+            continue
+        subdbname, stat, key_stats, value_stats = results[name]
+        print_stats(subdbname, stat['entries'], key_stats, value_stats, stat, histograms)
+        
 
-                assert len(key) == 64
-                destination = key[:32]
-                block = key[32:]
+@click.command()
+@click.option('-l', '--lmdb', 'lmdbfile', default=RAIBLOCKS_LMDB_DB, help='RaiBlocks LMDB database file', show_default=True)
+@click.option('-s', '--stats', is_flag=True, help='Only print statistics per sub-database, not the records')
+@click.option('--no-scan', is_flag=True, help='With --stats: only the LMDB statistics (no key/value lengths), without reading the records')
+@click.option('--histograms', is_flag=True, help='With --stats: also print the most common key/value lengths')
+@click.option('-p', '--processes', default=multiprocessing.cpu_count(), help='Number of worker processes for --stats', show_default=True)
+@click.argument('subdbs', nargs=-1)
+def main(lmdbfile, stats, no_scan, histograms, processes, subdbs):
+    """
+    Print the records of the LMDB database of the Nano node, for all
+    sub-databases or the ones given (one or more of: accounts, blocks_info,
+    change, checksum, frontiers, meta, open, pending, receive,
+    representation, send, unchecked, unsynced, vote)
+    """
     
-                sender = value[:32]
-                amount = value[32:48]
-                assert len(value[48:]) == 0
-                
-                print('pending %s' % bin2hex(key))
-                print('.k. destination %s (%s)' % (bin2hex(destination), encode_account(destination)))
-                print('.k. block %s' % bin2hex(block))
-                print('... sender %s (%s)' % (bin2hex(sender), encode_account(sender)))
-                print('... amount %s (%.6f Mxrb)' % (bin2hex(amount), bin2balance_mxrb(amount)))
-                #print('... destination %s (%s)' % (bin2hex(destination), encode_account(destination)))
-                
-            elif subdbname == 'receive':
-                # blocks.cpp, deserialize_block(stream, type), rai::receive_block members
-                
-                previous_block = value[:32]
-                source_block = value[32:64]
-                signature = value[64:128]
-                work = unpack('<Q', value[128:136])[0]
-                successor = value[136:168]
-                assert len(value[168:]) == 0
-                
-                print('Receive block %s' % bin2hex(key))
-                print('... previous block %s' % bin2hex(previous_block))
-                print('... source block %s' % bin2hex(source_block))
-                print('... signature %s' % bin2hex(signature))
-                print('... work %08x' % work)
-                print('... successor %s' % bin2hex(successor))
-                
-            elif subdbname == 'representation':
-                
-                weight = value[:16]
-                assert len(value[16:]) == 0
-                
-                print('Representation %s (%s)' % (bin2hex(key), encode_account(key)))
-                print('... weight %.6f' % bin2balance_mxrb(weight))
-                
-            elif subdbname == 'send':
-                # blocks.cpp, deserialize_block(stream, type), rai::send_block members
-                
-                previous_block = value[:32]
-                destination = value[32:64]
-                balance = value[64:80]
-                signature = value[80:144]
-                work = unpack('<Q', value[144:152])[0]
-                successor = value[152:184]
-                assert len(value[184:]) == 0
-                
-                print('Send block %s' % bin2hex(key))
-                print('... previous block %s' % bin2hex(previous_block))
-                print('... destination %s (%s)' % (destination, encode_account(destination)))
-                print('... balance %s (%.6f Mxrb)' % (bin2hex(balance), bin2balance_mxrb(balance)))
-                print('... signature %s' % bin2hex(signature))
-                print('... work %08x' % work)
-                print('... successor %s' % bin2hex(successor))
-                
-            elif subdbname == 'unchecked':
-                
-                block = value
-                
-                print('Unchecked block %s' % bin2hex(key))
-                print('... %s' % bin2hex(block))
-     
-            elif subdbname == 'unsynced':
-                
-                block = value
-                
-                print('Unsynced block %s' % bin2hex(key))
-                print('... %s' % bin2hex(block))
-                
-            elif subdbname == 'vote':
-                # secure.cpp, vote::serialize()
-                
-                account = value[:32]
-                signature = value[32:96]
-                sequence_number = unpack('<Q', value[96:104])[0]
-                successor = value[152:184]
-                #assert len(value[184:]) == 0
-                
-                print('Vote block %s' % bin2hex(key))
-                print('... voting account %s (%s)' % (bin2hex(account), encode_account(account)))
-                print('... signature %s' % bin2hex(signature))
-                print('... sequence_number %08x' % sequence_number)
-                print('... block %s' % bin2hex(value[104:]))
-                
-            num_records += 1
-                
-    key_len = numpy.array(key_len, dtype=numpy.uint32)
-    value_len = numpy.array(value_len, dtype=numpy.uint32)
+    for subdb in subdbs:
+        if subdb not in SUBDBS:
+            raise click.BadParameter('Invalid sub-db "%s", must be one or more of %s' % (subdb, SUBDBS))
+            
+    subdbnames = list(subdbs) if len(subdbs) > 0 else SUBDBS
+    
+    if stats:
+        print_all_stats(lmdbfile, subdbnames, processes, not no_scan, histograms)
+    else:
+        env = open_env(lmdbfile)
+        for subdbname in subdbnames:
+            dump_subdb(env, subdbname)
 
-    print('*** %s ***' % subdbname)
-    print('%d records' % num_records)
-    if num_records > 0:
-        print('key (min, max, median)  : [%d, %d]; median = %.1f' % (numpy.min(key_len), numpy.max(key_len), numpy.median(key_len)))
-        print('value (min, max, median): [%d, %d]; median = %.1f' % (numpy.min(value_len), numpy.max(value_len), numpy.median(value_len)))
+
+if __name__ == '__main__':
+    main()
@@ -24,36 +24,70 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import sys
-from flask import Flask, abort, flash, g, jsonify, redirect, render_template, request, url_for
-from jinja2 import evalcontextfilter, Markup
+import os, sys, time, functools, hashlib, multiprocessing
+import click
+from flask import Blueprint, Flask, abort, current_app, flash, g, jsonify, make_response, redirect, render_template, request, session, url_for
+try:
+    from jinja2 import evalcontextfilter, Markup
+except ImportError:
+    # Jinja2 >= 3.1
+    from jinja2 import pass_eval_context as evalcontextfilter
+    from markupsafe import Markup
 
-from nanodb import NanoDatabase, KNOWN_ACCOUNTS, BlockNotFound, AccountNotFound
-from rainumbers import format_amount
+from nanodb import NanoDatabasePool, StatementCounter, KNOWN_ACCOUNTS, MIN_SEARCH_PREFIX, BlockNotFound, AccountNotFound
+from rainumbers import AmountFormatter, decode_account, decode_accounts, validate_account
+from pagecache import PageCache, StaticPages
+from metrics import RequestMetrics
 
 HOST = '127.0.0.1'
 PORT = 7777
+# Start with SQL profiling enabled (can also be toggled at /profiler)
 TRACEDB = False
+# Maximum number of database connections kept open (and shared by all
+# request handling threads). When serving this is set to the number of
+# threads per worker process.
+POOL_SIZE = 8
+# Default number of request handling threads (per process) for "serve"
+THREADS = 8
+
+RICH_LIST_PAGE_SIZE = 100
+
+# Rendered pages only depend on the database contents, so they are cached
+# (per database generation) and clients may cache them as well
+PAGE_CACHE_ENTRIES = 2000
+PAGE_CACHE_BYTES = 128*1024*1024
+CACHE_MAX_AGE = 300
+
+# Maximum number of matches shown when searching on a partial hash or address
+SEARCH_LIMIT = 25
+
+# Maximum number of blocks/accounts requested in one API call
+API_MAX_BATCH = 1000
+API_DEFAULT_PAGE_SIZE = 100
+
+# Pre-rendered pages (render-static): number of top accounts and of block 
+# list pages per account
+STATIC_TOP_ACCOUNTS = 100
+STATIC_BLOCK_PAGES = 4
+STATIC_BLOCKS_PER_PAGE = 50
 
 THOUSAND_SEPARATOR = ','
 #THOUSAND_SEPARATOR = '.'
 #THOUSAND_SEPARATOR = ' '
 
-DBFILE = sys.argv[1]    
-
-app = Flask(__name__)
-app.secret_key = 'doh!'     # XXX should generate this to a separate file
+# All pages and filters are registered on this blueprint, see create_app()
+bp = Blueprint('explorer', __name__)
 
 # Custom filters
 
-@app.template_filter('account_name')
+@bp.app_template_filter('account_name')
 def account_name(address):
     if address in KNOWN_ACCOUNTS:
         return KNOWN_ACCOUNTS[address]
     else:
         return ''
         
-@app.template_filter('account_link')     
+@bp.app_template_filter('account_link')     
 @evalcontextfilter
 def account_link(eval_ctx, account, show_address=True):
     name = account.name()
@@ -70,98 +104,310 @@ def account_link(eval_ctx, account, show_address=True):
         s = Markup(s)
     return s
     
-def adjust_thousand_separator(s):
-    # Assumes s has format 1,000,000.00
-    if THOUSAND_SEPARATOR == ',':
-        return s
-    elif THOUSAND_SEPARATOR == '.':
-        s = s.replace('.', '#')
-        s = s.replace(',', '.')
-        s = s.replace('#', ',')
-    else:
-        s = s.replace(',', ' ')
-    return s
+def format_amounts(formatter, amounts):
+    """Format a list of amounts at once, leaving None values as they are"""
+    amounts = list(amounts)
+    formatted = iter(formatter.many([amount for amount in amounts if amount is not None]))
+    return [None if amount is None else Markup(next(formatted)) for amount in amounts]
+    
+def amount_filters(thousand_separator=THOUSAND_SEPARATOR):
+    """
+    The format_amount2/3/6 filters, with the separators fixed when the 
+    application is set up (a '.' thousand separator implies ',' as decimal
+    separator), plus format_amounts2/3/6 for formatting whole lists of 
+    amounts (e.g. a column of a table) at once
+    """
+    decimal_separator = ',' if thousand_separator == '.' else '.'
+    filters = {}
+    for precision in (2, 3, 6):
+        formatter = AmountFormatter(precision, thousand_separator, decimal_separator)
+        filters['format_amount%d' % precision] = lambda amount, formatter=formatter: Markup(formatter(amount))
+        filters['format_amounts%d' % precision] = functools.partial(format_amounts, formatter)
+    return filters
 
-@app.template_filter('format_amount2')            
-def format_amount_3(amount):
-    s = format_amount(amount, 2)
-    s = adjust_thousand_separator(s)
-    return Markup(s)
-    
-@app.template_filter('format_amount3')            
-def format_amount_3(amount):
-    s = format_amount(amount, 3)
-    s = adjust_thousand_separator(s)
-    return Markup(s)
-    
-@app.template_filter('format_amount6')            
-def format_amount_6(amount):
-    s = format_amount(amount, 6)
-    s = adjust_thousand_separator(s)
-    return Markup(s)
-
-@app.template_filter('format_hash')            
+@bp.app_template_filter('format_hash')            
 def format_hash(value):
     return value[:8] + '...' + value[-8:]
+    
+@bp.app_template_filter('call_method')
+def call_method(obj, name):
+    """For collecting values with map(), e.g. blocks | map('call_method', 'balance')"""
+    return getattr(obj, name)()
+    
+@bp.app_template_filter('rich_list_cursor')
+def rich_list_cursor(entry):
+    """Cursor (for the rich list URLs) of a top_accounts() entry"""
+    rank, account, balance = entry
+    return '%x-%d' % (balance, account.id)
+    
+def parse_rich_list_cursor(cursor):
+    """(balance, account ID) of a rich list cursor, raises ValueError"""
+    balance, id = cursor.split('-')
+    balance, id = int(balance, 16), int(id)
+    if not 0 <= balance < 2**128 or id < 0:
+        raise ValueError('Invalid rich list cursor %s' % cursor)
+    return balance, id
+    
+# The same filters by name, for use by other front-ends (explorer_async.py),
+# together with amount_filters()
+TEMPLATE_FILTERS = {
+    'account_name': account_name,
+    'account_link': account_link,
+    'format_hash': format_hash,
+    'call_method': call_method,
+    'rich_list_cursor': rich_list_cursor,
+}
 
 # Database stuff    
+
+class ExplorerState:
+    
+    """
+    Per-application (i.e. per worker process) state: the database 
+    connection pool, the page caches and request metrics
+    """
+    
+    def __init__(self, dbfile, pool_size, trace, static_dir=None, page_cache=True):
+        # Connections are reused across requests, instead of opening and 
+        # closing one per request
+        self.pool = NanoDatabasePool(dbfile, max_connections=pool_size, trace=trace)
+        with self.pool.connection() as db:
+            self.generation = db.generation()
+        if page_cache:
+            self.page_cache = PageCache(PAGE_CACHE_ENTRIES, PAGE_CACHE_BYTES)
+        else:
+            self.page_cache = PageCache(0, 0)
+        self.static_pages = None
+        if static_dir is not None:
+            self.static_pages = StaticPages(static_dir, self.generation)
+            if self.static_pages.stale:
+                print('Ignoring pre-rendered pages in %s, rendered from another database' % static_dir)
+        self.metrics = RequestMetrics('nanoexplorer')
+        
+def get_state():
+    return current_app.extensions['explorer']
     
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = NanoDatabase(DBFILE, trace=TRACEDB)
+        db = g._database = get_state().pool.acquire()
+        counter = g.get('statement_counter')
+        if counter is not None:
+            db.set_statement_counter(counter)
     return db
     
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
+@bp.teardown_app_request
+def release_connection(exception):
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        db.set_statement_counter(None)
+        get_state().pool.release(db)
+        
+# Metrics (only collected once /metrics has been requested)
+
+@bp.before_app_request
+def start_request_metrics():
+    if get_state().metrics.active:
+        g.request_start = time.perf_counter()
+        g.statement_counter = StatementCounter()
+        
+@bp.after_app_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        counter = g.statement_counter
+        get_state().metrics.observe(request.endpoint or 'unknown', response.status_code, 
+            time.perf_counter() - start, counter.count, counter.time)
+    return response
+        
+# Page cache
+
+def cached_page(view):
+    """
+    Serve the page from the pre-rendered pages or the page cache when 
+    possible, otherwise render it and cache it. Also handles conditional 
+    requests (If-None-Match), based on a strong ETag derived from the 
+    database generation and page path.
+    """
+    
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        
+        # A page showing flashed messages is specific to this client
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+            
+        state = get_state()
+        key = (state.generation, request.path)
+        etag = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        elif state.static_pages is not None and request.path in state.static_pages:
+            if 'gzip' in request.accept_encodings:
+                response = current_app.response_class(state.static_pages.get(request.path), mimetype='text/html')
+                response.content_encoding = 'gzip'
+            else:
+                response = current_app.response_class(state.static_pages.get(request.path, compressed=False), mimetype='text/html')
+            response.vary.add('Accept-Encoding')
+        else:
+            cached = state.page_cache.get(key)
+            if cached is not None:
+                data, mimetype = cached
+                response = current_app.response_class(data, mimetype=mimetype)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    # E.g. redirect after flash()
+                    return response
+                data = response.get_data()
+                state.page_cache.put(key, (data, response.mimetype), len(data))
+                
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        return response
+        
+    return wrapper
         
 # Pages
 
-@app.route("/")
-@app.route("/known_accounts")
+def find_account(db, id_or_address):
+    """
+    Look up an account by ID or address. Raises AccountNotFound, or 
+    ValueError for an invalid ID or address (checked without querying)
+    """
+    if id_or_address.startswith('xrb_'):
+        decode_account(id_or_address)
+        return db.account_from_address(id_or_address)
+    else:
+        return db.account_from_id(int(id_or_address))
+        
+def find_block(db, id_or_hash):
+    """
+    Look up a block by hash or ID, together with the blocks shown on its 
+    page. Returns (block, previous, next, first_block, last_block), the 
+    last two being the first and last block of the block's account (or 
+    None). All blocks have their values already retrieved, see 
+    NanoDatabase.blocks_from_ids(). Raises BlockNotFound, or ValueError 
+    for an invalid ID.
+    """
+    if len(id_or_hash) == 64:
+        id = db.block_from_hash(id_or_hash).id
+    else:
+        id = int(id_or_hash)
+        
+    cur = db.cursor()
+    cur.execute("""
+        select b.previous, b.next, 
+            (select o.id from blocks o where o.account = i.account and o.type = 'open'),
+            (select l.block from block_info l where l.account = i.account order by l.chain_index desc limit 1)
+        from blocks b
+        left join block_info i on i.block = b.id
+        where b.id = ?
+        """, (id,))
+    try:
+        ids = next(cur)
+    except StopIteration:
+        raise BlockNotFound('Unknown block %d' % id)
+        
+    blocks = dict((b.id, b) for b in db.blocks_from_ids([id] + [i for i in ids if i is not None]))
+    return tuple([blocks[id]] + [blocks.get(i) for i in ids])
+        
+def invalid_account_message(id_or_address, e):
+    if id_or_address.startswith('xrb_'):
+        return str(e)
+    else:
+        return 'Invalid account ID "%s", must be integer >= 0' % id_or_address
+        
+@bp.route("/")
+@bp.route("/known_accounts")
+@cached_page
 def known_accounts():
     
     db = get_db()
-    cur = db.cursor()
     
-    res = []
+    # The known accounts are the ones having a name in the database
+    res = [(id, address, name) for id, (address, name) in db.named_accounts().items()]
+    res.sort(key=lambda v: v[2])
+        
+    return render_template('known_accounts.html', accounts=res)
+
+def rich_list_page(db, page, after=None, before=None):
+    """
+    Returns (accounts, num_pages) for a rich list page, with accounts None 
+    for an invalid page. Pages are looked up from the cursor of the 
+    adjacent page (after/before, see NanoDatabase.top_accounts()) when 
+    given, otherwise by offset. Raises ValueError for an invalid cursor.
+    """
+    num_accounts = db.stats()['opened_accounts']
+    num_pages = max(1, (num_accounts + RICH_LIST_PAGE_SIZE - 1) // RICH_LIST_PAGE_SIZE)
     
-    for address, name in KNOWN_ACCOUNTS.items():
+    if page >= num_pages:
+        return None, num_pages
         
-        cur.execute('select id from accounts where address=?', (address,))
-        account = next(cur)[0]
+    if after is not None:
+        after = parse_rich_list_cursor(after)
+    if before is not None:
+        before = parse_rich_list_cursor(before)
         
-        res.append((account, address, name))
+    accounts = db.top_accounts(RICH_LIST_PAGE_SIZE, page*RICH_LIST_PAGE_SIZE, after, before)
+    if len(accounts) == 0:
+        # Cursor beyond the end (or start) of the list
+        raise ValueError('No rich list accounts after/before the cursor')
         
-    res.sort(key=lambda v: v[2])
+    return accounts, num_pages
+    
+RICH_LIST_RECONVERT_MESSAGE = 'The rich list needs a database converted with a newer version of conv2sqlite.py, please reconvert it'
+    
+@bp.route('/rich_list')
+@bp.route('/rich_list/<int:page>')
+@bp.route('/rich_list/<int:page>/after/<after>')
+@bp.route('/rich_list/<int:page>/before/<before>')
+@cached_page
+def rich_list(page=0, after=None, before=None):
+    
+    db = get_db()
+    
+    if not db.has_table('account_info'):
+        flash(RICH_LIST_RECONVERT_MESSAGE)
+        return redirect(url_for('.known_accounts'))
         
-    return render_template('known_accounts.html', accounts=res)
+    try:
+        accounts, num_pages = rich_list_page(db, page, after, before)
+    except ValueError:
+        flash('Invalid rich list page cursor')
+        return redirect(url_for('.rich_list'))
+    
+    if accounts is None:
+        flash('Invalid rich list page %d, there are %d pages' % (page, num_pages))
+        return redirect(url_for('.rich_list'))
+    
+    return render_template('rich_list.html',
+            accounts=accounts,
+            page=page,
+            num_pages=num_pages)
 
-@app.route('/account/<id_or_address>')
-@app.route('/account/<id_or_address>/<int:block_limit>')
+@bp.route('/account/<id_or_address>')
+@bp.route('/account/<id_or_address>/<int:block_limit>')
+@cached_page
 def account(id_or_address, block_limit=100):
     
     db = get_db()
     
     try:
-        if id_or_address.startswith('xrb_'):
-            account = db.account_from_address(id_or_address)
-        else:
-            id = int(id_or_address)
-            account = db.account_from_id(id)
+        account = find_account(db, id_or_address)
     except AccountNotFound:
         flash('Account %s not found' % id_or_address)
-        return redirect(url_for('known_accounts'))
-    except ValueError:
-        flash('Invalid account ID "%s", must be integer >= 0' % id_or_address)
-        return redirect(url_for('known_accounts'))        
+        return redirect(url_for('.known_accounts'))
+    except ValueError as e:
+        flash(invalid_account_message(id_or_address, e))
+        return redirect(url_for('.known_accounts'))        
             
     # XXX handle case where there's more blocks than the limit
     #last_blocks = account.chain(limit=block_limit, reverse=True)
-    unpocketed_blocks = account.unpocketed(limit=block_limit, reverse=True)
+    unpocketed_blocks = account.unpocketed(limit=block_limit, reverse=True, hydrate=True)
+    pending_total = account.pending_total()
     have_transactions = True #(len(last_blocks) + len(unpocketed_blocks)) > 0
     chain_length = account.chain_length()
     
@@ -170,12 +416,14 @@ def account(id_or_address, block_limit=100):
             chain_length=chain_length,
             #last_blocks=last_blocks,
             unpocketed_blocks=unpocketed_blocks,
+            pending_total=pending_total,
             have_transactions=have_transactions,
             num_blocks=account.chain_length())
             
-@app.route('/account_blocks/<id_or_address>')
-@app.route('/account_blocks/<id_or_address>/<int:start>')
-@app.route('/account_blocks/<id_or_address>/<int:start>/<int:num_blocks>')
+@bp.route('/account_blocks/<id_or_address>')
+@bp.route('/account_blocks/<id_or_address>/<int:start>')
+@bp.route('/account_blocks/<id_or_address>/<int:start>/<int:num_blocks>')
+@cached_page
 def account_blocks(id_or_address, start=-1, num_blocks=50):
     """
     start: chain index or first block
@@ -184,22 +432,18 @@ def account_blocks(id_or_address, start=-1, num_blocks=50):
     db = get_db()
     
     try:
-        if id_or_address.startswith('xrb_'):
-            account = db.account_from_address(id_or_address)
-        else:
-            id = int(id_or_address)
-            account = db.account_from_id(id)
+        account = find_account(db, id_or_address)
     except AccountNotFound:
         flash('Account %s not found' % id_or_address)
-        return redirect(url_for('known_accounts'))
-    except ValueError:
-        flash('Invalid account ID "%s", must be integer >= 0' % id_or_address)
-        return redirect(url_for('known_accounts'))
+        return redirect(url_for('.known_accounts'))
+    except ValueError as e:
+        flash(invalid_account_message(id_or_address, e))
+        return redirect(url_for('.known_accounts'))
         
     chain_length = account.chain_length()
     if start < 0:
         start = chain_length + start
-    blocks = account.chain2(start=start, limit=num_blocks, reverse=True)
+    blocks = account.chain2(start=start, limit=num_blocks, reverse=True, hydrate=True)
     
     return render_template('account_blocks.html',
             account=account,
@@ -211,62 +455,452 @@ def account_blocks(id_or_address, start=-1, num_blocks=50):
             )
 
 
-@app.route('/block/<id_or_hash>')
+@bp.route('/block/<id_or_hash>')
+@cached_page
 def block(id_or_hash):
     
     db = get_db()
     
     try:
-        if len(id_or_hash) == 64:
-            block = db.block_from_hash(id_or_hash)
-        else:
-            id = int(id_or_hash)
-            block = db.block_from_id(id)
+        block, previous, next, first_block, last_block = find_block(db, id_or_hash)
     except BlockNotFound:
         flash('Block %s not found' % id_or_hash)
-        return redirect(url_for('known_accounts'))
+        return redirect(url_for('.known_accounts'))
     except ValueError:
         flash('Invalid block ID "%s", must be integer >= 0' % id_or_hash)
-        return redirect(url_for('known_accounts'))
+        return redirect(url_for('.known_accounts'))
         
-    account = block.account()
-    global_index = block.global_index()
-    chain_index = block.chain_index()
-    previous = block.previous()
-    next = block.next()
-    
     return render_template('block.html', 
             block=block,
-            account=account,
-            global_index=global_index,
-            chain_index=chain_index,
+            account=block.account(),
+            global_index=block.global_index(),
+            chain_index=block.chain_index(),
             previous=previous,
             next=next,
+            first_block=first_block,
+            last_block=last_block,
             id=block.id)
         
         
-@app.route('/account_or_block', methods=['POST'])
+# JSON API
+#
+# Blocks are referenced by hash and accounts by address, amounts are in raw
+# and represented as strings. Paginated results contain a "cursor" value to 
+# pass for the next page (null on the last page).
+
+class APIError(Exception):
+    status_code = 400
+    
+class APINotFound(APIError):
+    status_code = 404
+    
+@bp.app_errorhandler(APIError)
+def api_error(e):
+    response = jsonify(error=str(e))
+    response.status_code = e.status_code
+    return response
+    
+def api_list_arg(name, convert=str):
+    """Comma-separated list of values from a query argument, or None"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        values = [convert(v.strip()) for v in value.split(',')]
+    except ValueError:
+        raise APIError('Invalid value in "%s"' % name)
+    if len(values) > API_MAX_BATCH:
+        raise APIError('At most %d values allowed in "%s"' % (API_MAX_BATCH, name))
+    return values
+    
+def api_int_arg(name, default=None, minimum=None, maximum=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIError('Invalid value for "%s", must be integer' % name)
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise APIError('Value for "%s" out of range' % name)
+    return value
+    
+def api_account(id_or_address):
+    try:
+        return find_account(get_db(), id_or_address)
+    except AccountNotFound:
+        raise APINotFound('Account %s not found' % id_or_address)
+    except ValueError as e:
+        raise APIError(invalid_account_message(id_or_address, e))
+
+@bp.route('/api/blocks')
+def api_blocks():
+    """/api/blocks?ids=1,2,3 or /api/blocks?hashes=<hash>,<hash>"""
+    db = get_db()
+    ids = api_list_arg('ids', int)
+    hashes = api_list_arg('hashes', lambda h: h.upper())
+    if hashes is not None:
+        blocks = db.block_records(hashes=hashes)
+    elif ids is not None:
+        blocks = db.block_records(ids=ids)
+    else:
+        raise APIError('Pass either "ids" or "hashes"')
+    return jsonify(blocks=blocks)
+    
+@bp.route('/api/accounts')
+def api_accounts():
+    """/api/accounts?ids=1,2,3 or /api/accounts?addresses=xrb_...,xrb_..."""
+    db = get_db()
+    ids = api_list_arg('ids', int)
+    addresses = api_list_arg('addresses')
+    if addresses is not None:
+        keys, invalid = decode_accounts(addresses)
+        if len(invalid) > 0:
+            raise APIError('Invalid addresses: %s' % ', '.join('%s (%s)' % (address, reason) 
+                for index, address, reason in invalid[:10]))
+        accounts = db.account_records(addresses=addresses)
+    elif ids is not None:
+        accounts = db.account_records(ids=ids)
+    else:
+        raise APIError('Pass either "ids" or "addresses"')
+    return jsonify(accounts=accounts)
+    
+@bp.route('/api/account/<id_or_address>/chain')
+def api_account_chain(id_or_address):
+    """?cursor=<chain index>&limit=<n>&reverse=1"""
+    account = api_account(id_or_address)
+    cursor = api_int_arg('cursor')
+    limit = api_int_arg('limit', API_DEFAULT_PAGE_SIZE, 1, API_MAX_BATCH)
+    reverse = api_int_arg('reverse', 0) != 0
+    blocks, next_cursor = account.chain_records(cursor, limit, reverse)
+    return jsonify(blocks=blocks, cursor=next_cursor)
+    
+@bp.route('/api/account/<id_or_address>/pending')
+def api_account_pending(id_or_address):
+    """?cursor=<global index>&limit=<n>"""
+    account = api_account(id_or_address)
+    cursor = api_int_arg('cursor')
+    limit = api_int_arg('limit', API_DEFAULT_PAGE_SIZE, 1, API_MAX_BATCH)
+    blocks, next_cursor = account.pending_records(cursor, limit)
+    return jsonify(blocks=blocks, cursor=next_cursor)
+
+@bp.route('/api/complete')
+def api_complete():
+    """?q=<partial hash or address>&limit=<n>"""
+    db = get_db()
+    limit = api_int_arg('limit', SEARCH_LIMIT, 1, API_MAX_BATCH)
+    res = db.search_prefix(request.args.get('q', ''), limit)
+    return jsonify(
+        blocks=[dict(id=id, hash=hash) for id, hash in res['blocks']],
+        accounts=[dict(id=id, address=address, name=name) for id, address, name in res['accounts']])
+
+@bp.route('/metrics')
+def metrics():
+    """Request, page cache and connection pool metrics, in Prometheus text format"""
+    
+    state = get_state()
+    state.metrics.activate()
+    
+    cache = state.page_cache.stats()
+    pool = state.pool.stats()
+    
+    gauges = [
+        ('page_cache_entries', 'Number of cached pages', cache['entries']),
+        ('page_cache_bytes', 'Size of cached pages', cache['bytes']),
+        ('page_cache_hit_ratio', 'Fraction of page cache lookups that were hits', cache['hit_rate']),
+        ('db_pool_max_connections', 'Maximum number of database connections', pool['max_connections']),
+        ('db_pool_connections', 'Open database connections', pool['connections']),
+        ('db_pool_in_use', 'Database connections in use', pool['in_use']),
+        ('db_pool_idle', 'Idle database connections', pool['idle']),
+        ('db_pool_peak_in_use', 'Maximum number of database connections in use at the same time', pool['peak_in_use']),
+    ]
+    counters = [
+        ('page_cache_hits_total', 'Page cache hits', cache['hits']),
+        ('page_cache_misses_total', 'Page cache misses', cache['misses']),
+        ('page_cache_evictions_total', 'Pages evicted from the page cache', cache['evictions']),
+        ('db_pool_acquisitions_total', 'Database connections handed out', pool['acquisitions']),
+        ('db_pool_affinity_hits_total', 'Connections handed out to the thread that used them last', pool['affinity_hits']),
+        ('db_pool_waits_total', 'Times a request had to wait for a database connection', pool['waits']),
+        ('db_pool_wait_seconds_total', 'Time spent waiting for a database connection', pool['wait_time']),
+    ]
+    
+    return current_app.response_class(state.metrics.exposition(gauges, counters), 
+        mimetype='text/plain; version=0.0.4')
+
+@bp.route('/profiler')
+def profiler():
+    profiler = get_state().pool.profiler
+    return render_template('profiler.html', 
+            profiler=profiler, 
+            statements=profiler.results(),
+            profiler_control=current_app.config['PROFILER_CONTROL'])
+            
+@bp.route('/profiler.json')
+def profiler_json():
+    return current_app.response_class(get_state().pool.profiler.as_json(), mimetype='application/json')
+    
+@bp.route('/profiler', methods=['POST'])
+def profiler_action():
+    # Profiling slows down all requests, so it can't be turned on by 
+    # just anyone visiting a public explorer
+    if not current_app.config['PROFILER_CONTROL']:
+        abort(403)
+    pool = get_state().pool
+    action = request.form['action']
+    if action == 'enable':
+        pool.profiler.enabled = True
+    elif action == 'disable':
+        pool.profiler.enabled = False
+    elif action == 'reset':
+        pool.profiler.reset()
+    else:
+        abort(400)
+    return redirect(url_for('.profiler'))
+        
+@bp.route('/account_or_block', methods=['POST'])
 def account_or_block():
     
     if request.method == 'POST':
         value = request.form['value']
         value = value.strip()
         
-        if value.startswith('xrb_'):
-            return redirect(url_for('account', id_or_address=value))
+        if value.startswith('xrb_') and len(value) == 64:
+            if not validate_account(value):
+                flash('Invalid account address %s (wrong checksum or characters)' % value)
+                return redirect(url_for('.known_accounts'))
+            return redirect(url_for('.account', id_or_address=value))
         elif len(value) == 64:
-            return redirect(url_for('block', id_or_hash=value))
-        else:
-            flash("Value provided ('%s') doesn't look like account nor block hash" % value)
-            return redirect(url_for('known_accounts'))
+            return redirect(url_for('.block', id_or_hash=value))
+            
+        # Partial hash or address
+        db = get_db()
+        res = db.search_prefix(value, SEARCH_LIMIT)
+        blocks, accounts = res['blocks'], res['accounts']
+        
+        if len(blocks) + len(accounts) == 0:
+            flash("Value provided ('%s') doesn't match any account nor block hash "
+                "(at least %d characters are needed)" % (value, MIN_SEARCH_PREFIX))
+            return redirect(url_for('.known_accounts'))
+        elif len(blocks) == 1 and len(accounts) == 0:
+            return redirect(url_for('.block', id_or_hash=blocks[0][0]))
+        elif len(accounts) == 1 and len(blocks) == 0:
+            return redirect(url_for('.account', id_or_address=accounts[0][0]))
+            
+        return render_template('search.html', 
+                value=value, 
+                blocks=blocks, 
+                accounts=accounts,
+                limit=SEARCH_LIMIT)
             
     else:
         abort(405)
             
         
     
-if __name__ == '__main__':    
-    app.jinja_env.auto_reload = True
-    app.config['TEMPLATES_AUTO_RELOAD'] = True
+# Application setup
+
+def create_app(dbfile, pool_size=POOL_SIZE, trace=TRACEDB, debug=False, static_dir=None, thousand_separator=THOUSAND_SEPARATOR, profiler_control=None, page_cache=True):
+    """
+    Create the explorer application for the given database. This opens 
+    (and warms up) pool_size database connections, so call this in each 
+    worker process, after forking.
+    
+    static_dir: directory of pages pre-rendered with render-static, served
+    instead of rendering these pages
+    
+    thousand_separator: used when formatting amounts (',', '.' or ' ')
+    
+    profiler_control: allow enabling, disabling and resetting the SQL 
+    profiler at /profiler (by default only in debug mode)
+    
+    page_cache: cache rendered pages in memory (disable for benchmarking 
+    the page rendering)
+    """
+    
+    app = Flask(__name__)
+    app.secret_key = 'doh!'     # XXX should generate this to a separate file
+    # Keep the field order of the API responses
+    if hasattr(app, 'json'):
+        # Flask >= 2.2, where the config keys below are deprecated (and 
+        # ignored from 2.3)
+        app.json.sort_keys = False
+        app.json.compact = True
+    else:
+        app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+        app.config['JSON_SORT_KEYS'] = False
+    
+    if debug:
+        app.jinja_env.auto_reload = True
+        app.config['TEMPLATES_AUTO_RELOAD'] = True
+        
+    app.config['PROFILER_CONTROL'] = debug if profiler_control is None else profiler_control
+        
+    app.register_blueprint(bp)
+    app.jinja_env.filters.update(amount_filters(thousand_separator))
+    
+    state = ExplorerState(dbfile, pool_size, trace, static_dir, page_cache)
+    state.pool.warm()
+    app.extensions['explorer'] = state
+    
+    return app
+    
+def run_gunicorn(dbfile, host, port, workers, threads, trace, static_dir, profiler_control, page_cache):
+    from gunicorn.app.base import BaseApplication
+    
+    class Application(BaseApplication):
+        
+        def load_config(self):
+            self.cfg.set('bind', '%s:%d' % (host, port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread' if threads > 1 else 'sync')
+            
+        def load(self):
+            # Called in each worker process
+            return create_app(dbfile, pool_size=threads, trace=trace, static_dir=static_dir, 
+                profiler_control=profiler_control, page_cache=page_cache)
+            
+    Application().run()
+
+SERVERS = ['waitress', 'gunicorn', 'werkzeug']
+
+@click.command()
+@click.option('--host', default=HOST, show_default=True)
+@click.option('--port', default=PORT, show_default=True)
+@click.option('--server', type=click.Choice(SERVERS), default='waitress', help='WSGI server to use', show_default=True)
+@click.option('-w', '--workers', default=1, help='Number of worker processes (gunicorn only)', show_default=True)
+@click.option('-t', '--threads', default=THREADS, help='Number of request handling threads per worker process', show_default=True)
+@click.option('--trace', is_flag=True, help='Start with SQL profiling enabled')
+@click.option('--static-pages', type=click.Path(file_okay=False), help='Directory of pages pre-rendered with render-static')
+@click.option('--profiler-control', is_flag=True, help='Allow enabling the SQL profiler at /profiler (slows down all requests while enabled)')
+@click.option('--no-page-cache', is_flag=True, help='Render every page, instead of caching them (for benchmarks)')
+@click.argument('dbfile')
+def serve(host, port, server, workers, threads, trace, static_pages, profiler_control, no_page_cache, dbfile):
+    """Serve the explorer for DBFILE with a production WSGI server"""
+    
+    if workers > 1 and server != 'gunicorn':
+        raise click.UsageError('Multiple worker processes are only supported with gunicorn')
+        
+    print('Serving %s on http://%s:%d/ (%s, %d worker(s) x %d thread(s))' % 
+        (dbfile, host, port, server, workers, threads))
+        
+    if server == 'gunicorn':
+        run_gunicorn(dbfile, host, port, workers, threads, trace, static_pages, profiler_control, not no_page_cache)
+    elif server == 'waitress':
+        import waitress
+        app = create_app(dbfile, pool_size=threads, trace=trace, static_dir=static_pages, 
+            profiler_control=profiler_control, page_cache=not no_page_cache)
+        waitress.serve(app, host=host, port=port, threads=threads)
+    else:
+        app = create_app(dbfile, pool_size=threads, trace=trace, static_dir=static_pages, 
+            profiler_control=profiler_control, page_cache=not no_page_cache)
+        app.run(host=host, port=port, threaded=threads > 1)
+        
+@click.command()
+@click.option('--host', default=HOST, show_default=True)
+@click.option('--port', default=PORT, show_default=True)
+@click.option('--trace', is_flag=True, help='Start with SQL profiling enabled')
+@click.option('--no-page-cache', is_flag=True, help='Render every page, instead of caching them (for benchmarks)')
+@click.argument('dbfile')
+def debug(host, port, trace, no_page_cache, dbfile):
+    """Run the explorer for DBFILE with Flask's debug server (auto-reloading)"""
+    app = create_app(dbfile, trace=trace, debug=True, page_cache=not no_page_cache)
+    app.run(host=host, port=port, debug=True)
+    
+# Pre-rendering
+
+def static_page_paths(db, top_accounts, block_pages):
+    """
+    Paths of the pages to pre-render: the known accounts and rich list 
+    pages, plus for the named accounts and top_accounts richest accounts
+    their account page and first block_pages block lists (as requested 
+    by the account page).
+    """
+    
+    paths = ['/', '/known_accounts']
+    
+    account_ids = list(db.named_accounts().keys())
+    if db.has_table('account_info'):
+        paths.append('/rich_list')
+        for rank, account, balance in db.top_accounts(top_accounts):
+            if account.id not in account_ids:
+                account_ids.append(account.id)
+            
+    for account in [db.account_from_id(id) for id in account_ids]:
+        paths.append('/account/%d' % account.id)
+        start = account.chain_length() - 1
+        for i in range(block_pages):
+            if start < 0:
+                break
+            paths.append('/account_blocks/%d/%d/%d' % (account.id, start, STATIC_BLOCKS_PER_PAGE))
+            start -= STATIC_BLOCKS_PER_PAGE
+            
+    return paths
+    
+render_client = None
+    
+def init_render_worker(dbfile):
+    global render_client
+    render_client = create_app(dbfile, pool_size=1).test_client()
+    
+def render_pages(args):
+    """Render the pages for a list of paths (in a worker process)"""
+    outdir, paths = args
+    pages = {}
+    for path in paths:
+        response = render_client.get(path)
+        if response.status_code == 200:
+            pages[path] = StaticPages.write_page(outdir, path, response.get_data())
+    return pages
+    
+@click.command('render-static')
+@click.option('-o', '--outdir', default='static_pages', type=click.Path(file_okay=False), help='Output directory', show_default=True)
+@click.option('-a', '--top-accounts', default=STATIC_TOP_ACCOUNTS, help='Number of richest accounts to render, besides the named accounts', show_default=True)
+@click.option('-b', '--block-pages', default=STATIC_BLOCK_PAGES, help='Number of block list pages per account', show_default=True)
+@click.option('-p', '--processes', default=multiprocessing.cpu_count(), help='Number of worker processes', show_default=True)
+@click.argument('dbfile')
+def render_static(outdir, top_accounts, block_pages, processes, dbfile):
+    """
+    Pre-render the most requested pages of DBFILE to a directory of gzip 
+    compressed HTML, to be served with "serve --static-pages" or directly 
+    by a front proxy
+    """
+    
+    t0 = time.time()
+    
+    app = create_app(dbfile, pool_size=1)
+    state = app.extensions['explorer']
+    with state.pool.connection() as db:
+        paths = static_page_paths(db, top_accounts, block_pages)
+        
+    os.makedirs(outdir, exist_ok=True)
+    
+    chunk_size = max(1, min(50, len(paths) // (4*processes)))
+    chunks = [(outdir, paths[i:i+chunk_size]) for i in range(0, len(paths), chunk_size)]
+    
+    pages = {}
+    with multiprocessing.Pool(processes, init_render_worker, (dbfile,)) as pool:
+        for res in pool.imap_unordered(render_pages, chunks):
+            pages.update(res)
+            
+    # Written last, so the pages are only used once complete
+    StaticPages.write_manifest(outdir, state.generation, pages)
+    
+    size = sum(page['size'] for page in pages.values())
+    compressed = sum(page['compressed'] for page in pages.values())
+    print('Rendered %d pages (%.1f MB, %.1f MB compressed) to %s in %.1fs' % 
+        (len(pages), size/1e6, compressed/1e6, outdir, time.time() - t0))
+
+@click.group()
+def cli():
+    pass
+    
+cli.add_command(serve)
+cli.add_command(debug)
+cli.add_command(render_static)
     
-    app.run(host=HOST, port=PORT, debug=True)
+if __name__ == '__main__':
+    # Backwards compatibility: "explorer.py nano.db" runs the debug server
+    if len(sys.argv) > 1 and sys.argv[1] not in cli.commands and not sys.argv[1].startswith('-'):
+        sys.argv.insert(1, 'debug')
+    cli()
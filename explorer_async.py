@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import click
+from quart import Blueprint, Quart, current_app, flash, redirect, render_template, request, url_for
+
+from explorer import TEMPLATE_FILTERS, amount_filters, HOST, PORT, THREADS, RICH_LIST_RECONVERT_MESSAGE, SEARCH_LIMIT, find_account, find_block, invalid_account_message, rich_list_page
+from nanodb import Account, BlockNotFound, AccountNotFound, MIN_SEARCH_PREFIX
+from nanodb_async import AsyncNanoDatabase
+from rainumbers import validate_account
+
+"""
+Asynchronous (ASGI) version of explorer.py, using Quart and the same 
+templates and filters. 
+
+All database work runs on the bounded pool of worker threads of an 
+AsyncNanoDatabase, while the event loop only handles connections and 
+renders templates. The independent lookups for a page are performed 
+concurrently, and the account page includes its first list of blocks 
+directly, instead of fetching it with a second request.
+
+The worker functions below return blocks and accounts with all values 
+used by the templates already retrieved (see NanoDatabase.blocks_from_ids()), 
+as the templates are rendered on the event loop, where no queries may 
+be performed.
+"""
+
+# Number of blocks shown initially on the account page
+ACCOUNT_BLOCKS = 50
+
+bp = Blueprint('explorer', __name__)
+
+def get_db():
+    return current_app.extensions['explorer']
+
+# Functions run on the worker threads
+
+def _named_accounts(db):
+    return db.named_accounts()
+    
+def _rich_list(db, page, after, before):
+    """Returns (None, None) for a database without account_info table"""
+    if not db.has_table('account_info'):
+        return None, None
+    return rich_list_page(db, page, after, before)
+
+def _account(db, id_or_address):
+    account = find_account(db, id_or_address)
+    account.name()
+    return account
+    
+def _account_ends(db, account_id):
+    """First and last block of an account"""
+    account = Account(db, account_id)
+    ids = [b.id for b in (account.first_block(), account.last_block()) if b is not None]
+    blocks = dict((b.id, b) for b in db.blocks_from_ids(ids))
+    first, last = account.first_block(), account.last_block()
+    return (blocks[first.id] if first is not None else None, 
+        blocks[last.id] if last is not None else None)
+    
+def _pending_total(db, account_id):
+    return Account(db, account_id).pending_total()
+    
+def _chain_length(db, account_id):
+    return Account(db, account_id).chain_length()
+    
+def _account_blocks(db, account_id, start, num_blocks):
+    account = Account(db, account_id)
+    if start < 0:
+        start = account.chain_length() + start
+    return start, account.chain2(start=start, limit=num_blocks, reverse=True, hydrate=True)
+    
+def _unpocketed(db, account_id, limit):
+    return Account(db, account_id).unpocketed(limit=limit, reverse=True, hydrate=True)
+    
+def _search_prefix(db, value):
+    return db.search_prefix(value, SEARCH_LIMIT)
+    
+# Pages
+
+async def lookup_account(id_or_address):
+    """Returns the account, or a redirect response when not found"""
+    try:
+        return await get_db().run(_account, id_or_address), None
+    except AccountNotFound:
+        await flash('Account %s not found' % id_or_address)
+    except ValueError as e:
+        await flash(invalid_account_message(id_or_address, e))
+    return None, redirect(url_for('.known_accounts'))
+
+@bp.route("/")
+@bp.route("/known_accounts")
+async def known_accounts():
+    named = await get_db().run(_named_accounts)
+    res = [(id, address, name) for id, (address, name) in named.items()]
+    res.sort(key=lambda v: v[2])
+    return await render_template('known_accounts.html', accounts=res)
+    
+@bp.route('/rich_list')
+@bp.route('/rich_list/<int:page>')
+@bp.route('/rich_list/<int:page>/after/<after>')
+@bp.route('/rich_list/<int:page>/before/<before>')
+async def rich_list(page=0, after=None, before=None):
+    try:
+        accounts, num_pages = await get_db().run(_rich_list, page, after, before)
+    except ValueError:
+        await flash('Invalid rich list page cursor')
+        return redirect(url_for('.rich_list'))
+    if num_pages is None:
+        await flash(RICH_LIST_RECONVERT_MESSAGE)
+        return redirect(url_for('.known_accounts'))
+    if accounts is None:
+        await flash('Invalid rich list page %d, there are %d pages' % (page, num_pages))
+        return redirect(url_for('.rich_list'))
+    return await render_template('rich_list.html',
+            accounts=accounts,
+            page=page,
+            num_pages=num_pages)
+            
+@bp.route('/account/<id_or_address>')
+@bp.route('/account/<id_or_address>/<int:block_limit>')
+async def account(id_or_address, block_limit=100):
+    
+    db = get_db()
+    
+    account, response = await lookup_account(id_or_address)
+    if account is None:
+        return response
+        
+    (unpocketed_blocks, pending_total, chain_length, 
+        (first_block, last_block), (start, blocks)) = await asyncio.gather(
+        db.run(_unpocketed, account.id, block_limit),
+        db.run(_pending_total, account.id),
+        db.run(_chain_length, account.id),
+        db.run(_account_ends, account.id),
+        db.run(_account_blocks, account.id, -1, ACCOUNT_BLOCKS))
+        
+    # Passed explicitly, as None (e.g. for an account without open block)
+    # would make the template query account.first_block() on the event loop
+    return await render_template('account.html', 
+            account=account,
+            first_block=first_block,
+            last_block=last_block,
+            chain_length=chain_length,
+            unpocketed_blocks=unpocketed_blocks,
+            pending_total=pending_total,
+            have_transactions=True,
+            num_blocks=chain_length,
+            blocks=blocks)
+            
+@bp.route('/account_blocks/<id_or_address>')
+@bp.route('/account_blocks/<id_or_address>/<int:start>')
+@bp.route('/account_blocks/<id_or_address>/<int:start>/<int:num_blocks>')
+async def account_blocks(id_or_address, start=-1, num_blocks=50):
+    
+    account, response = await lookup_account(id_or_address)
+    if account is None:
+        return response
+        
+    start, blocks = await get_db().run(_account_blocks, account.id, start, num_blocks)
+    
+    return await render_template('account_blocks.html',
+            account=account,
+            blocks=blocks,
+            next_start=start+num_blocks,
+            previous_start=start-num_blocks,
+            start=start,
+            )
+            
+@bp.route('/block/<id_or_hash>')
+async def block(id_or_hash):
+    
+    db = get_db()
+    
+    try:
+        block, previous, next, first_block, last_block = await db.run(find_block, id_or_hash)
+    except BlockNotFound:
+        await flash('Block %s not found' % id_or_hash)
+        return redirect(url_for('.known_accounts'))
+    except ValueError:
+        await flash('Invalid block ID "%s", must be integer >= 0' % id_or_hash)
+        return redirect(url_for('.known_accounts'))
+        
+    return await render_template('block.html', 
+            block=block,
+            account=block.account(),
+            global_index=block.global_index(),
+            chain_index=block.chain_index(),
+            previous=previous,
+            next=next,
+            first_block=first_block,
+            last_block=last_block,
+            id=block.id)
+            
+@bp.route('/account_or_block', methods=['POST'])
+async def account_or_block():
+    
+    form = await request.form
+    value = form['value'].strip()
+    
+    if value.startswith('xrb_') and len(value) == 64:
+        if not validate_account(value):
+            await flash('Invalid account address %s (wrong checksum or characters)' % value)
+            return redirect(url_for('.known_accounts'))
+        return redirect(url_for('.account', id_or_address=value))
+    elif len(value) == 64:
+        return redirect(url_for('.block', id_or_hash=value))
+        
+    res = await get_db().run(_search_prefix, value)
+    blocks, accounts = res['blocks'], res['accounts']
+    
+    if len(blocks) + len(accounts) == 0:
+        await flash("Value provided ('%s') doesn't match any account nor block hash "
+            "(at least %d characters are needed)" % (value, MIN_SEARCH_PREFIX))
+        return redirect(url_for('.known_accounts'))
+    elif len(blocks) == 1 and len(accounts) == 0:
+        return redirect(url_for('.block', id_or_hash=blocks[0][0]))
+    elif len(accounts) == 1 and len(blocks) == 0:
+        return redirect(url_for('.account', id_or_address=accounts[0][0]))
+        
+    return await render_template('search.html', 
+            value=value, 
+            blocks=blocks, 
+            accounts=accounts,
+            limit=SEARCH_LIMIT)
+            
+# Application setup
+
+def create_app(dbfile, max_workers=THREADS, max_concurrency=None):
+    """
+    Create the async explorer application for the given database.
+    
+    max_workers: number of database worker threads (and connections)
+    max_concurrency: see AsyncNanoDatabase
+    """
+    
+    app = Quart(__name__)
+    app.secret_key = 'doh!'     # XXX should generate this to a separate file
+    app.jinja_env.filters.update(TEMPLATE_FILTERS)
+    app.jinja_env.filters.update(amount_filters())
+    app.register_blueprint(bp)
+    
+    db = AsyncNanoDatabase(dbfile, max_workers=max_workers, max_concurrency=max_concurrency)
+    db.pool.warm()
+    app.extensions['explorer'] = db
+    
+    @app.after_serving
+    async def close_database():
+        await db.aclose()
+        
+    return app
+    
+@click.command()
+@click.option('--host', default=HOST, show_default=True)
+@click.option('--port', default=PORT, show_default=True)
+@click.option('-t', '--threads', default=THREADS, help='Number of database worker threads', show_default=True)
+@click.option('--max-concurrency', type=int, default=None, help='Maximum number of queued database calls [default: 2 x threads]')
+@click.argument('dbfile')
+def serve(host, port, threads, max_concurrency, dbfile):
+    """Serve the async explorer for DBFILE with hypercorn"""
+    import hypercorn.asyncio, hypercorn.config
+    
+    app = create_app(dbfile, threads, max_concurrency)
+    
+    config = hypercorn.config.Config()
+    config.bind = ['%s:%d' % (host, port)]
+    
+    print('Serving %s on http://%s:%d/ (%d database thread(s))' % (dbfile, host, port, threads))
+    asyncio.run(hypercorn.asyncio.serve(app, config))
+    
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import threading, bisect, collections
+
+"""
+Minimal request metrics in the Prometheus text exposition format
+(https://prometheus.io/docs/instrumenting/exposition_formats/), 
+without depending on a client library.
+"""
+
+# Upper bounds of the histogram buckets (+Inf is implicit)
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+STATEMENT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) 
+        for name, value in labels)
+
+
+class Histogram:
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        
+    def lines(self, name, labels):
+        res = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            res.append('%s_bucket%s %d' % (name, _format_labels(labels + [('le', bound)]), cumulative))
+        res.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(self.sum)))
+        res.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+        return res
+        
+
+class RequestMetrics:
+    
+    """
+    Per-route request statistics: latency histogram, number of SQL 
+    statements per request (histogram) and SQL time, plus response counts 
+    per status code.
+    
+    Collection only starts when the metrics are first requested (see 
+    activate()), so there's no overhead when nobody is scraping them.
+    """
+    
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.active = False
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = collections.defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.sql_time = collections.defaultdict(float)
+        self.responses = collections.defaultdict(int)
+        
+    def activate(self):
+        self.active = True
+        
+    def observe(self, route, status, duration, statements, sql_time):
+        with self.lock:
+            self.latency[route].observe(duration)
+            self.statements[route].observe(statements)
+            self.sql_time[route] += sql_time
+            self.responses[(route, status)] += 1
+            
+    def exposition(self, gauges=(), counters=()):
+        """
+        Return the metrics as text. Extra values can be passed as lists of
+        (name, help, value) tuples, name without prefix.
+        """
+        p = self.prefix
+        lines = []
+        
+        with self.lock:
+            
+            lines.append('# HELP %s_request_duration_seconds Request handling time' % p)
+            lines.append('# TYPE %s_request_duration_seconds histogram' % p)
+            for route, h in sorted(self.latency.items()):
+                lines += h.lines('%s_request_duration_seconds' % p, [('route', route)])
+                
+            lines.append('# HELP %s_request_sql_statements SQL statements executed per request' % p)
+            lines.append('# TYPE %s_request_sql_statements histogram' % p)
+            for route, h in sorted(self.statements.items()):
+                lines += h.lines('%s_request_sql_statements' % p, [('route', route)])
+                
+            lines.append('# HELP %s_request_sql_seconds_total Time spent in SQL statements (as measured by SQLite)' % p)
+            lines.append('# TYPE %s_request_sql_seconds_total counter' % p)
+            for route, t in sorted(self.sql_time.items()):
+                lines.append('%s_request_sql_seconds_total%s %s' % (p, _format_labels([('route', route)]), _format_value(t)))
+                
+            lines.append('# HELP %s_responses_total Responses per route and status code' % p)
+            lines.append('# TYPE %s_responses_total counter' % p)
+            for (route, status), n in sorted(self.responses.items()):
+                lines.append('%s_responses_total%s %d' % (p, _format_labels([('route', route), ('status', status)]), n))
+                
+        for kind, values in (('gauge', gauges), ('counter', counters)):
+            for name, help, value in values:
+                lines.append('# HELP %s_%s %s' % (p, name, help))
+                lines.append('# TYPE %s_%s %s' % (p, name, kind))
+                lines.append('%s_%s %s' % (p, name, _format_value(value)))
+            
+        return '\n'.join(lines) + '\n'
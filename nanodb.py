@@ -24,8 +24,9 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import sys
+import sys, os, re, json, hashlib, threading, time, contextlib, collections, itertools, weakref
 import apsw
+from rainumbers import amounts_from_bytes, amounts_from_ints, amounts_to_float
 
 KNOWN_ACCOUNTS = {
     'xrb_3t6k35gi95xu6tergt6p69ck76ogmitsa8mnijtpxm9fkcm736xtoncuohr3': 'Genesis',
@@ -65,6 +66,9 @@ GENESIS_BALANCE_RAW     = 2**128 - 1
 
 assert KNOWN_ACCOUNTS[GENESIS_ACCOUNT] == 'Genesis'
 
+# Marks a cached value as not retrieved yet, as None is a valid value
+UNSET = object()
+
 class NanoDBException(BaseException):
     pass
     
@@ -73,18 +77,524 @@ class BlockNotFound(NanoDBException):
     
 class AccountNotFound(NanoDBException):
     pass
+    
+class PoolTimeout(NanoDBException):
+    pass
 
 
-class NanoDatabase:
+# Balance after the last block of an account at or before a global index.
+# Uses the (account, global_index) index to find that block directly.
+BALANCE_AT_QUERY = """
+    select balance from block_info 
+    where account=? and global_index<=? 
+    order by global_index desc limit 1
+    """
+
+# Text columns that hold raw amounts (integers represented as strings)
+RAW_AMOUNT_COLUMNS = set(['balance_raw', 'balance', 'amount'])
+
+# Width of text columns in exported arrays (others get DEFAULT_TEXT_WIDTH)
+TEXT_COLUMN_WIDTHS = dict(hash=64, address=64, type=8, signature=128, work=16)
+DEFAULT_TEXT_WIDTH = 64
+
+# Plain column, with optional table prefix and alias ("i.balance as info_balance")
+COLUMN_RE = re.compile(r'^\s*(?:\w+\.)?(\w+)(?:\s+as\s+\w+)?\s*$', re.IGNORECASE)
+
+# Fields of block and account records (see NanoDatabase.block_records()
+# and account_records()), in the order of the query columns
+BLOCK_RECORD_FIELDS = ['id', 'hash', 'type', 'account', 'chain_index', 'global_index',
+    'balance', 'amount', 'previous', 'next', 'source', 'sister', 'destination', 'representative']
+    
+BLOCK_RECORDS_QUERY = """
+    select b.id, b.hash, b.type, a.address, i.chain_index, i.global_index, 
+        i.balance, i.amount, pb.hash, nb.hash, sb.hash, ib.hash, d.address, r.address
+    from blocks b
+    left join block_info i on i.block = b.id
+    left join accounts a on a.id = i.account
+    left join blocks pb on pb.id = b.previous
+    left join blocks nb on nb.id = b.next
+    left join blocks sb on sb.id = b.source
+    left join blocks ib on ib.id = i.sister
+    left join accounts d on d.id = b.destination
+    left join accounts r on r.id = b.representative
+    where b.%s in (%s)
+    """
+    
+ACCOUNT_RECORD_FIELDS = ['id', 'address', 'name', 'chain_length', 'balance', 'head_block']
+
+ACCOUNT_RECORDS_QUERY = """
+    select a.id, a.address, a.name, ai.chain_length, ai.balance, hb.hash
+    from accounts a
+    left join account_info ai on ai.account = a.id
+    left join blocks hb on hb.id = ai.head_block
+    where a.%s in (%s)
+    """
+
+# For databases converted before account_info was added, which lack the
+# chain length, balance and head block
+ACCOUNT_RECORDS_QUERY_NO_INFO = """
+    select a.id, a.address, a.name, null, null, null
+    from accounts a
+    where a.%s in (%s)
+    """
+
+# Minimum number of characters of a partial hash or address (not counting 
+# the "xrb_") accepted by NanoDatabase.search_prefix()
+MIN_SEARCH_PREFIX = 8
+
+HEX_DIGITS = set('0123456789ABCDEF')
+
+# Maximum number of values bound in a single "in (...)" query
+BATCH_SIZE = 500
+
+# Statements executed on a new connection to have SQLite parse the schema 
+# and to fill APSW's statement cache with the most common lookups
+WARMUP_STATEMENTS = [
+    ('select count(*) from sqlite_master', ()),
+    ('select id from accounts where address=?', ('',)),
+    ('select address from accounts where id=?', (-1,)),
+    ('select name from accounts where id=?', (-1,)),
+    ('select id from blocks where hash=?', ('',)),
+    ('select type from blocks where id=?', (-1,)),
+    ('select hash from blocks where id=?', (-1,)),
+    ('select account from block_info where block=?', (-1,)),
+    ('select balance from block_info where block=?', (-1,)),
+    ('select amount from block_info where block=?', (-1,)),
+    ('select sister from block_info where block=?', (-1,)),
+]
+
+
+def hash_prefix(hash):
+    """
+    Value of blocks.hash_prefix for the given (hex) block hash: its first 
+    8 bytes as a signed 64-bit integer. These are offset by -2^63, so they
+    sort in the same order as the hashes.
+    """
+    return int(hash[:16], 16) - 2**63
+    
+def hash_prefix_range(prefix):
+    """Range (inclusive) of hash_prefix values of hashes starting with the given hex prefix"""
+    prefix = prefix[:16]
+    return hash_prefix(prefix.ljust(16, '0')), hash_prefix(prefix.ljust(16, 'F'))
+
+def _percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if len(sorted_values) == 0:
+        return 0
+    idx = max(0, (p * len(sorted_values) + 99) // 100 - 1)
+    return sorted_values[idx]
+
+def lttb_indices(x, y, n):
+    """
+    Largest-Triangle-Three-Buckets downsampling (Steinarsson, 2013) of 
+    the series (x, y) to n points. The first and last points are always 
+    kept, for the others the points are split into n-2 buckets and from 
+    each the point is picked that forms the largest triangle with the 
+    point picked in the previous bucket and the average of the next bucket.
+    This preserves peaks and dips much better than taking every k-th point.
+    
+    Returns the (sorted) indices of the selected points.
+    """
+    import numpy
+    
+    num = len(x)
+    if n >= num or n < 3:
+        return numpy.arange(num)
+        
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    
+    # Bucket boundaries, for the points excluding the first and last
+    edges = numpy.linspace(1, num-1, n-1).astype(numpy.int64)
+    
+    res = numpy.empty(n, dtype=numpy.int64)
+    res[0] = 0
+    res[-1] = num - 1
+    
+    a = 0
+    for i in range(n-2):
+        start, end = edges[i], edges[i+1]
+        # Average of the next bucket (the last point for the last bucket)
+        if i < n-3:
+            nstart, nend = edges[i+1], edges[i+2]
+            cx, cy = x[nstart:nend].mean(), y[nstart:nend].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        ax, ay = x[a], y[a]
+        areas = numpy.abs((ax - cx) * (y[start:end] - ay) - (ax - x[start:end]) * (cy - ay))
+        a = start + int(numpy.argmax(areas))
+        res[i+1] = a
+        
+    return res
+
+def compute_ledger_stats(cur):
+    """
+    Compute ledger statistics from the block data. This needs a number of 
+    full table scans, hence conv2sqlite stores the result in the
+    ledger_stats table.
+    
+    Returns a dict, with all amounts in raw:
+    
+    {
+        'blocks_by_type': {<type>: <count>, ...},
+        'num_blocks': ...,
+        'num_accounts': ...,                # All accounts referenced
+        'opened_accounts': ...,             # Accounts having an open block
+        'unopened_destinations': ...,       # Accounts sent to, but not opened
+        'total_volume_sent': ...,
+        'unpocketed_blocks': ...,           # Send blocks not received yet
+        'volume_unpocketed': ...,
+        'chain_length': {'min': ..., 'p50': ..., 'p90': ..., 'p99': ..., 'max': ...}
+    }
+    """
+    
+    blocks_by_type = {}
+    cur.execute('select type, count(*) from blocks group by type')
+    for type, count in cur:
+        blocks_by_type[type] = count
+        
+    cur.execute('select count(*) from accounts')
+    num_accounts = next(cur)[0]
+    
+    cur.execute("""
+        select count(distinct destination) from blocks 
+        where type=? and destination not in (select account from blocks where type=?)
+        """,
+        ('send', 'open'))
+    unopened_destinations = next(cur)[0]
+    
+    # Amounts are stored as strings, as they need 128 bits, so sum them here
+    total_volume_sent = 0
+    volume_unpocketed = 0
+    unpocketed_blocks = 0
+    cur.execute("""
+        select i.amount, i.sister from blocks b, block_info i 
+        where b.id=i.block and b.type=?
+        """,
+        ('send',))
+    for amount, sister in cur:
+        if amount is None:
+            continue
+        amount = int(amount)
+        total_volume_sent += amount
+        if sister is None:
+            unpocketed_blocks += 1
+            volume_unpocketed += amount
+            
+    cur.execute('select count(*) from block_info group by account')
+    chain_lengths = sorted(row[0] for row in cur)
+    
+    return dict(
+        blocks_by_type=blocks_by_type,
+        num_blocks=sum(blocks_by_type.values()),
+        num_accounts=num_accounts,
+        opened_accounts=blocks_by_type.get('open', 0),
+        unopened_destinations=unopened_destinations,
+        total_volume_sent=total_volume_sent,
+        unpocketed_blocks=unpocketed_blocks,
+        volume_unpocketed=volume_unpocketed,
+        chain_length=dict(
+            min=chain_lengths[0] if len(chain_lengths) > 0 else 0,
+            p50=_percentile(chain_lengths, 50),
+            p90=_percentile(chain_lengths, 90),
+            p99=_percentile(chain_lengths, 99),
+            max=chain_lengths[-1] if len(chain_lengths) > 0 else 0,
+        )
+    )
+    
+def flatten_ledger_stats(stats):
+    """
+    Turn the dict returned by compute_ledger_stats() into a list of 
+    (name, value) pairs for storage, e.g. ('blocks_by_type.send', '123').
+    Values are stored as strings, as amounts don't fit in 64 bits.
+    """
+    res = []
+    for name, value in sorted(stats.items()):
+        if isinstance(value, dict):
+            for subname, subvalue in sorted(value.items()):
+                res.append(('%s.%s' % (name, subname), str(subvalue)))
+        else:
+            res.append((name, str(value)))
+    return res
+    
+def unflatten_ledger_stats(rows):
+    """Inverse of flatten_ledger_stats()"""
+    stats = {}
+    for name, value in rows:
+        if '.' in name:
+            name, subname = name.split('.', 1)
+            stats.setdefault(name, {})[subname] = int(value)
+        else:
+            stats[name] = int(value)
+    return stats
+
+
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SQL_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SQL_SPACE = re.compile(r'\s+')
+
+def normalize_sql(sql):
+    """
+    Reduce a SQL statement to its "shape": literals replaced by ?, 
+    "in (?, ?, ...)" lists of any length collapsed to "in (?...)" and 
+    whitespace collapsed
+    """
+    sql = _SQL_STRING.sub('?', sql)
+    sql = _SQL_NUMBER.sub('?', sql)
+    sql = _SQL_IN_LIST.sub('(?...)', sql)
+    sql = _SQL_SPACE.sub(' ', sql)
+    return sql.strip().rstrip(';').strip()
+
+
+class StatementCounter:
+    
+    """
+    Counts the SQL statements executed on a connection and their total 
+    time (as reported by SQLite, in seconds). Cheaper than a QueryProfiler,
+    e.g. for per-request accounting. See NanoDatabase.set_statement_counter().
+    """
+    
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        
+    def exectrace(self, cursor, sql, bindings):
+        self.count += 1
+        return True
+        
+    def profile(self, sql, nanoseconds):
+        self.time += nanoseconds * 1e-9
 
-    def __init__(self, dbfile, trace=False):
-        self.sqldb = apsw.Connection(dbfile, flags=apsw.SQLITE_OPEN_READONLY)
-        if trace:
-            self.sqldb.setexectrace(self._exectrace)
 
-    def _exectrace(self, cursor, sql, bindings):
-        print('%s [%s]' % (sql, repr(bindings)))
+class QueryProfiler:
+    """
+    Aggregates statistics of the SQL statements executed on one or more
+    connections, per normalized statement (see normalize_sql()). Per
+    statement shape it records:
+    
+        calls               number of executions
+        rows                number of rows returned
+        total_time          time (s) from start of execution until the 
+                            statement completed, as reported by SQLite
+                            (millisecond resolution on most platforms).
+                            Note that this includes the time the caller
+                            spends between fetching rows.
+        max_time            longest single execution
+        first_row_time      time (s) from start of execution until the
+                            first row was available (only for executions
+                            returning rows)
+        plan                output of EXPLAIN QUERY PLAN, captured on the 
+                            first execution
+        full_scan           True if the plan contains a table scan that
+                            doesn't use an index
+                            
+    Profiling can be switched on and off at runtime with the enabled 
+    attribute, the hooks then do nothing. Use NanoDatabase.set_profiler() 
+    to install the profiler on a connection, or pass trace=True to 
+    NanoDatabase/NanoDatabasePool.
+    """
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # cursor -> [shape, start time, first row seen]
+        self.executions = weakref.WeakKeyDictionary()
+        self.reset()
+        
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+            self.started = time.time()
+            
+    def _statement(self, shape):
+        try:
+            return self.statements[shape]
+        except KeyError:
+            st = self.statements[shape] = dict(calls=0, rows=0, total_time=0.0, 
+                max_time=0.0, first_row_time=0.0, plan=None, full_scan=False)
+            return st
+            
+    def _explain(self, connection, sql, bindings):
+        """Return the query plan of sql as a list of strings, or None"""
+        if not sql.lstrip()[:6].lower() in ('select', 'with', 'insert', 'update', 'delete'):
+            return None
+        self.local.busy = True
+        try:
+            return [row[-1] for row in connection.cursor().execute('explain query plan ' + sql, bindings)]
+        except apsw.Error:
+            return None
+        finally:
+            self.local.busy = False
+            
+    def exectrace(self, cursor, sql, bindings):
+        if not self.enabled or getattr(self.local, 'busy', False):
+            return True
+        shape = normalize_sql(sql)
+        with self.lock:
+            st = self._statement(shape)
+            st['calls'] += 1
+            need_plan = st['plan'] is None
+            if need_plan:
+                st['plan'] = []         # Only explain once, even with multiple threads
+        if need_plan:
+            plan = self._explain(cursor.connection, sql, bindings) or []
+            with self.lock:
+                st['plan'] = plan
+                st['full_scan'] = any(
+                    detail.startswith('SCAN ') and 'INDEX' not in detail and 'CONSTANT ROW' not in detail
+                    for detail in plan)
+        with self.lock:
+            self.executions[cursor] = [shape, time.perf_counter(), False]
         return True
+        
+    def rowtrace(self, cursor, row):
+        if not self.enabled or getattr(self.local, 'busy', False):
+            return row
+        with self.lock:
+            execution = self.executions.get(cursor)
+            if execution is not None:
+                st = self._statement(execution[0])
+                st['rows'] += 1
+                if not execution[2]:
+                    execution[2] = True
+                    st['first_row_time'] += time.perf_counter() - execution[1]
+        return row
+        
+    def profile(self, sql, nanoseconds):
+        if not self.enabled or getattr(self.local, 'busy', False):
+            return
+        t = nanoseconds * 1e-9
+        with self.lock:
+            st = self._statement(normalize_sql(sql))
+            st['total_time'] += t
+            st['max_time'] = max(st['max_time'], t)
+            
+    def install(self, connection):
+        """Install the hooks on an APSW connection"""
+        connection.setexectrace(self.exectrace)
+        connection.setrowtrace(self.rowtrace)
+        connection.setprofile(self.profile)
+        
+    @staticmethod
+    def uninstall(connection):
+        connection.setexectrace(None)
+        connection.setrowtrace(None)
+        connection.setprofile(None)
+        
+    def results(self, sort='total_time'):
+        """Return a list of dicts, one per statement shape, sorted on the given key (descending)"""
+        with self.lock:
+            res = [dict(st, sql=shape) for shape, st in self.statements.items()]
+        for st in res:
+            st['mean_time'] = st['total_time'] / st['calls'] if st['calls'] > 0 else 0.0
+        res.sort(key=lambda st: st[sort], reverse=True)
+        return res
+        
+    def as_json(self, sort='total_time'):
+        return json.dumps(dict(
+            enabled=self.enabled,
+            duration=time.time() - self.started,
+            statements=self.results(sort)), indent=1)
+            
+    def report(self, sort='total_time', limit=None):
+        """Return a human-readable report of the (limit) most expensive statements"""
+        res = self.results(sort)
+        if limit is not None:
+            res = res[:limit]
+        lines = ['%-8s %8s %10s %10s %10s %10s  %s' % 
+            ('calls', 'rows', 'total(ms)', 'mean(ms)', 'max(ms)', '1st row(ms)', 'statement')]
+        for st in res:
+            lines.append('%-8d %8d %10.3f %10.3f %10.3f %10.3f  %s%s' % (
+                st['calls'], st['rows'], st['total_time']*1000, st['mean_time']*1000,
+                st['max_time']*1000, st['first_row_time']*1000, 
+                '[FULL SCAN] ' if st['full_scan'] else '', st['sql']))
+            for detail in st['plan'] or []:
+                lines.append('%60s%s' % ('', detail))
+        return '\n'.join(lines)
+
+
+class NanoDatabase:
+
+    def __init__(self, dbfile, trace=False, mmap_size=None, cache_size=None, shared_cache=False, 
+            profiler=None):
+        """
+        trace: profile all SQL statements executed (see QueryProfiler), 
+            available through the profiler attribute
+        mmap_size: if set, maximum number of bytes of the database file to memory-map
+        cache_size: if set, SQLite page cache size (as for "PRAGMA cache_size",
+            i.e. negative values are in KiB)
+        shared_cache: open the database in SQLite's shared-cache mode
+        profiler: QueryProfiler to use, e.g. to share one between connections
+        """
+        self.dbfile = dbfile
+        self.tables_ = {}
+        self.stats_ = None
+        self.metadata_ = None
+        self.named_accounts_ = None
+        self.profiler = None
+        self.statement_counter = None
+        flags = apsw.SQLITE_OPEN_READONLY
+        if shared_cache:
+            flags |= apsw.SQLITE_OPEN_SHAREDCACHE
+        self.sqldb = apsw.Connection(dbfile, flags=flags)
+        if profiler is None and trace:
+            profiler = QueryProfiler()
+        self.set_profiler(profiler)
+            
+        cur = self.sqldb.cursor()
+        if mmap_size is not None:
+            cur.execute('pragma mmap_size=%d' % mmap_size)
+        if cache_size is not None:
+            cur.execute('pragma cache_size=%d' % cache_size)
+            
+    def warmup(self):
+        """Prepare the most commonly used statements"""
+        cur = self.sqldb.cursor()
+        for sql, bindings in WARMUP_STATEMENTS:
+            for row in cur.execute(sql, bindings):
+                pass
+
+    def set_profiler(self, profiler):
+        """Profile statements with the given QueryProfiler, or stop profiling if None"""
+        if profiler is self.profiler:
+            return
+        self.profiler = profiler
+        self._install_hooks()
+        
+    def set_statement_counter(self, counter):
+        """Count statements with the given StatementCounter, or stop counting if None"""
+        if counter is self.statement_counter:
+            return
+        self.statement_counter = counter
+        self._install_hooks()
+        
+    def _install_hooks(self):
+        # A connection has a single hook of each kind, so combine the
+        # profiler and counter hooks when both are used
+        profiler, counter = self.profiler, self.statement_counter
+        if profiler is None and counter is None:
+            QueryProfiler.uninstall(self.sqldb)
+        elif counter is None:
+            profiler.install(self.sqldb)
+        elif profiler is None:
+            self.sqldb.setexectrace(counter.exectrace)
+            self.sqldb.setrowtrace(None)
+            self.sqldb.setprofile(counter.profile)
+        else:
+            def exectrace(cursor, sql, bindings):
+                # Don't count the profiler's own EXPLAIN statements
+                if not getattr(profiler.local, 'busy', False):
+                    counter.exectrace(cursor, sql, bindings)
+                return profiler.exectrace(cursor, sql, bindings)
+            def profile(sql, nanoseconds):
+                if not getattr(profiler.local, 'busy', False):
+                    counter.profile(sql, nanoseconds)
+                profiler.profile(sql, nanoseconds)
+            self.sqldb.setexectrace(exectrace)
+            self.sqldb.setrowtrace(profiler.rowtrace)
+            self.sqldb.setprofile(profile)
 
     def close(self):
         # Mostly for use under Flask
@@ -92,6 +602,11 @@ class NanoDatabase:
 
     def account_from_id(self, id):
         assert isinstance(id, int)
+        if self.named_accounts_ is not None and id in self.named_accounts_:
+            address, name = self.named_accounts_[id]
+            account = Account(self, id, address)
+            account.name_ = name
+            return account
         cur = self.sqldb.cursor()
         try:
             cur.execute('select address from accounts where id=?', (id,))
@@ -205,6 +720,80 @@ class NanoDatabase:
         
         return res
 
+    def balances_at(self, accounts, global_index):
+        """
+        Return the balances of the given accounts (Account objects or IDs)
+        at the point in time of the given global index, as a dict
+        {<account-id>: <balance in raw>}. See Account.balance_at().
+        
+        Performs a single index lookup per account.
+        """
+        res = {}
+        cur = self.sqldb.cursor()
+        for account in accounts:
+            if isinstance(account, Account):
+                account = account.id
+            cur.execute(BALANCE_AT_QUERY, (account, global_index))
+            try:
+                res[account] = int(next(cur)[0])
+            except StopIteration:
+                res[account] = 0
+        return res
+
+    def top_accounts(self, n=100, offset=0, after=None, before=None):
+        """
+        Return the accounts with the highest current balance, as a list
+        [(<rank>, <account>, <balance in raw>), ...]. Ranks start at 1, 
+        accounts with equal balance are ordered by descending ID.
+        
+        Use offset to skip the first accounts, e.g. for pagination. This 
+        takes time proportional to offset, so for paging through the list 
+        pass after (or before): the (<balance in raw>, <account ID>) of 
+        the last account of the previous page (or the first account of 
+        the next page). These pages are read directly from the 
+        (balance, account) index, offset then only determines the ranks.
+        """
+        cur = self.sqldb.cursor()
+        
+        if after is not None:
+            cur.execute("""
+                select i.account, a.address, a.name, i.balance
+                from account_info i, accounts a
+                where (i.balance, i.account) < (?, ?) and i.account = a.id
+                order by i.balance desc, i.account desc
+                limit ?
+                """,
+                (after[0].to_bytes(16, 'big'), after[1], n))
+            rows = list(cur)
+        elif before is not None:
+            cur.execute("""
+                select i.account, a.address, a.name, i.balance
+                from account_info i, accounts a
+                where (i.balance, i.account) > (?, ?) and i.account = a.id
+                order by i.balance asc, i.account asc
+                limit ?
+                """,
+                (before[0].to_bytes(16, 'big'), before[1], n))
+            rows = list(cur)[::-1]
+        else:
+            cur.execute("""
+                select i.account, a.address, a.name, i.balance
+                from account_info i, accounts a
+                where i.account = a.id
+                order by i.balance desc, i.account desc
+                limit ? offset ?
+                """,
+                (n, offset))
+            rows = list(cur)
+            
+        res = []
+        for idx, (id, address, name, balance) in enumerate(rows):
+            account = Account(self, id, address)
+            account.name_ = name
+            res.append((offset+idx+1, account, int.from_bytes(balance, 'big')))
+            
+        return res
+
     def block_from_id(self, id, type=None):
         assert isinstance(id, int)
         return Block(self, id, type)
@@ -217,13 +806,186 @@ class NanoDatabase:
             return Block(self, int(row[0]))
         except StopIteration:
             raise BlockNotFound('No block with hash %s found' % hash)
+            
+    def blocks_from_ids(self, ids):
+        """
+        Return Block objects for the given block IDs, in the same order. 
+        
+        The returned blocks have all their per-block values (hash, account, 
+        indices, balance, amount, destination and sister block) already 
+        retrieved, using a single query per (up to) BATCH_SIZE blocks. 
+        IDs of non-existing blocks are skipped.
+        """
+        
+        ids = list(ids)
+        blocks = {}
+        accounts = {}
+        
+        def get_account(id, address, name):
+            if id is None:
+                return None
+            try:
+                return accounts[id]
+            except KeyError:
+                a = accounts[id] = Account(self, id, address)
+                a.name_ = name
+                return a
+        
+        cur = self.sqldb.cursor()
+        
+        for i in range(0, len(ids), BATCH_SIZE):
+            chunk = ids[i:i+BATCH_SIZE]
+            cur.execute("""
+                select b.id, b.type, b.hash, i.chain_index, i.global_index, i.balance, i.amount,
+                    i.account, a.address, a.name, 
+                    b.destination, d.address, d.name,
+                    i.sister, sb.type, sb.hash, si.account, sa.address, sa.name
+                from blocks b
+                left join block_info i on i.block = b.id
+                left join accounts a on a.id = i.account
+                left join accounts d on d.id = b.destination
+                left join blocks sb on sb.id = i.sister
+                left join block_info si on si.block = i.sister
+                left join accounts sa on sa.id = si.account
+                where b.id in (%s)
+                """ % ','.join('?'*len(chunk)),
+                chunk)
+                
+            for row in cur:
+                (id, type, hash, chain_index, global_index, balance, amount, 
+                    account, address, name, 
+                    destination, dest_address, dest_name,
+                    sister, sister_type, sister_hash, sister_account, sister_address, sister_name) = row
+                
+                b = Block(self, id, type)
+                b.hash_ = hash
+                b.chain_index_ = chain_index
+                b.global_index_ = global_index
+                b.balance_ = int(balance) if balance is not None else None
+                b.amount_ = int(amount) if amount is not None else None
+                b.account_ = get_account(account, address, name)
+                b.destination_ = get_account(destination, dest_address, dest_name)
+                
+                if sister is not None:
+                    s = Block(self, sister, sister_type)
+                    s.hash_ = sister_hash
+                    s.account_ = get_account(sister_account, sister_address, sister_name)
+                    s.sister_ = b
+                    b.sister_ = s
+                else:
+                    b.sister_ = None
+                    
+                blocks[id] = b
+                
+        return [blocks[id] for id in ids if id in blocks]
 
-    # XXX add blocks()?
+    def _records(self, query, column, values, fields, convert=None):
+        """Run a records query in batches, returning records keyed on column"""
+        values = list(values)
+        res = {}
+        idx = fields.index(column)
+        cur = self.sqldb.cursor()
+        for i in range(0, len(values), BATCH_SIZE):
+            chunk = values[i:i+BATCH_SIZE]
+            cur.execute(query % (column, ','.join('?'*len(chunk))), chunk)
+            for row in cur:
+                if convert is not None:
+                    row = convert(row)
+                record = collections.OrderedDict(
+                    (field, value) for field, value in zip(fields, row) if value is not None)
+                res[row[idx]] = record
+        return [res[v] for v in values if v in res]
+        
+    def block_records(self, ids=None, hashes=None):
+        """
+        Return plain records (OrderedDicts) for the given block IDs or 
+        hashes, e.g. for serializing to JSON. Uses one query per (up to) 
+        BATCH_SIZE blocks. 
+        
+        Fields are listed in BLOCK_RECORD_FIELDS. Blocks are referenced by 
+        hash, accounts by address, amounts are in raw as strings (as they
+        don't fit in 64 bits). Fields that don't apply to the block type 
+        are left out. Unknown blocks are skipped.
+        """
+        if hashes is not None:
+            return self._records(BLOCK_RECORDS_QUERY, 'hash', hashes, BLOCK_RECORD_FIELDS)
+        else:
+            return self._records(BLOCK_RECORDS_QUERY, 'id', ids, BLOCK_RECORD_FIELDS)
+            
+    def account_records(self, ids=None, addresses=None):
+        """
+        Return plain records (OrderedDicts) for the given account IDs or
+        addresses, with the fields listed in ACCOUNT_RECORD_FIELDS. The 
+        balance (in raw, as string) is the current one, head_block the 
+        hash of the last block. These three are left out for a database 
+        without account_info table (reconvert it). Unknown accounts are 
+        skipped.
+        """
+        def convert(row):
+            row = list(row)
+            if row[4] is not None:
+                row[4] = str(int.from_bytes(row[4], 'big'))
+            return row
+        query = ACCOUNT_RECORDS_QUERY if self.has_table('account_info') else ACCOUNT_RECORDS_QUERY_NO_INFO
+        if addresses is not None:
+            return self._records(query, 'address', addresses, ACCOUNT_RECORD_FIELDS, convert)
+        else:
+            return self._records(query, 'id', ids, ACCOUNT_RECORD_FIELDS, convert)
+    
+    def check_pending(self):
+        """
+        Cross-check the pending table (imported from the LMDB database)
+        against the unpocketed send blocks derived from the sister links.
+        
+        Returns a dict with lists of send block IDs per type of inconsistency:
+        
+        not_found:          pending, but no such block in the chains
+        not_unpocketed:     pending, but the derived data has a receive/open for it
+        mismatched:         pending, but destination, sender or amount differ
+        missing:            derived as unpocketed, but not pending
+        """
+        
+        res = dict(not_found=[], not_unpocketed=[], mismatched=[], missing=[])
+        
+        if not self.has_table('pending'):
+            raise NanoDBException('Database has no pending table, reconvert it')
+        
+        cur = self.sqldb.cursor()
+        
+        cur.execute("""
+            select p.block, p.destination, p.sender, p.amount, 
+                b.type, b.destination, i.account, i.amount, i.sister
+            from pending p 
+            left join blocks b on b.id = p.block
+            left join block_info i on i.block = p.block
+            """)
+            
+        for block, destination, sender, amount, type, b_destination, i_account, i_amount, i_sister in cur:
+            if type != 'send' or i_account is None:
+                res['not_found'].append(block)
+            elif i_sister is not None:
+                res['not_unpocketed'].append(block)
+            elif destination != b_destination or sender != i_account or int(amount) != int(i_amount):
+                res['mismatched'].append(block)
+                
+        cur.execute("""
+            select b.id from blocks b, block_info i
+            where b.id = i.block and b.type = ? and i.sister is null
+                and not exists (select 1 from pending p where p.block = b.id)
+            """,
+            ('send',))
+            
+        res['missing'] = [row[0] for row in cur]
+        
+        return res
 
     def check(self):
         """Perform consistency checks, mostly for debugging purposes"""
 
-        pass
+        if self.has_table('pending'):
+            for problem, blocks in self.check_pending().items():
+                if len(blocks) > 0:
+                    print('%d pending blocks %s' % (len(blocks), problem.replace('_', ' ')))
 
         # Check for missing blocks, e.g. previous id points to non-existent block. 
         # For genesis open block: source points to non-existent block        
@@ -241,39 +1003,500 @@ class NanoDatabase:
         """For when you know what you're doing..."""
         return self.sqldb.cursor()
         
+    def _column_kinds(self, columns, names, description, rows, kinds=None):
+        """
+        Determine how each selected column is exported: as given in kinds
+        ({<name>: <kind>}), from its declared type or, for expressions, from 
+        its first non-NULL value
+        """
+        kinds = kinds or {}
+        res = []
+        for i, (column, name, (_, decltype)) in enumerate(zip(columns, names, description)):
+            # Column name without table prefix and alias, for plain columns
+            m = COLUMN_RE.match(column)
+            basename = m.group(1) if m else name
+            if name in kinds:
+                res.append(kinds[name])
+                continue
+            decltype = (decltype or '').lower()
+            if decltype == '':
+                value = next((row[i] for row in rows if row[i] is not None), None)
+                decltype = {int: 'integer', float: 'float', str: 'text', bytes: 'blob'}.get(type(value), '')
+            if decltype in ('float', 'real', 'double'):
+                res.append('float')
+            elif decltype in ('text', 'blob') and basename in RAW_AMOUNT_COLUMNS:
+                res.append('amount')
+            elif decltype in ('text', 'blob'):
+                res.append('text')
+            else:
+                res.append('integer')
+        return res
+        
+    def iter_columns(self, table, columns, where=None, bindings=(), chunk_size=65536, kinds=None):
+        """
+        Generator version of export_columns(), yielding the result in chunks
+        of (at most) chunk_size rows, each as an OrderedDict of arrays.
+        """
+        import numpy
+        
+        q = 'select %s from %s' % (', '.join(columns), table)
+        if where is not None:
+            q += ' where ' + where
+            
+        cur = self.sqldb.cursor()
+        cur.execute(q, bindings)
+        
+        try:
+            description = cur.getdescription()
+        except apsw.ExecutionCompleteError:
+            # No rows
+            return
+        
+        # Output names: alias, or column name without table prefix
+        names = [name for name, decltype in description]
+        
+        column_kinds = None
+        
+        while True:
+            rows = list(itertools.islice(cur, chunk_size))
+            if len(rows) == 0:
+                break
+                
+            if column_kinds is None:
+                column_kinds = self._column_kinds(columns, names, description, rows, kinds)
+                
+            chunk = collections.OrderedDict()
+            
+            for name, kind, values in zip(names, column_kinds, zip(*rows)):
+                n = len(values)
+                if kind == 'integer':
+                    chunk[name] = numpy.fromiter((-1 if v is None else v for v in values), dtype=numpy.int64, count=n)
+                elif kind == 'float':
+                    chunk[name] = numpy.fromiter((numpy.nan if v is None else v for v in values), dtype=numpy.float64, count=n)
+                elif kind == 'amount':
+                    if any(isinstance(v, bytes) for v in values):
+                        # 16-byte big-endian (e.g. account_info.balance)
+                        chunk[name+'_hi'], chunk[name+'_lo'] = amounts_from_bytes([bytes(16) if v is None else v for v in values])
+                    else:
+                        chunk[name+'_hi'], chunk[name+'_lo'] = amounts_from_ints([0 if v is None else int(v) for v in values])
+                else:
+                    values = [b'' if v is None else (v if isinstance(v, bytes) else str(v).encode('utf8')) for v in values]
+                    # Widened when needed, never truncated
+                    width = max([TEXT_COLUMN_WIDTHS.get(name, DEFAULT_TEXT_WIDTH)] + [len(v) for v in values])
+                    chunk[name] = numpy.array(values, dtype='S%d' % width)
+                    
+            yield chunk
+            
+    def export_columns(self, table, columns, where=None, bindings=(), chunk_size=65536, kinds=None):
+        """
+        Export the result of a query as NumPy arrays, one per column. 
+        
+        table: table name, or any other FROM clause, e.g. a join
+        columns: list of column names or expressions, optionally with 
+            table prefix and/or alias ("i.balance as info_balance")
+        where: optional WHERE clause, with values in bindings
+        kinds: optional {<name>: <kind>} overriding how columns are exported
+            ('integer', 'float', 'text' or 'amount')
+        
+        Returns an OrderedDict {<name>: <array>}. The rows are fetched in 
+        chunks and copied into arrays allocated up front. Integer columns 
+        become int64 arrays (NULL = -1), float columns float64 (NULL = NaN),
+        text columns fixed-width byte strings (see TEXT_COLUMN_WIDTHS, wider 
+        when a value is longer). Raw amount columns (see RAW_AMOUNT_COLUMNS,
+        strings or 16-byte big-endian blobs) are split into two uint64 
+        arrays <name>_hi and <name>_lo (NULL = 0), holding the upper and 
+        lower 64 bits.
+        """
+        import numpy
+        
+        cur = self.sqldb.cursor()
+        q = 'select count(*) from %s' % table
+        if where is not None:
+            q += ' where ' + where
+        cur.execute(q, bindings)
+        n = next(cur)[0]
+        
+        res = None
+        pos = 0
+        
+        for chunk in self.iter_columns(table, columns, where, bindings, chunk_size, kinds):
+            if res is None:
+                res = collections.OrderedDict(
+                    (name, numpy.empty(n, dtype=a.dtype)) for name, a in chunk.items())
+            size = len(next(iter(chunk.values())))
+            for name, a in chunk.items():
+                if a.dtype.itemsize > res[name].dtype.itemsize:
+                    # Longer text values than in earlier chunks
+                    res[name] = res[name].astype(a.dtype)
+                res[name][pos:pos+size] = a
+            pos += size
+            
+        if res is None:
+            # No rows matched, take the column types from an arbitrary 
+            # (unfiltered) row instead. If the table is empty as well we
+            # can only return an empty result.
+            res = collections.OrderedDict()
+            for chunk in self.iter_columns(table + ' limit 1', columns, chunk_size=1, kinds=kinds):
+                res = collections.OrderedDict((name, a[:0]) for name, a in chunk.items())
+            
+        return res
+        
     def dot_graph(self, fname, blocks):
         """For a selection of blocks write a DOT graph to file"""
         pass
         
-    def stats(self):
-        """Return a dict with some statistics"""
+    def has_column(self, table, column):
+        """Check if the given table has the given column, which older databases might lack"""
+        key = (table, column)
+        try:
+            return self.tables_[key]
+        except KeyError:
+            cur = self.sqldb.cursor()
+            cur.execute('pragma table_info(%s)' % table)
+            self.tables_[key] = column in [row[1] for row in cur]
+            return self.tables_[key]
+            
+    def search_prefix(self, value, limit=10):
+        """
+        Find blocks and accounts from a partial hash or address, i.e. its
+        first characters (at least MIN_SEARCH_PREFIX, besides "xrb_"). The 
+        value can also be a shortened form such as "AAAAAAAA...BBBBBBBB",
+        as shown by the explorer, in which case the end has to match as well.
+        
+        Hashes are looked up on the blocks.hash_prefix index, addresses 
+        with a range query on their index, so this is fast regardless of 
+        the number of blocks/accounts.
+        
+        Returns a dict with at most limit matches of each kind:
+        
+            {
+                'blocks': [(<id>, <hash>), ...],
+                'accounts': [(<id>, <address>, <name>), ...]
+            }
+        """
+        
+        value = value.strip().replace('\u2026', '...')
+        prefix, sep, suffix = value.partition('...')
+        
+        res = dict(blocks=[], accounts=[])
         cur = self.sqldb.cursor()
         
-        blocks_by_type = {}
-        cur.execute('select type, count(*) from blocks group by type')
-        for type, count in cur:
-            blocks_by_type[type] = count
+        if prefix.startswith('xrb_'):
+            if len(prefix) - 4 < MIN_SEARCH_PREFIX:
+                return res
+            # All addresses starting with prefix sort between prefix and
+            # prefix with its last character incremented
+            end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            q = 'select id, address, name from accounts where address >= ? and address < ?'
+            v = [prefix, end]
+            if suffix != '':
+                q += ' and substr(address, ?) = ?'
+                v += [-len(suffix), suffix]
+            q += ' order by address limit ?'
+            v.append(limit)
+            res['accounts'] = cur.execute(q, v).fetchall()
+            
+        else:
+            prefix = prefix.upper()
+            suffix = suffix.upper()
+            if len(prefix) < MIN_SEARCH_PREFIX or not set(prefix+suffix).issubset(HEX_DIGITS):
+                return res
+            if self.has_column('blocks', 'hash_prefix'):
+                lo, hi = hash_prefix_range(prefix)
+                q = 'select id, hash from blocks where hash_prefix between ? and ?'
+                v = [lo, hi]
+                if len(prefix) > 16:
+                    q += ' and substr(hash, 1, ?) = ?'
+                    v += [len(prefix), prefix]
+                order = 'hash_prefix'
+            else:
+                end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                q = 'select id, hash from blocks where hash >= ? and hash < ?'
+                v = [prefix, end]
+                order = 'hash'
+            if suffix != '':
+                q += ' and substr(hash, ?) = ?'
+                v += [-len(suffix), suffix]
+            q += ' order by %s limit ?' % order
+            v.append(limit)
+            res['blocks'] = cur.execute(q, v).fetchall()
             
-        # XXX compute in raw
-        # XXX need amount, not balance
-        #cur.execute('select sum(balance) from blocks where type=?', ('send',))
-        #total_volume_sent = next(cur)[0]
+        return res
         
-        # XXX need amount, not balance
-        if False:
-            cur.execute("""
-                select sum(b.balance)
-                from blocks b, block_info i
-                where b.id=i.sister and b.type=? and i.sister is null
-                """,
-                ('send',))
-            volume_unpocketed = next(cur)[0]
+    def has_table(self, name):
+        """Check if the database contains the given table, which older databases might lack"""
+        try:
+            return self.tables_[name]
+        except KeyError:
+            cur = self.sqldb.cursor()
+            cur.execute('select count(*) from sqlite_master where type=? and name=?', ('table', name))
+            self.tables_[name] = next(cur)[0] > 0
+            return self.tables_[name]
+        
+    def stats(self, refresh=False):
+        """
+        Return a dict with ledger statistics, see compute_ledger_stats().
+        
+        These are read from the ledger_stats table computed during conversion,
+        which is cheap. With refresh=True (or for databases without that
+        table) they are recomputed from the block data, which is expensive.
+        """
+        
+        if self.stats_ is not None and not refresh:
+            return self.stats_
             
-        return dict(
-            blocks_by_type=blocks_by_type,
-            #total_volume_sent=total_volume_sent,
-            #volume_unpocketed=volume_unpocketed
-        )
+        cur = self.sqldb.cursor()
+            
+        if not refresh and self.has_table('ledger_stats'):
+            cur.execute('select name, value from ledger_stats')
+            self.stats_ = unflatten_ledger_stats(cur)
+        else:
+            self.stats_ = compute_ledger_stats(cur)
+            
+        return self.stats_
+        
+    def load_named_accounts(self, named_accounts=None):
+        """
+        Load (and from then on use) the IDs, addresses and names of all 
+        accounts that have a name, i.e. the known accounts. This makes
+        Account.name() free, and account_from_id() for named accounts.
+        
+        named_accounts: previously loaded result, to share it between 
+            connections to the same database
+        
+        Returns a dict {<id>: (<address>, <name>), ...}
+        """
+        if named_accounts is None:
+            cur = self.sqldb.cursor()
+            cur.execute('select id, address, name from accounts where name is not null')
+            named_accounts = dict((id, (address, name)) for id, address, name in cur)
+        self.named_accounts_ = named_accounts
+        return named_accounts
+        
+    def named_accounts(self):
+        """Return the named accounts, as load_named_accounts(), loading them if needed"""
+        if self.named_accounts_ is None:
+            self.load_named_accounts()
+        return self.named_accounts_
+        
+    def metadata(self):
+        """
+        Return a dict with information on the conversion that produced this 
+        database (see conv2sqlite.store_metadata()), empty for older databases
+        """
+        if self.metadata_ is None:
+            self.metadata_ = {}
+            if self.has_table('metadata'):
+                cur = self.sqldb.cursor()
+                cur.execute('select name, value from metadata')
+                self.metadata_ = dict(cur)
+        return self.metadata_
+        
+    def generation(self):
+        """
+        Return a string identifying the contents of the database: it changes 
+        when the database file is replaced, modified or regenerated. Used as 
+        (part of) a cache key for derived data.
+        """
+        st = os.stat(self.dbfile)
+        h = hashlib.sha1()
+        h.update(repr((os.path.realpath(self.dbfile), st.st_dev, st.st_ino, 
+            st.st_size, st.st_mtime_ns)).encode('utf8'))
+        h.update(repr(sorted(self.metadata().items())).encode('utf8'))
+        return h.hexdigest()[:20]
+        
+
+class NanoDatabasePool:
+    
+    """
+    Pool of read-only NanoDatabase connections that can be shared by 
+    multiple threads, e.g. under a threaded WSGI server or with 
+    concurrent.futures workers. 
+    
+    Connections are opened on demand (up to max_connections), warmed up 
+    and then reused, so SQLite's page cache and parsed schema survive 
+    between uses. A thread gets back the connection it used last when that 
+    one is available, so in practice each worker thread keeps its own 
+    connection.
+    
+    Usage:
+    
+        pool = NanoDatabasePool('nano.db')
+        with pool.connection() as db:
+            block = db.block_from_hash(...)
+            
+    Objects (blocks, accounts) obtained from a connection should not be 
+    used after the connection is returned to the pool.
+    """
+    
+    def __init__(self, dbfile, max_connections=8, timeout=None, trace=False, 
+            mmap_size=256*1024*1024, cache_size=-16*1024, shared_cache=False):
+        """
+        timeout: default maximum time (in seconds) acquire() waits for a 
+            connection to become available, None = wait indefinitely
+        
+        trace: start with profiling enabled. All connections share one 
+            QueryProfiler (the profiler attribute), that can be switched 
+            on and off at runtime through its enabled attribute.
+        
+        The remaining parameters are passed to NanoDatabase
+        """
+        assert max_connections > 0
+        self.dbfile = dbfile
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.profiler = QueryProfiler(enabled=trace)
+        self.named_accounts = None
+        self.connection_args = dict(mmap_size=mmap_size, 
+            cache_size=cache_size, shared_cache=shared_cache)
+        
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.idle = []
+        self.num_connections = 0        # Opened, or being opened
+        self.in_use = 0
+        self.closed = False
+        
+        # Statistics
+        self.peak_in_use = 0
+        self.acquisitions = 0
+        self.affinity_hits = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        
+    def __repr__(self):
+        return '<NanoDatabasePool %s %d/%d in use>' % (self.dbfile, self.in_use, self.max_connections)
+        
+    def _open(self):
+        db = NanoDatabase(self.dbfile, **self.connection_args)
+        db.warmup()
+        # Named accounts are loaded once and shared by all connections
+        self.named_accounts = db.load_named_accounts(self.named_accounts)
+        return db
+        
+    def warm(self, n=None):
+        """Open (and warm up) n connections in advance, default max_connections"""
+        if n is None:
+            n = self.max_connections
+        dbs = [self.acquire() for i in range(min(n, self.max_connections))]
+        for db in dbs:
+            self.release(db)
+        
+    def acquire(self, timeout=-1):
+        """
+        Get a connection from the pool, opening a new one if needed and 
+        allowed. Raises PoolTimeout if none became available in time.
+        
+        Every acquire() must be matched with a release(), see also connection().
+        """
+        
+        if timeout == -1:
+            timeout = self.timeout
+        
+        db = None
+        
+        with self.cond:
+            if self.closed:
+                raise NanoDBException('Pool is closed')
+                
+            # Prefer the connection this thread used last
+            preferred = getattr(self.local, 'db', None)
+            
+            if len(self.idle) == 0 and self.num_connections >= self.max_connections:
+                self.waits += 1
+                t0 = time.time()
+                # A slot can also become free without a connection being 
+                # returned, when one is discarded or fails to open
+                ok = self.cond.wait_for(lambda: len(self.idle) > 0 or 
+                    self.num_connections < self.max_connections or self.closed, timeout)
+                self.wait_time += time.time() - t0
+                if not ok:
+                    raise PoolTimeout('No database connection available after %.1fs' % timeout)
+                if self.closed:
+                    raise NanoDBException('Pool is closed')
+                    
+            if preferred is not None and preferred in self.idle:
+                self.idle.remove(preferred)
+                db = preferred
+                self.affinity_hits += 1
+            elif len(self.idle) > 0:
+                db = self.idle.pop()
+            else:
+                # Reserve a slot, but open the connection outside the lock
+                self.num_connections += 1
+                
+            self.in_use += 1
+            self.acquisitions += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            
+        if db is None:
+            try:
+                db = self._open()
+            except:
+                with self.cond:
+                    self.num_connections -= 1
+                    self.in_use -= 1
+                    self.cond.notify()
+                raise
+                
+        # Only have the profiling hooks installed when needed
+        if self.profiler.enabled:
+            db.set_profiler(self.profiler)
+        else:
+            db.set_profiler(None)
+                
+        self.local.db = db
+        return db
+        
+    def release(self, db, discard=False):
+        """
+        Return a connection obtained with acquire() to the pool.
+        
+        discard: close the connection instead of reusing it, e.g. when
+            it was interrupted
+        """
+        with self.cond:
+            self.in_use -= 1
+            if self.closed or discard:
+                db.close()
+                self.num_connections -= 1
+            else:
+                self.idle.append(db)
+            self.cond.notify()
+            
+    @contextlib.contextmanager
+    def connection(self, timeout=-1):
+        """Context manager around acquire()/release()"""
+        db = self.acquire(timeout)
+        try:
+            yield db
+        finally:
+            self.release(db)
+            
+    def close(self):
+        """Close all idle connections. Connections in use are closed when released."""
+        with self.cond:
+            self.closed = True
+            for db in self.idle:
+                db.close()
+            self.idle = []
+            self.cond.notify_all()
+            
+    def stats(self):
+        """Return a dict with pool utilization statistics"""
+        with self.cond:
+            return dict(
+                max_connections=self.max_connections,
+                connections=self.num_connections,
+                in_use=self.in_use,
+                idle=len(self.idle),
+                peak_in_use=self.peak_in_use,
+                utilization=1.0 * self.in_use / self.max_connections,
+                acquisitions=self.acquisitions,
+                affinity_hits=self.affinity_hits,
+                waits=self.waits,
+                wait_time=self.wait_time,
+            )
 
 
 class Account:
@@ -289,7 +1512,7 @@ class Account:
         self.address = address
         self.open_block_ = None
         self.last_block_ = None
-        self.name_ = None
+        self.name_ = UNSET
 
     def __repr__(self):
         # XXX include name, if set
@@ -353,8 +1576,6 @@ class Account:
         if limit is not None:
             q += ' limit ?'
             v.append(limit)
-            
-        print(q, v)
 
         res = []
         cur = self.db.cursor()
@@ -366,7 +1587,7 @@ class Account:
 
         return res
         
-    def chain2(self, type=None, start=0, limit=None, reverse=False):
+    def chain2(self, type=None, start=0, limit=None, reverse=False, hydrate=False):
         """
         Return all blocks in the chain, in sequence.
         
@@ -377,6 +1598,9 @@ class Account:
         
         If "type" is set, only blocks of the requested type will be returned.
         If "limit" is set, at most limit blocks will be returned.
+        If "hydrate" is set, the blocks are retrieved with 
+        NanoDatabase.blocks_from_ids(), i.e. with their values and related
+        accounts (including names) prefetched, for listing them.
         """
 
         q = 'select block from block_info where account=?'
@@ -400,31 +1624,43 @@ class Account:
         if limit is not None:
             q += ' limit ?'
             v.append(limit)
-            
-        print(q, v)
 
-        res = []
         cur = self.db.cursor()
         cur.execute(q, v)
+        
+        if hydrate:
+            return self.db.blocks_from_ids(row[0] for row in cur)
 
+        res = []
         for row in cur:
             b = Block(self.db, row[0])
             res.append(b)
 
         return res
         
-    def unpocketed(self, limit=None, reverse=False):
-        """Return send transactions to this account that are not pocketed yet"""
+    def unpocketed(self, limit=None, reverse=False, hydrate=False):
+        """
+        Return send transactions to this account that are not pocketed yet.
+        See chain2() for "hydrate".
+        """
         
-        # Find send blocks to this account with no sister (receive) block
         order = 'desc' if reverse else 'asc'
         
-        q = """
-            select block from blocks b, block_info i 
-            where b.id=i.block and b.type=? and b.destination=? and i.sister is null
-            order by i.global_index %s
-            """ % order
-        v = ['send', self.id]
+        if self.db.has_table('pending'):
+            q = """
+                select p.block from pending p, block_info i 
+                where p.destination=? and p.block=i.block
+                order by i.global_index %s
+                """ % order
+            v = [self.id]
+        else:
+            # Find send blocks to this account with no sister (receive) block
+            q = """
+                select block from blocks b, block_info i 
+                where b.id=i.block and b.type=? and b.destination=? and i.sister is null
+                order by i.global_index %s
+                """ % order
+            v = ['send', self.id]
         if limit is not None:
             q += ' limit ?'
             v.append(limit)   
@@ -432,6 +1668,9 @@ class Account:
         cur = self.db.cursor()
         cur.execute(q, v)
         
+        if hydrate:
+            return self.db.blocks_from_ids(row[0] for row in cur)
+        
         res = []
         for row in cur:
             b = Block(self.db, row[0])
@@ -439,8 +1678,79 @@ class Account:
             
         return res
 
+    def chain_records(self, cursor=None, limit=100, reverse=False):
+        """
+        Return a page of block records (see NanoDatabase.block_records()) 
+        of this account's chain, plus the cursor for the next page (None 
+        when there are no more blocks).
+        
+        The cursor is a chain index: the page starts after it (or before
+        it, with reverse=True). Without cursor the page starts at the open 
+        block, or at the last block when reversed.
+        """
+        q = 'select block, chain_index from block_info where account=?'
+        v = [self.id]
+        if cursor is not None:
+            q += ' and chain_index < ?' if reverse else ' and chain_index > ?'
+            v.append(cursor)
+        q += ' order by chain_index %s limit ?' % ('desc' if reverse else 'asc')
+        v.append(limit)
+        
+        cur = self.db.cursor()
+        rows = cur.execute(q, v).fetchall()
+        
+        next_cursor = rows[-1][1] if len(rows) == limit else None
+        return self.db.block_records(ids=[row[0] for row in rows]), next_cursor
+        
+    def pending_records(self, cursor=None, limit=100):
+        """
+        Return a page of block records of the send blocks to this account
+        that aren't pocketed yet, oldest first, plus the cursor for the next 
+        page (None when there are no more). The cursor is a global index.
+        """
+        if self.db.has_table('pending'):
+            q = """
+                select p.block, i.global_index from pending p, block_info i 
+                where p.destination=? and p.block=i.block
+                """
+            v = [self.id]
+        else:
+            q = """
+                select block, i.global_index from blocks b, block_info i 
+                where b.id=i.block and b.type=? and b.destination=? and i.sister is null
+                """
+            v = ['send', self.id]
+        if cursor is not None:
+            q += ' and i.global_index > ?'
+            v.append(cursor)
+        q += ' order by i.global_index limit ?'
+        v.append(limit)
+        
+        cur = self.db.cursor()
+        rows = cur.execute(q, v).fetchall()
+        
+        next_cursor = rows[-1][1] if len(rows) == limit else None
+        return self.db.block_records(ids=[row[0] for row in rows]), next_cursor
+
+    def pending_total(self):
+        """Return the total amount (in raw) sent to this account that isn't pocketed yet"""
+        cur = self.db.cursor()
+        if self.db.has_table('pending'):
+            cur.execute('select amount from pending where destination=?', (self.id,))
+        else:
+            cur.execute("""
+                select i.amount from blocks b, block_info i 
+                where b.id=i.block and b.type=? and b.destination=? and i.sister is null
+                """,
+                ('send', self.id))
+        return sum(int(row[0]) for row in cur)
+
     def name(self):
-        if self.name_ is not None:
+        if self.name_ is not UNSET:
+            return self.name_
+        if self.db.named_accounts_ is not None:
+            # All named accounts are known
+            self.name_ = self.db.named_accounts_.get(self.id, (None, None))[1]
             return self.name_
         cur = self.db.cursor()
         cur.execute('select name from accounts where id=?', (self.id,))
@@ -448,6 +1758,63 @@ class Account:
         self.name_ = name
         return name
 
+    def balance_at(self, global_index):
+        """
+        Return the balance (in raw) of this account at the point in time
+        of the given global index, i.e. the balance after its last block 
+        with a global index <= global_index. Returns 0 if the account 
+        wasn't opened yet at that point.
+        """
+        cur = self.db.cursor()
+        cur.execute(BALANCE_AT_QUERY, (self.id, global_index))
+        try:
+            return int(next(cur)[0])
+        except StopIteration:
+            return 0
+
+    def balance_series(self, downsample=None):
+        """
+        Return the balance history of this account, as a dict of NumPy 
+        arrays, one entry per block in the chain (in chain order):
+        
+            chain_index, global_index   int64
+            balance                     float64, in XRB (not fully precise)
+            balance_hi, balance_lo      uint64, upper and lower 64 bits of
+                                        the exact balance in raw
+        
+        If downsample is set to a number of points N, and the chain is 
+        longer than that, only N blocks are returned, selected with 
+        lttb_indices() (using global index and balance) so the shape of
+        the curve is preserved. Useful for plotting long chains.
+        """
+        import numpy
+        
+        cur = self.db.cursor()
+        cur.execute("""
+            select chain_index, global_index, balance from block_info 
+            where account=? order by chain_index
+            """, (self.id,))
+        rows = cur.fetchall()
+        
+        n = len(rows)
+        chain_index = numpy.fromiter((r[0] for r in rows), dtype=numpy.int64, count=n)
+        global_index = numpy.fromiter((r[1] for r in rows), dtype=numpy.int64, count=n)
+        balance_hi, balance_lo = amounts_from_ints([int(r[2]) for r in rows])
+        
+        res = dict(
+            chain_index = chain_index,
+            global_index = global_index,
+            balance = amounts_to_float(balance_hi, balance_lo),
+            balance_hi = balance_hi,
+            balance_lo = balance_lo
+        )
+        
+        if downsample is not None and n > downsample:
+            idx = lttb_indices(global_index, res['balance'], downsample)
+            res = dict((k, a[idx]) for k, a in res.items())
+            
+        return res
+
     # def balance()
     # find last send/receive block
 
@@ -470,10 +1837,10 @@ class Block:
         #self.previous_ = None
         #self.next_ = None
         
-        self.sister_ = None
+        self.sister_ = UNSET
 
         self.balance_ = None
-        self.amount_ = None     # Only for send/open/receive blocks
+        self.amount_ = UNSET    # Only for send/open/receive blocks
         
         self.account_ = None
         self.global_index_ = None
@@ -524,7 +1891,7 @@ class Block:
         return Block(self.db, nextid, nexttype)
 
     def sister(self):
-        if self.sister_ is not None:
+        if self.sister_ is not UNSET:
             return self.sister_
         
         cur = self.sqldb.cursor()
@@ -532,6 +1899,8 @@ class Block:
         sister_id = next(cur)[0]
         if sister_id is not None:
             self.sister_ = Block(self.db, sister_id)
+        else:
+            self.sister_ = None
         
         return self.sister_
 
@@ -662,8 +2031,7 @@ class Block:
         For other block types return None.
         """
         
-        # XXX if we retrieve none below we will still perform the query multiple times
-        if self.amount_ is not None:      
+        if self.amount_ is not UNSET:      
             return self.amount_
         
         cur = self.sqldb.cursor()
@@ -671,6 +2039,8 @@ class Block:
         amount = next(cur)[0]
         if amount is not None:
             self.amount_ = int(amount)
+        else:
+            self.amount_ = None
         
         return self.amount_
             
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys, asyncio, threading
+import concurrent.futures
+
+from nanodb import NanoDatabasePool, Account
+
+"""
+asyncio interface to a nanodb SQLite database. 
+
+SQLite (and APSW) calls are blocking, so all queries are run on a bounded 
+pool of worker threads, each of which uses its own (pooled) connection. 
+The coroutines below can therefore be run concurrently, e.g. with
+asyncio.gather(), up to max_concurrency in flight at the same time.
+
+Cancelling a coroutine (e.g. on timeout) removes the query from the 
+queue if it hasn't started yet, or interrupts it if it is running.
+
+Blocks and accounts are returned with their values already retrieved
+on the worker thread (see NanoDatabase.blocks_from_ids()). Any further 
+lookups on them, for example Block.previous() or Account.chain_length(), 
+must be performed through run(), as the connection they refer to belongs 
+to a worker thread.
+"""
+
+class _Job:
+    
+    """Callable run on a worker thread, that can be interrupted from another thread"""
+    
+    def __init__(self, pool, func, args, kwargs):
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.db = None
+        self.cancelled = False
+        
+    def __call__(self):
+        db = self.pool.acquire()
+        interrupted = False
+        try:
+            with self.lock:
+                if self.cancelled:
+                    raise concurrent.futures.CancelledError()
+                self.db = db
+            try:
+                return self.func(db, *self.args, **self.kwargs)
+            finally:
+                with self.lock:
+                    self.db = None
+                    interrupted = self.cancelled
+        finally:
+            # An interrupt that arrived between two statements would still
+            # be pending, so don't reuse the connection in that case
+            self.pool.release(db, discard=interrupted)
+                    
+    def interrupt(self):
+        with self.lock:
+            self.cancelled = True
+            if self.db is not None:
+                # Makes the running query raise apsw.InterruptError
+                self.db.sqldb.interrupt()
+
+
+# Functions run on the worker threads
+
+def _block_from_hash(db, hash):
+    block = db.block_from_hash(hash)
+    return db.blocks_from_ids([block.id])[0]
+    
+def _blocks_from_ids(db, ids):
+    return db.blocks_from_ids(ids)
+    
+def _account_from_address(db, address):
+    account = db.account_from_address(address)
+    account.name()
+    return account
+    
+def _account_from_id(db, id):
+    account = db.account_from_id(id)
+    account.name()
+    return account
+    
+def _chain2(db, account_id, **kwargs):
+    return Account(db, account_id).chain2(hydrate=True, **kwargs)
+    
+def _unpocketed(db, account_id, **kwargs):
+    return Account(db, account_id).unpocketed(hydrate=True, **kwargs)
+    
+def _chain_length(db, account_id):
+    return Account(db, account_id).chain_length()
+    
+def _account_interactions(db, left_id, right_id):
+    return db.account_interactions(Account(db, left_id), Account(db, right_id))
+    
+    
+class AsyncNanoDatabase:
+    
+    def __init__(self, dbfile, max_workers=8, max_concurrency=None, **pool_args):
+        """
+        max_workers: number of worker threads (and database connections)
+        max_concurrency: maximum number of queries queued or running at 
+            the same time, defaults to 2*max_workers. Further calls wait 
+            (without occupying a worker) until a slot becomes available.
+            
+        Remaining keyword arguments are passed to NanoDatabasePool.
+        """
+        self.pool = NanoDatabasePool(dbfile, max_connections=max_workers, **pool_args)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='nanodb')
+        if max_concurrency is None:
+            max_concurrency = 2*max_workers
+        self.max_concurrency = max_concurrency
+        # Created on first use, so it belongs to the running event loop
+        self.semaphore = None
+        
+    async def __aenter__(self):
+        return self
+        
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+        
+    def close(self):
+        """Wait for the running queries to finish and close the connections"""
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        
+    async def aclose(self):
+        """close() for use on the event loop, which it doesn't block"""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+        
+    async def run(self, func, *args, **kwargs):
+        """
+        Run func(db, *args, **kwargs) on a worker thread and return its 
+        result, with db a NanoDatabase only used by that thread for the 
+        duration of the call.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            
+        async with self.semaphore:
+            job = _Job(self.pool, func, args, kwargs)
+            future = self.executor.submit(job)
+            try:
+                return await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                if not future.cancel():
+                    # Already running
+                    job.interrupt()
+                raise
+                
+    async def block_from_hash(self, hash):
+        return await self.run(_block_from_hash, hash)
+        
+    async def blocks_from_ids(self, ids):
+        return await self.run(_blocks_from_ids, list(ids))
+        
+    async def account_from_address(self, address):
+        return await self.run(_account_from_address, address)
+        
+    async def account_from_id(self, id):
+        return await self.run(_account_from_id, id)
+        
+    async def chain2(self, account, type=None, start=0, limit=None, reverse=False):
+        """Async version of Account.chain2()"""
+        return await self.run(_chain2, account.id, type=type, start=start, limit=limit, reverse=reverse)
+        
+    async def unpocketed(self, account, limit=None, reverse=False):
+        """Async version of Account.unpocketed()"""
+        return await self.run(_unpocketed, account.id, limit=limit, reverse=reverse)
+        
+    async def chain_length(self, account):
+        """Async version of Account.chain_length()"""
+        return await self.run(_chain_length, account.id)
+        
+    async def account_interactions(self, left_account, right_account):
+        """Async version of NanoDatabase.account_interactions()"""
+        return await self.run(_account_interactions, left_account.id, right_account.id)
+        
+
+if __name__ == '__main__':
+    
+    import time
+    
+    async def main(dbfile):
+        async with AsyncNanoDatabase(dbfile) as db:
+            t0 = time.time()
+            blocks = await asyncio.gather(*[db.blocks_from_ids([id]) for id in range(100)])
+            t1 = time.time()
+            print('%d blocks in %.3f s' % (len(blocks), t1-t0))
+            print(db.pool.stats())
+            
+    asyncio.run(main(sys.argv[1]))
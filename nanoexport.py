@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+import click
+
+from nanodb import NanoDatabase
+
+"""
+Dump blocks (plus the derived block_info) from the SQLite database to
+a columnar file, for use in analytics tools (NumPy, pandas, Arrow, ...).
+
+Raw amounts are 128-bit integers, which none of these formats support
+natively, so they are split into two uint64 columns <name>_hi and
+<name>_lo (value = hi * 2**64 + lo).
+"""
+
+DEFAULT_SQLITE_DB = 'nano.db'
+
+BLOCK_COLUMNS = [
+    'b.id', 'b.hash', 'b.type', 'b.previous', 'b.next',
+    'b.representative', 'b.source', 'b.destination',
+    'b.balance_raw', 'b.account as open_account',
+    'i.account', 'i.chain_index', 'i.global_index', 'i.sister',
+    'i.balance', 'i.amount'
+]
+
+BLOCK_TABLES = 'blocks b join block_info i on i.block = b.id'
+
+FORMATS = ['npz', 'arrow', 'parquet']
+
+
+def write_npz(chunks, filename, db):
+    import numpy
+    columns = db.export_columns(BLOCK_TABLES, BLOCK_COLUMNS, chunk_size=chunks)
+    numpy.savez(filename, **columns)
+    return len(columns['id'])
+    
+def write_arrow(chunks, filename, db, format):
+    import pyarrow
+    
+    writer = None
+    n = 0
+    
+    for chunk in db.iter_columns(BLOCK_TABLES, BLOCK_COLUMNS, chunk_size=chunks):
+        batch = pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(a) for a in chunk.values()], names=list(chunk.keys()))
+        if writer is None:
+            if format == 'parquet':
+                import pyarrow.parquet
+                writer = pyarrow.parquet.ParquetWriter(filename, batch.schema)
+            else:
+                writer = pyarrow.ipc.new_file(filename, batch.schema)
+        if format == 'parquet':
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        n += batch.num_rows
+        
+    if writer is not None:
+        writer.close()
+        
+    return n
+
+@click.command()
+@click.option('-d', '--dbfile', default=DEFAULT_SQLITE_DB, help='SQLite database file', show_default=True)
+@click.option('-f', '--format', type=click.Choice(FORMATS), default='npz', help='Output format', show_default=True)
+@click.option('-c', '--chunk-size', default=262144, help='Number of rows fetched per chunk', show_default=True)
+@click.argument('outfile')
+def export(dbfile, format, chunk_size, outfile):
+    """Export blocks and block_info to OUTFILE"""
+    
+    db = NanoDatabase(dbfile, mmap_size=1024*1024*1024)
+    
+    t0 = time.time()
+    
+    if format == 'npz':
+        n = write_npz(chunk_size, outfile, db)
+    else:
+        n = write_arrow(chunk_size, outfile, db, format)
+        
+    t1 = time.time()
+    
+    print('Exported %d blocks to %s in %.1fs' % (n, outfile, t1-t0))
+
+if __name__ == '__main__':
+    export()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys, os, json, itertools
+import numpy
+
+from nanodb import NanoDatabase, Account, Block
+
+"""
+In-memory representation of the block-lattice as a directed graph,
+with block IDs as nodes. There are two kinds of edges:
+
+    A -> B      B.previous == A (i.e. A.next == B), same account chain
+    S -> R      R is the receive/open block that pockets send block S
+
+Following edges forward tracks where funds (can) flow to, following them
+backward where they came from. The adjacency lists are stored in CSR form
+(an offsets array indexed by block ID plus one flat targets array), for
+both directions. Building these arrays requires a few full table scans,
+so they are cached on disk next to the SQLite database and memory-mapped
+on subsequent loads.
+"""
+
+# Increase when the layout of the cached arrays changes
+CACHE_VERSION = 1
+
+CACHE_ARRAYS = ['fwd_offsets', 'fwd_targets', 'rev_offsets', 'rev_targets', 'block_account']
+
+
+def _build_csr(src, dst, num_nodes):
+    """
+    Build CSR arrays from parallel src/dst edge arrays.
+    
+    Returns (offsets, targets), with the neighbours of node n
+    being targets[offsets[n]:offsets[n+1]]
+    """
+    order = numpy.argsort(src, kind='stable')
+    targets = dst[order].astype(numpy.int32)
+    offsets = numpy.zeros(num_nodes+1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(src, minlength=num_nodes), out=offsets[1:])
+    return offsets, targets
+    
+    
+def _expand(offsets, targets, frontier):
+    """
+    Return (sources, neighbours) for all edges leaving the nodes in frontier,
+    without looping over the nodes in Python
+    """
+    starts = offsets[frontier]
+    counts = offsets[frontier+1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        empty = numpy.zeros(0, dtype=numpy.int32)
+        return empty, empty
+    # Position in targets[] of each neighbour: start of its source node's 
+    # range plus its index within that range
+    base = numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts)
+    neighbours = targets[base + numpy.arange(total)]
+    sources = numpy.repeat(frontier, counts)
+    return sources, neighbours
+    
+
+class LatticeGraph:
+    
+    def __init__(self, db, cachedir=None, rebuild=False):
+        """
+        db: NanoDatabase
+        cachedir: directory holding the cached arrays, defaults to <dbfile>.graph
+        rebuild: ignore any existing cache
+        """
+        assert isinstance(db, NanoDatabase)
+        self.db = db
+        
+        if cachedir is None:
+            cachedir = db.dbfile + '.graph'
+        self.cachedir = cachedir
+        
+        if rebuild or not self._load_cache():
+            self._build()
+            self._save_cache()
+            # Reload, so the arrays are memory-mapped in the same way 
+            # as with a cache hit
+            self._load_cache()
+            
+        self.num_nodes = len(self.fwd_offsets) - 1
+        
+    def __repr__(self):
+        return '<LatticeGraph %d blocks, %d edges>' % (self.num_nodes, len(self.fwd_targets))
+
+    # Construction and caching
+        
+    def _db_identity(self):
+        st = os.stat(self.db.dbfile)
+        return dict(version=CACHE_VERSION, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        
+    def _load_cache(self):
+        """Memory-map the cached arrays. Returns False if no (valid) cache exists"""
+        try:
+            with open(os.path.join(self.cachedir, 'meta.json'), 'rt') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+            
+        if meta != self._db_identity():
+            return False
+        
+        try:
+            for name in CACHE_ARRAYS:
+                fname = os.path.join(self.cachedir, name + '.npy')
+                setattr(self, name, numpy.load(fname, mmap_mode='r'))
+        except (OSError, ValueError):
+            return False
+            
+        return True
+        
+    def _save_cache(self):
+        os.makedirs(self.cachedir, exist_ok=True)
+        
+        # Write meta.json last (and atomically), so a partially written 
+        # cache is never considered valid
+        metafile = os.path.join(self.cachedir, 'meta.json')
+        if os.path.exists(metafile):
+            os.remove(metafile)
+            
+        for name in CACHE_ARRAYS:
+            numpy.save(os.path.join(self.cachedir, name + '.npy'), getattr(self, name))
+            
+        with open(metafile + '.tmp', 'wt') as f:
+            json.dump(self._db_identity(), f)
+        os.replace(metafile + '.tmp', metafile)
+        
+    def _query_pairs(self, cur, sql, bindings=()):
+        """Return the two-column result of sql as a (N,2) integer array"""
+        cur.execute(sql, bindings)
+        values = numpy.fromiter(itertools.chain.from_iterable(cur), dtype=numpy.int64)
+        return values.reshape((-1, 2))
+        
+    def _build(self):
+        cur = self.db.cursor()
+        
+        # previous -> next
+        chain_edges = self._query_pairs(cur, 'select id, next from blocks where next is not null')
+        # send -> receive/open
+        transfer_edges = self._query_pairs(cur, 'select source, id from blocks where source is not null')
+        edges = numpy.concatenate((chain_edges, transfer_edges))
+        
+        block_account = self._query_pairs(cur, 'select block, account from block_info')
+        
+        cur.execute('select max(id) from blocks')
+        max_id = next(cur)[0]
+        if max_id is None:
+            max_id = -1
+        if len(edges) > 0:
+            # Blocks can reference blocks that are not in the database
+            max_id = max(max_id, int(edges.max()))
+        num_nodes = max_id + 1
+            
+        src = edges[:,0]
+        dst = edges[:,1]
+        self.fwd_offsets, self.fwd_targets = _build_csr(src, dst, num_nodes)
+        self.rev_offsets, self.rev_targets = _build_csr(dst, src, num_nodes)
+        
+        self.block_account = numpy.full(num_nodes, -1, dtype=numpy.int32)
+        self.block_account[block_account[:,0]] = block_account[:,1]
+        
+    # Queries
+    
+    def _csr(self, backward):
+        if backward:
+            return self.rev_offsets, self.rev_targets
+        return self.fwd_offsets, self.fwd_targets
+        
+    def _block_ids(self, blocks):
+        if isinstance(blocks, (Block, int, numpy.integer)):
+            blocks = [blocks]
+        ids = [b.id if isinstance(b, Block) else int(b) for b in blocks]
+        return numpy.array(ids, dtype=numpy.int64)
+        
+    def _account_id(self, account):
+        if isinstance(account, Account):
+            return account.id
+        return int(account)
+        
+    def successors(self, block):
+        """IDs of the blocks directly depending on the given block (next block, pocketing block)"""
+        id = self._block_ids(block)[0]
+        return numpy.array(self.fwd_targets[self.fwd_offsets[id]:self.fwd_offsets[id+1]])
+        
+    def predecessors(self, block):
+        """IDs of the blocks the given block directly depends on (previous block, source block)"""
+        id = self._block_ids(block)[0]
+        return numpy.array(self.rev_targets[self.rev_offsets[id]:self.rev_offsets[id+1]])
+    
+    def bfs(self, blocks, max_hops=None, backward=False):
+        """
+        Breadth-first search starting at the given block(s), following edges 
+        forward (where funds went) or backward (where funds came from).
+        
+        Returns two arrays (block IDs, hop count), in order of increasing 
+        hop count. The start blocks themselves are included with hop count 0.
+        """
+        offsets, targets = self._csr(backward)
+        
+        frontier = numpy.unique(self._block_ids(blocks))
+        visited = numpy.zeros(self.num_nodes, dtype=numpy.bool_)
+        visited[frontier] = True
+        
+        found = [frontier]
+        hops = [numpy.zeros(len(frontier), dtype=numpy.int32)]
+        hop = 0
+        
+        while len(frontier) > 0 and (max_hops is None or hop < max_hops):
+            hop += 1
+            sources, neighbours = _expand(offsets, targets, frontier)
+            frontier = numpy.unique(neighbours[~visited[neighbours]])
+            visited[frontier] = True
+            found.append(frontier)
+            hops.append(numpy.full(len(frontier), hop, dtype=numpy.int32))
+            
+        return numpy.concatenate(found), numpy.concatenate(hops)
+        
+    def reachable(self, blocks, backward=False, max_hops=None):
+        """
+        Return the (sorted) IDs of all blocks reachable from the given block(s), 
+        excluding the start blocks themselves.
+        
+        backward=False: all blocks the funds in the start block(s) can have flowed to
+        backward=True: all blocks the funds in the start block(s) can have come from
+        """
+        start = self._block_ids(blocks)
+        found, hops = self.bfs(start, max_hops=max_hops, backward=backward)
+        return numpy.sort(found[hops > 0])
+        
+    def reachable_accounts(self, blocks, backward=False, max_hops=None):
+        """Return the (sorted) IDs of the accounts owning the blocks returned by reachable()"""
+        accounts = self.block_account[self.reachable(blocks, backward, max_hops)]
+        return numpy.unique(accounts[accounts >= 0])
+        
+    def path(self, from_account, to_account, max_hops=None, return_ids=False):
+        """
+        Find the first (i.e. shortest) path along which funds could have
+        flowed from one account to another. 
+        
+        Returns a list of blocks, starting with a block in the chain of 
+        from_account and ending with a block in the chain of to_account.
+        Returns None if no such path exists.
+        
+        If return_ids=True block IDs are returned instead of Block objects.
+        """
+        
+        from_account = self._account_id(from_account)
+        to_account = self._account_id(to_account)
+        
+        offsets, targets = self.fwd_offsets, self.fwd_targets
+        
+        frontier = numpy.flatnonzero(self.block_account == from_account)
+        if len(frontier) == 0:
+            return None
+            
+        if from_account == to_account:
+            path = [int(frontier[0])]
+        else:
+            parent = numpy.full(self.num_nodes, -1, dtype=numpy.int64)
+            visited = numpy.zeros(self.num_nodes, dtype=numpy.bool_)
+            visited[frontier] = True
+            
+            hop = 0
+            hit = None
+            
+            while len(frontier) > 0 and (max_hops is None or hop < max_hops):
+                hop += 1
+                sources, neighbours = _expand(offsets, targets, frontier)
+                mask = ~visited[neighbours]
+                frontier, first = numpy.unique(neighbours[mask], return_index=True)
+                parent[frontier] = sources[mask][first]
+                visited[frontier] = True
+                
+                hits = frontier[self.block_account[frontier] == to_account]
+                if len(hits) > 0:
+                    hit = int(hits[0])
+                    break
+                    
+            if hit is None:
+                return None
+            
+            path = [hit]
+            while parent[path[-1]] >= 0:
+                path.append(int(parent[path[-1]]))
+            path.reverse()
+            
+        if return_ids:
+            return path
+        return [Block(self.db, id) for id in path]
+        
+
+if __name__ == '__main__':
+    
+    import time
+    
+    db = NanoDatabase(sys.argv[1])
+    
+    t0 = time.time()
+    g = LatticeGraph(db)
+    t1 = time.time()
+    print(g)
+    print('Loaded in %.3f s' % (t1-t0))
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import math, struct
+import lmdb
+
+from nanodb import NanoDBException, BlockNotFound, AccountNotFound, UNSET, \
+    KNOWN_ACCOUNTS, GENESIS_OPEN_BLOCK_HASH, GENESIS_BALANCE_RAW
+from rainumbers import bin2hex, hex2bin, encode_account, decode_account
+
+"""
+Read-only access to the LMDB database of a Nano node (data.ldb), with 
+(a subset of) the API of nanodb, so no conversion with conv2sqlite.py is 
+needed for quick lookups, e.g. on a live node.
+
+Blocks and accounts are identified by their hash and address, as LMDB 
+has no integer IDs, i.e. Block.id is the (hex) hash and Account.id the 
+address.
+
+Everything is read within a single long-lived read transaction, with 
+buffers=True, so values are not copied out of the memory map (only the
+fields used are). Call refresh() to see changes made by the node since 
+the database was opened.
+
+Queries that need the data derived during conversion (global_index, 
+chain_index, receive block of a send, rich list, ...) raise 
+RequiresConvertedDB.
+"""
+
+# Block sub-databases, roughly in order of decreasing size
+BLOCK_TYPES = ['send', 'receive', 'open', 'change']
+
+SUBDBS = BLOCK_TYPES + ['accounts', 'pending', 'frontiers', 'blocks_info']
+
+ZERO_HASH = bytes(32)
+
+GENESIS_OPEN_BLOCK = hex2bin(GENESIS_OPEN_BLOCK_HASH)
+
+# Offsets of the fields of the block types (see dump_wallet_db.py), 
+# as <field>: (start, end); all blocks end with signature (64), work (8)
+# and successor (32)
+BLOCK_FIELDS = {
+    'send':     dict(previous=(0, 32), destination=(32, 64), balance=(64, 80)),
+    'receive':  dict(previous=(0, 32), source=(32, 64)),
+    'open':     dict(source=(0, 32), representative=(32, 64), account=(64, 96)),
+    'change':   dict(previous=(0, 32), representative=(32, 64)),
+}
+
+
+class RequiresConvertedDB(NanoDBException):
+    """The query needs data only available in a database converted with conv2sqlite.py"""
+    pass
+
+
+class BloomFilter:
+    
+    """
+    Bloom filter for a set of 32-byte keys (block hashes, public keys). 
+    As these are uniformly distributed already, the bit positions are taken 
+    directly from (up to 8) 32-bit words of the key, instead of hashing.
+    Needs numpy.
+    """
+    
+    def __init__(self, keys, error_rate=0.01):
+        """keys: array of shape (n, 32) and dtype uint8, see keys_array()"""
+        import numpy
+        n = max(1, len(keys))
+        self.num_bits = max(64, int(math.ceil(-n * math.log(error_rate) / math.log(2)**2)))
+        self.num_hashes = max(1, min(8, int(round(self.num_bits / n * math.log(2)))))
+        self.bits = numpy.zeros((self.num_bits + 7) // 8, dtype=numpy.uint8)
+        if len(keys) > 0:
+            positions = self._positions(keys).ravel()
+            numpy.bitwise_or.at(self.bits, positions >> 3, (1 << (positions & 7)).astype(numpy.uint8))
+        # Indexing bytes is faster than indexing an array, for single lookups
+        self.bits_bytes = self.bits.tobytes()
+            
+    @staticmethod
+    def keys_array(keys):
+        """Convert a sequence of 32-byte keys to an array for __init__()/contains()"""
+        import numpy
+        return numpy.frombuffer(b''.join(keys), dtype=numpy.uint8).reshape(-1, 32)
+        
+    def _positions(self, keys):
+        import numpy
+        words = keys.view('<u4')[:, :self.num_hashes].astype(numpy.uint64)
+        return words % numpy.uint64(self.num_bits)
+        
+    def __contains__(self, key):
+        num_bits, bits = self.num_bits, self.bits_bytes
+        for i in range(0, 4*self.num_hashes, 4):
+            position = int.from_bytes(key[i:i+4], 'little') % num_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+        
+    def contains(self, keys):
+        """Boolean array, for an array of keys (see keys_array())"""
+        import numpy
+        positions = self._positions(keys)
+        present = (self.bits[positions >> 3] >> (positions & 7).astype(numpy.uint8)) & 1
+        return present.all(axis=1)
+        
+        
+class BlockLocator:
+    
+    """
+    Finds the sub-database (block type) holding a block, using exact 
+    lookups within a single read transaction (by default its own, kept 
+    open until close()). 
+    
+    With bloom=True a Bloom filter is built per sub-database first (one 
+    scan over its keys), so sub-databases that can't contain a hash are 
+    skipped. This pays off for many lookups, e.g. with locate_many().
+    """
+    
+    def __init__(self, env, types=BLOCK_TYPES, txn=None, bloom=False, error_rate=0.01):
+        self.env = env
+        self.own_txn = txn is None
+        self.txn = env.begin(buffers=True) if txn is None else txn
+        self.subdbs = []
+        for name in types:
+            if self.txn.get(name.encode('ascii')) is not None:
+                self.subdbs.append((name, env.open_db(name.encode('ascii'), txn=self.txn, create=False)))
+        self.filters = None
+        if bloom:
+            self.filters = {}
+            for name, subdb in self.subdbs:
+                keys = BloomFilter.keys_array(bytes(key) for key in self.txn.cursor(subdb).iternext(values=False))
+                self.filters[name] = BloomFilter(keys, error_rate)
+                
+    def close(self):
+        if self.own_txn:
+            self.txn.abort()
+            
+    def locate(self, key):
+        """Return (<type>, <value buffer>) for a block hash (32 bytes), or None"""
+        get, filters = self.txn.get, self.filters
+        for name, subdb in self.subdbs:
+            if filters is not None and key not in filters[name]:
+                continue
+            value = get(key, db=subdb)
+            if value is not None:
+                return name, value
+        return None
+        
+    def locate_many(self, keys):
+        """Return a list with the result of locate() for each key"""
+        
+        keys = list(keys)
+        if self.filters is None or len(keys) == 0:
+            return [self.locate(key) for key in keys]
+            
+        # Filter all keys at once, then only look up the candidates
+        array = BloomFilter.keys_array(keys)
+        candidates = [(name, subdb, self.filters[name].contains(array).tolist()) for name, subdb in self.subdbs]
+        
+        res = []
+        get = self.txn.get
+        for i, key in enumerate(keys):
+            found = None
+            for name, subdb, maybe in candidates:
+                if maybe[i]:
+                    value = get(key, db=subdb)
+                    if value is not None:
+                        found = (name, value)
+                        break
+            res.append(found)
+            
+        return res
+
+
+class LMDBDatabase:
+    
+    def __init__(self, lmdbfile, map_size=64*1024*1024*1024):
+        self.lmdbfile = lmdbfile
+        self.env = lmdb.Environment(lmdbfile, subdir=False, readonly=True,
+            map_size=map_size, max_dbs=16)
+        self.subdbs = dict((name, self.env.open_db(name.encode('ascii'), create=False)) 
+            for name in SUBDBS if self._has_subdb(name))
+        self.txn = self.env.begin(buffers=True)
+        self.locator = BlockLocator(self.env, txn=self.txn)
+        
+    def _has_subdb(self, name):
+        with self.env.begin() as txn:
+            return txn.get(name.encode('ascii')) is not None
+            
+    def refresh(self):
+        """Start a new read transaction, to see the current state of the database"""
+        self.txn.abort()
+        self.txn = self.env.begin(buffers=True)
+        self.locator.txn = self.txn
+        
+    def close(self):
+        self.txn.abort()
+        self.env.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
+        
+    def get(self, subdbname, key):
+        """Value (a buffer, valid until refresh()) for key in a sub-database, or None"""
+        subdb = self.subdbs.get(subdbname)
+        if subdb is None:
+            return None
+        return self.txn.get(key, db=subdb)
+        
+    # Blocks
+        
+    def block_from_hash(self, hash):
+        """Block for a hash (hex string or 32 bytes)"""
+        key = hex2bin(hash) if isinstance(hash, str) else bytes(hash)
+        res = self.locator.locate(key)
+        if res is None:
+            raise BlockNotFound('Unknown block %s' % bin2hex(key))
+        return Block(self, key, res[0], res[1])
+        
+    def blocks_from_hashes(self, hashes):
+        """Blocks for a sequence of hashes (hex strings or 32 bytes), None for unknown hashes"""
+        keys = [hex2bin(h) if isinstance(h, str) else bytes(h) for h in hashes]
+        return [Block(self, key, res[0], res[1]) if res is not None else None 
+            for key, res in zip(keys, self.locator.locate_many(keys))]
+        
+    # Block IDs are hashes
+    block_from_id = block_from_hash
+    
+    # Accounts
+    
+    def account_from_address(self, address):
+        try:
+            key = decode_account(address)
+        except ValueError as e:
+            raise AccountNotFound(str(e))
+        if self.get('accounts', key) is None:
+            raise AccountNotFound('Unknown account %s' % address)
+        return Account(self, key, address)
+        
+    # Account IDs are addresses
+    account_from_id = account_from_address
+    
+    def account_from_key(self, key):
+        """Account for a public key (32 bytes)"""
+        key = bytes(key)
+        if self.get('accounts', key) is None:
+            raise AccountNotFound('Unknown account %s' % encode_account(key))
+        return Account(self, key)
+        
+    def account_from_name(self, name):
+        for address, accname in KNOWN_ACCOUNTS.items():
+            if name == accname:
+                return self.account_from_address(address)
+        raise AccountNotFound('Account with name "%s" not found' % name)
+        
+    def named_accounts(self):
+        """Named accounts present in the database, as {<address>: (<address>, <name>)}"""
+        res = {}
+        for address, name in KNOWN_ACCOUNTS.items():
+            if self.get('accounts', decode_account(address)) is not None:
+                res[address] = (address, name)
+        return res
+        
+    def stats(self):
+        """Number of entries per sub-database (from the LMDB statistics, no scanning)"""
+        return dict((name, self.txn.stat(subdb)['entries']) for name, subdb in self.subdbs.items())
+        
+    # Derived data, not available
+    
+    def top_accounts(self, n=100, offset=0, after=None, before=None):
+        raise RequiresConvertedDB('top_accounts() requires a converted database (conv2sqlite.py)')
+        
+    def balances_at(self, accounts, global_index):
+        raise RequiresConvertedDB('balances_at() requires a converted database (conv2sqlite.py)')
+        
+    def account_tree(self, return_ids=False):
+        raise RequiresConvertedDB('account_tree() requires a converted database (conv2sqlite.py)')
+        
+    def search_prefix(self, value, limit=10):
+        raise RequiresConvertedDB('search_prefix() requires a converted database (conv2sqlite.py)')
+        
+        
+class Account:
+    
+    def __init__(self, db, key, address=None):
+        self.db = db
+        self.key = key
+        self.address = address if address is not None else encode_account(key)
+        self.id = self.address
+        self.info_ = None
+        
+    def __repr__(self):
+        return '<Account %s>' % self.address
+        
+    def info(self):
+        """
+        Fields of the "accounts" entry: (head block hash, representative 
+        block hash, open block hash, balance, modified, block count)
+        """
+        if self.info_ is None:
+            value = self.db.get('accounts', self.key)
+            if value is None:
+                raise AccountNotFound('Unknown account %s' % self.address)
+            modified, block_count = struct.unpack('<QQ', value[112:128])
+            self.info_ = (bytes(value[0:32]), bytes(value[32:64]), bytes(value[64:96]), 
+                int.from_bytes(value[96:112], 'big'), modified, block_count)
+        return self.info_
+        
+    def first_block(self):
+        """The open block"""
+        return self.db.block_from_hash(self.info()[2])
+        
+    def last_block(self):
+        """The head block"""
+        return self.db.block_from_hash(self.info()[0])
+        
+    def chain_length(self):
+        return self.info()[5]
+        
+    def balance(self):
+        """Current balance (in raw)"""
+        return self.info()[3]
+        
+    def modified(self):
+        """Time of last modification (seconds since the epoch)"""
+        return self.info()[4]
+        
+    def name(self):
+        return KNOWN_ACCOUNTS.get(self.address)
+        
+    def chain(self, type=None, limit=None, reverse=False):
+        """
+        Blocks in the account chain (optionally only those of the given 
+        type), starting with the open block (or with the head block for 
+        reverse=True)
+        """
+        res = []
+        block = self.last_block() if reverse else self.first_block()
+        while block is not None and (limit is None or len(res) < limit):
+            if type is None or block.type == type:
+                res.append(block)
+            block = block.previous() if reverse else block.next()
+        return res
+        
+    def _pending(self):
+        """(send block hash, sender key, amount) for the pending entries of this account"""
+        subdb = self.db.subdbs.get('pending')
+        if subdb is None:
+            return
+        cur = self.db.txn.cursor(subdb)
+        if not cur.set_range(self.key):
+            return
+        for key, value in cur:
+            if bytes(key[:32]) != self.key:
+                break
+            yield bytes(key[32:64]), bytes(value[0:32]), int.from_bytes(value[32:48], 'big')
+            
+    def unpocketed(self, limit=None):
+        """Send blocks to this account that are not pocketed yet (in hash order)"""
+        res = []
+        for hash, sender, amount in self._pending():
+            if limit is not None and len(res) >= limit:
+                break
+            res.append(self.db.block_from_hash(hash))
+        return res
+        
+    def pending_total(self):
+        """Total amount (in raw) sent to this account that isn't pocketed yet"""
+        return sum(amount for hash, sender, amount in self._pending())
+        
+        
+class Block:
+    
+    def __init__(self, db, key, type, value):
+        self.db = db
+        self.key = key
+        self.id = bin2hex(key)
+        self.type = type
+        # Copy out only the hash and balance fields, not the signature and work
+        self.fields = dict((name, bytes(value[start:end])) for name, (start, end) in BLOCK_FIELDS[type].items())
+        self.successor = bytes(value[-32:])
+        self.balance_ = UNSET
+        self.account_ = None
+        
+    def __repr__(self):
+        return '<Block %s %s>' % (self.type, self.id)
+        
+    def hash(self):
+        return self.id
+        
+    def previous(self):
+        """Previous block in the chain, None for an open block"""
+        if self.type == 'open':
+            return None
+        return self.db.block_from_hash(self.fields['previous'])
+        
+    def next(self):
+        """Next block in the chain, None for the head block"""
+        if self.successor == ZERO_HASH:
+            return None
+        return self.db.block_from_hash(self.successor)
+        
+    def source(self):
+        """Source (send) block of a receive or open block; None for the genesis open block"""
+        if self.type not in ('receive', 'open') or self.key == GENESIS_OPEN_BLOCK:
+            return None
+        return self.db.block_from_hash(self.fields['source'])
+        
+    def destination(self):
+        """For a send block return the destination account, for other block types None"""
+        if self.type != 'send':
+            return None
+        return Account(self.db, self.fields['destination'])
+        
+    def account(self):
+        """
+        Account this block belongs to. Only stored for open blocks, for 
+        others the chain is followed to a block with a blocks_info entry, 
+        or the head block (frontiers).
+        """
+        if self.account_ is not None:
+            return self.account_
+        block = self
+        while True:
+            if block.type == 'open':
+                key = block.fields['account']
+                break
+            info = self.db.get('blocks_info', block.key)
+            if info is not None:
+                key = bytes(info[0:32])
+                break
+            frontier = self.db.get('frontiers', block.key)
+            if frontier is not None:
+                key = bytes(frontier[0:32])
+                break
+            block = block.next()
+            if block is None:
+                raise BlockNotFound('Chain of block %s has no frontier' % self.id)
+        self.account_ = Account(self.db, key)
+        return self.account_
+        
+    def balance(self):
+        """
+        Account balance (in raw) at this block. Stored for send blocks 
+        (and in blocks_info for some others), otherwise derived from the 
+        previous blocks in the chain and the amounts received.
+        """
+        if self.balance_ is not UNSET:
+            return self.balance_
+            
+        # Walk back to a block with a known balance, adding the amounts received
+        received = 0
+        block = self
+        while True:
+            if block.balance_ is not UNSET:
+                balance = block.balance_
+                break
+            if block.type == 'send':
+                balance = int.from_bytes(block.fields['balance'], 'big')
+                break
+            info = self.db.get('blocks_info', block.key)
+            if info is not None:
+                balance = int.from_bytes(info[32:48], 'big')
+                break
+            if block.type in ('receive', 'open'):
+                received += block.amount()
+            if block.type == 'open':
+                balance = 0
+                break
+            block = block.previous()
+            
+        self.balance_ = balance + received
+        return self.balance_
+        
+    def amount(self):
+        """
+        Amount (in raw) transferred by a send/receive/open block, None for
+        a change block
+        """
+        if self.type == 'send':
+            return self.previous().balance() - self.balance()
+        elif self.type in ('receive', 'open'):
+            if self.key == GENESIS_OPEN_BLOCK:
+                return GENESIS_BALANCE_RAW
+            return self.source().amount()
+        return None
+        
+    def sister(self):
+        """
+        For a receive/open block its source (send) block. For a send block 
+        only the unpocketed case can be determined (returns None)
+        """
+        if self.type in ('receive', 'open'):
+            return self.source()
+        elif self.type == 'send':
+            if self.db.get('pending', self.fields['destination'] + self.key) is not None:
+                return None
+            raise RequiresConvertedDB('The receiving block of a send block requires a converted database (conv2sqlite.py)')
+        return None
+        
+    def chain_index(self):
+        raise RequiresConvertedDB('chain_index() requires a converted database (conv2sqlite.py)')
+        
+    def global_index(self):
+        raise RequiresConvertedDB('global_index() requires a converted database (conv2sqlite.py)')
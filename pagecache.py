@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018 Paul Melis
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os, json, gzip, threading, collections
+
+class PageCache:
+    
+    """
+    Thread-safe LRU cache of rendered pages (or any other byte strings),
+    bounded both in number of entries and in total size.
+    
+    Keys should include whatever identifies the data the page was rendered
+    from, e.g. the database generation plus the request path.
+    """
+    
+    def __init__(self, max_entries=1000, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key -> (size, value)
+        self.size = 0
+        
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def __len__(self):
+        return len(self.entries)
+        
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        with self.lock:
+            try:
+                size, value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+            
+    def put(self, key, value, size):
+        """
+        Store value under key. Size is the number of bytes accounted for 
+        the value; values larger than max_bytes are not stored.
+        """
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[0]
+            self.entries[key] = (size, value)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                oldsize, oldvalue = self.entries.popitem(last=False)[1]
+                self.size -= oldsize
+                self.evictions += 1
+                
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            
+    def stats(self):
+        """Return a dict with cache statistics"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                entries=len(self.entries),
+                max_entries=self.max_entries,
+                bytes=self.size,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=1.0 * self.hits / lookups if lookups > 0 else 0.0,
+                evictions=self.evictions,
+            )
+
+                
+class StaticPages:
+    
+    """
+    Directory of pre-rendered, gzip compressed pages, as written by 
+    "explorer.py render-static". The manifest (MANIFEST_FILE) lists the 
+    pages and the database generation they were rendered from; pages 
+    rendered from another generation are ignored.
+    
+    Page files are named after the request path, e.g. /account/1 is stored
+    as account/1.html.gz and / as index.html.gz, so a front proxy can serve 
+    them directly (e.g. nginx with gzip_static and try_files $uri.html).
+    """
+    
+    MANIFEST_FILE = 'manifest.json'
+    
+    def __init__(self, directory, generation):
+        self.directory = directory
+        self.pages = {}         # path -> file name, relative to directory
+        self.stale = False
+        
+        manifest_file = os.path.join(directory, self.MANIFEST_FILE)
+        if not os.path.exists(manifest_file):
+            return
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['generation'] != generation:
+            self.stale = True
+            return
+        self.pages = dict((path, page['file']) for path, page in manifest['pages'].items())
+        
+    def __len__(self):
+        return len(self.pages)
+        
+    def __contains__(self, path):
+        return path in self.pages
+        
+    @staticmethod
+    def file_name(path):
+        """File name (relative to the directory) of the page for a request path"""
+        path = path.strip('/')
+        if path == '':
+            path = 'index'
+        return path + '.html.gz'
+        
+    def get(self, path, compressed=True):
+        """
+        Return the page for path (gzip compressed, unless compressed is 
+        False), or None
+        """
+        name = self.pages.get(path)
+        if name is None:
+            return None
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            data = f.read()
+        return data if compressed else gzip.decompress(data)
+        
+    @classmethod
+    def write_page(cls, directory, path, data):
+        """Compress and store a page, returning its manifest entry"""
+        name = cls.file_name(path)
+        filename = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        compressed = gzip.compress(data, 9)
+        # Written to a temporary file first, as the directory may be in use
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(filename + '.tmp', filename)
+        return dict(file=name, size=len(data), compressed=len(compressed))
+        
+    @classmethod
+    def write_manifest(cls, directory, generation, pages):
+        """Write the manifest for pages ({path: entry from write_page()})"""
+        manifest = dict(generation=generation, pages=pages)
+        filename = os.path.join(directory, cls.MANIFEST_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
@@ -58,6 +58,86 @@ def format_amount(amount, precision):
 
     else:
         return "%d raw" % amount
+        
+# Units used by format_amount(), largest first
+AMOUNT_UNITS = [
+    (UNIT_Mxrb, " XRB"),
+    (UNIT_kxrb, "*10<sup>-3</sup> XRB"),
+    (UNIT_xrb,  "*10<sup>-6</sup> XRB"),
+    (UNIT_mxrb, "*10<sup>-9</sup> XRB"),
+    (UNIT_uxrb, "*10<sup>-12</sup> XRB"),
+]
+
+class AmountFormatter:
+    
+    """
+    Formats raw amounts like format_amount(), but using only integer 
+    arithmetic (so rounding is exact, half up), with the separators fixed 
+    when the formatter is created, e.g. thousands='.', decimal=',' for 
+    1.000.000,00 XRB. Call it with a single amount, or use many() for a 
+    sequence of amounts.
+    """
+    
+    def __init__(self, precision, thousands=',', decimal='.'):
+        self.precision = precision
+        self.thousands = thousands
+        self.decimal = decimal
+        
+        # (<threshold>, <divisor>, <rounding>, <format>): the amount is 
+        # rounded to a multiple of divisor (the unit divided by 10**precision),
+        # the format takes the grouped integer part and the fractional digits
+        self.scale = 10**precision
+        self.units = []
+        for unit, suffix in AMOUNT_UNITS:
+            suffix = suffix.replace('%', '%%')
+            if precision > 0:
+                fmt = '%s' + decimal + '%0' + str(precision) + 'd' + suffix
+            else:
+                fmt = '%s' + suffix
+            divisor = unit // self.scale
+            self.units.append((unit, divisor, divisor // 2, fmt))
+            
+    def __call__(self, amount):
+        if amount < self.units[-1][0]:
+            return '0 XRB' if amount == 0 else '%d raw' % amount
+        for unit, divisor, rounding, fmt in self.units:
+            if amount >= unit:
+                break
+        integer, fraction = divmod((amount + rounding) // divisor, self.scale)
+        integer = format(integer, ',')
+        if self.thousands != ',':
+            integer = integer.replace(',', self.thousands)
+        return fmt % (integer, fraction) if self.precision > 0 else fmt % integer
+        
+    def many(self, amounts):
+        """Format a sequence of amounts, returning a list of strings"""
+        
+        units = self.units
+        smallest = units[-1][0]
+        scale = self.scale
+        thousands = self.thousands if self.thousands != ',' else None
+        with_fraction = self.precision > 0
+        
+        res = []
+        append = res.append
+        
+        for amount in amounts:
+            
+            if amount < smallest:
+                append('0 XRB' if amount == 0 else '%d raw' % amount)
+                continue
+                
+            for unit, divisor, rounding, fmt in units:
+                if amount >= unit:
+                    break
+                    
+            integer, fraction = divmod((amount + rounding) // divisor, scale)
+            integer = format(integer, ',')
+            if thousands is not None:
+                integer = integer.replace(',', thousands)
+            append(fmt % (integer, fraction) if with_fraction else fmt % integer)
+            
+        return res
     
 def bin2hex(s):
     assert isinstance(s, bytes)
@@ -92,6 +172,116 @@ def bin2balance_mxrb(b):
     assert isinstance(b, bytes)
     return 1.0 * int.from_bytes(b, 'big') / (10**24 * 10**6)
     
+# Vectorized amounts
+#
+# Arrays of raw amounts are represented as pairs of NumPy uint64 arrays
+# (hi, lo), holding the upper and lower 64 bits (value = hi * 2**64 + lo),
+# as NumPy has no 128-bit integers. The functions below take and return
+# such pairs; NumPy is only needed when they're used.
+
+MASK32 = 2**32 - 1
+MASK64 = 2**64 - 1
+MAX_RAW = 2**128 - 1
+
+def amounts_from_bytes(data):
+    """
+    Convert 16-byte big-endian amounts (as stored by the node), either 
+    concatenated in a single bytes-like object or as a sequence of 
+    bytes objects, to a (hi, lo) pair of arrays
+    """
+    import numpy
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = b''.join(data)
+    if len(data) % 16 != 0:
+        raise ValueError('Length of amount data (%d) is not a multiple of 16' % len(data))
+    a = numpy.frombuffer(data, dtype='>u8').reshape(-1, 2)
+    return a[:,0].astype(numpy.uint64), a[:,1].astype(numpy.uint64)
+    
+def amounts_to_bytes(hi, lo):
+    """Convert a (hi, lo) pair of arrays to concatenated 16-byte big-endian amounts"""
+    import numpy
+    a = numpy.empty((len(hi), 2), dtype='>u8')
+    a[:,0] = hi
+    a[:,1] = lo
+    return a.tobytes()
+    
+def amounts_from_ints(values):
+    """Convert a sequence of raw amounts (ints, 0 <= value <= MAX_RAW) to a (hi, lo) pair of arrays"""
+    import numpy
+    if not isinstance(values, (list, tuple)):
+        values = list(values)
+    n = len(values)
+    if n > 0 and (min(values) < 0 or max(values) > MAX_RAW):
+        raise OverflowError('Amount out of range')
+    hi = numpy.fromiter((v >> 64 for v in values), dtype=numpy.uint64, count=n)
+    lo = numpy.fromiter((v & MASK64 for v in values), dtype=numpy.uint64, count=n)
+    return hi, lo
+    
+def amounts_to_ints(hi, lo):
+    """Convert a (hi, lo) pair of arrays to a list of ints"""
+    return [(h << 64) | l for h, l in zip(hi.tolist(), lo.tolist())]
+    
+def amounts_to_float(hi, lo, unit=UNIT_XRB):
+    """
+    Convert a (hi, lo) pair of arrays to float64 amounts in the given unit
+    (XRB by default). Like bin2balance_mxrb() this is not fully precise.
+    """
+    import numpy
+    return (hi.astype(numpy.float64) * 2.0**64 + lo.astype(numpy.float64)) / unit
+    
+def amounts_add(a_hi, a_lo, b_hi, b_lo):
+    """
+    Element-wise a + b. Returns (hi, lo, overflow), where overflow is a 
+    boolean array marking the sums that don't fit in 128 bits (these wrap 
+    around, i.e. are modulo 2**128)
+    """
+    import numpy
+    lo = a_lo + b_lo
+    carry = (lo < a_lo).astype(numpy.uint64)
+    hi = a_hi + b_hi
+    overflow = hi < a_hi
+    hi += carry
+    overflow |= hi < carry
+    return hi, lo, overflow
+    
+def amounts_sub(a_hi, a_lo, b_hi, b_lo):
+    """
+    Element-wise a - b. Returns (hi, lo, underflow), where underflow is a
+    boolean array marking the elements where b > a (these wrap around)
+    """
+    import numpy
+    lo = a_lo - b_lo
+    borrow = (a_lo < b_lo).astype(numpy.uint64)
+    hi = a_hi - b_hi
+    underflow = a_hi < b_hi
+    underflow |= hi < borrow
+    hi -= borrow
+    return hi, lo, underflow
+    
+def amounts_compare(a_hi, a_lo, b_hi, b_lo):
+    """Element-wise comparison, returns an int8 array with -1 (a < b), 0 (a == b) or 1 (a > b)"""
+    import numpy
+    res = numpy.where(a_lo > b_lo, 1, numpy.where(a_lo < b_lo, -1, 0)).astype(numpy.int8)
+    res[a_hi > b_hi] = 1
+    res[a_hi < b_hi] = -1
+    return res
+    
+def amounts_sum(hi, lo):
+    """
+    Exact sum of a (hi, lo) pair of arrays, returned as an int. Raises 
+    OverflowError when the sum doesn't fit in 128 bits.
+    """
+    import numpy
+    # Sum the 32-bit parts, which can't overflow uint64 for less than 
+    # 2**32 elements
+    total = 0
+    for a, shift in ((hi, 64), (lo, 0)):
+        total += int(numpy.sum(a >> numpy.uint64(32), dtype=numpy.uint64)) << (shift + 32)
+        total += int(numpy.sum(a & numpy.uint64(MASK32), dtype=numpy.uint64)) << shift
+    if total > MAX_RAW:
+        raise OverflowError('Sum of amounts (%d) exceeds 128 bits' % total)
+    return total
+    
 # After numbers.cpp
     
 base58_reverse = "~012345678~~~~~~~9:;<=>?@~ABCDE~FGHIJKLMNOP~~~~~~QRSTUVWXYZ[~\\]^_`abcdefghi"
@@ -117,54 +307,77 @@ def account_decode(value):
     assert value <= '~'
     return chr(ord(account_reverse[ord(value) - 0x30]) - 0x30)
 
-def decode_account(source_a):
+# Table for bytes.translate(), mapping the address alphabet to the digits
+# used by int(..., 32). Any other character maps to '~', which int() rejects.
+ACCOUNT_DIGITS = bytearray(b'~' * 256)
+for value, character in enumerate(account_lookup):
+    ACCOUNT_DIGITS[ord(character)] = ord('0123456789abcdefghijklmnopqrstuv'[value])
+ACCOUNT_DIGITS = bytes(ACCOUNT_DIGITS)
+
+ACCOUNT_PREFIXES = ('xrb_', 'xrb-')
+
+def _decode_account(address):
     """
-    Take a string of the form "xrb_..." of length 64 and return
-    the associated public key (as a bytes object)
+    Decode an address, returning (<public key>, None) if valid, or 
+    (None, <reason>) if not
     """
-    assert len(source_a) == 64
-    assert source_a.startswith('xrb_') or source_a.startswith('xrb-') 
-    
-    number_l = 0
     
-    for character in source_a[4:]:
+    if not isinstance(address, str) or len(address) != 64:
+        return None, 'invalid length'
+    if address[:4] not in ACCOUNT_PREFIXES:
+        return None, 'invalid prefix'
         
-        if ord(character) < 0x30 or ord(character) >= 0x80:
-            raise ValueError('Character out of range')
-            
-        byte = account_decode(character)
-        if byte == '~':
-            raise ValueError('Invalid character')
-            
-        number_l <<= 5
-        number_l += ord(byte)
+    try:
+        number = int(address[4:].encode('ascii').translate(ACCOUNT_DIGITS), 32)
+    except (UnicodeEncodeError, ValueError):
+        return None, 'invalid character'
+        
+    # 60 characters hold 300 bits, for a 256-bit key plus 40-bit checksum
+    if number >> 296:
+        return None, 'value out of range'
         
-    account = (number_l >> 40).to_bytes(length=32, byteorder='big')
+    account = (number >> 40).to_bytes(length=32, byteorder='big')
     
     # The digest to check is in the lowest 40 bits of the address
-    check = number_l & 0xffffffffff
-    hash = hashlib.blake2b(digest_size=5)
-    hash.update(account)
-    validation = hash.digest()
+    check = (number & 0xffffffffff).to_bytes(length=5, byteorder='little')
+    if hashlib.blake2b(account, digest_size=5).digest() != check:
+        return None, 'invalid checksum'
+        
+    return account, None
+
+def decode_account(source_a):
+    """
+    Take a string of the form "xrb_..." of length 64 and return
+    the associated public key (as a bytes object). Raises ValueError 
+    for an invalid address.
+    """
+    account, error = _decode_account(source_a)
+    if account is None:
+        raise ValueError('Invalid account %r: %s' % (source_a, error))
+    return account
     
-    assert check.to_bytes(length=5, byteorder='little') == validation
+def validate_account(address):
+    """Return True if address is a valid "xrb_..." string (including checksum)"""
+    return _decode_account(address)[0] is not None
     
+def decode_accounts(addresses):
     """
-    if (!result)
-    {
-        *this = (number_l >> 40).convert_to <rai::uint256_t> ();
-        uint64_t check (number_l.convert_to <uint64_t> ());
-        check &=  0xffffffffff;
-        uint64_t validation (0);
-        blake2b_state hash;
-        blake2b_init (&hash, 5);
-        blake2b_update (&hash, bytes.data (), bytes.size ());
-        blake2b_final (&hash, reinterpret_cast <uint8_t *> (&validation), 5);
-        result = check != validation;
-    }
+    Decode a sequence of addresses. Returns (accounts, invalid), where 
+    accounts is a list with the public key for each address (None for 
+    invalid addresses) and invalid a list of (<index>, <address>, <reason>)
+    for the invalid ones.
     """
     
-    return account
+    accounts = []
+    invalid = []
+    
+    for index, address in enumerate(addresses):
+        account, error = _decode_account(address)
+        if account is None:
+            invalid.append((index, address, error))
+        accounts.append(account)
+        
+    return accounts, invalid
 
 
 def encode_account(account):
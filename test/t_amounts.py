@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import sys, os, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy
+from rainumbers import bin2balance_raw, UNIT_XRB, MAX_RAW, \
+    amounts_from_bytes, amounts_to_bytes, amounts_from_ints, amounts_to_ints, amounts_to_float, \
+    amounts_add, amounts_sub, amounts_compare, amounts_sum
+
+rnd = random.Random(1)
+
+EDGES = [0, 1, 2**32-1, 2**32, 2**64-1, 2**64, 2**64+1, 2**96, MAX_RAW-1, MAX_RAW]
+
+def random_amounts(n):
+    return EDGES + [rnd.getrandbits(rnd.choice([8, 32, 63, 64, 65, 90, 127, 128])) for i in range(n - len(EDGES))]
+    
+a = random_amounts(20000)
+b = random_amounts(20000)
+rnd.shuffle(b)
+
+a_hi, a_lo = amounts_from_ints(a)
+b_hi, b_lo = amounts_from_ints(b)
+assert a_hi.dtype == numpy.uint64 and a_lo.dtype == numpy.uint64
+
+# Round trips, against the Python int functions
+assert amounts_to_ints(a_hi, a_lo) == a
+data = amounts_to_bytes(a_hi, a_lo)
+assert data == b''.join(v.to_bytes(16, 'big') for v in a)
+assert [bin2balance_raw(data[i:i+16]) for i in range(0, len(data), 16)] == a
+for hi, lo in (amounts_from_bytes(data), amounts_from_bytes([v.to_bytes(16, 'big') for v in a])):
+    assert (hi == a_hi).all() and (lo == a_lo).all()
+    
+for bad in ([-1], [MAX_RAW + 1]):
+    try:
+        amounts_from_ints(bad)
+        assert False
+    except OverflowError:
+        pass
+        
+# Arithmetic
+hi, lo, overflow = amounts_add(a_hi, a_lo, b_hi, b_lo)
+assert amounts_to_ints(hi, lo) == [(x + y) & MAX_RAW for x, y in zip(a, b)]
+assert overflow.tolist() == [x + y > MAX_RAW for x, y in zip(a, b)]
+assert overflow.any()
+
+hi, lo, underflow = amounts_sub(a_hi, a_lo, b_hi, b_lo)
+assert amounts_to_ints(hi, lo) == [(x - y) & MAX_RAW for x, y in zip(a, b)]
+assert underflow.tolist() == [x < y for x, y in zip(a, b)]
+
+assert amounts_compare(a_hi, a_lo, b_hi, b_lo).tolist() == [(x > y) - (x < y) for x, y in zip(a, b)]
+assert (amounts_compare(a_hi, a_lo, a_hi, a_lo) == 0).all()
+
+# Sums
+small = [v >> 20 for v in a]
+assert amounts_sum(*amounts_from_ints(small)) == sum(small)
+assert amounts_sum(*amounts_from_ints([])) == 0
+assert amounts_sum(*amounts_from_ints([MAX_RAW, 0])) == MAX_RAW
+try:
+    amounts_sum(*amounts_from_ints([MAX_RAW, 1]))
+    assert False
+except OverflowError:
+    pass
+    
+# Float conversion (not exact)
+xrb = amounts_to_float(a_hi, a_lo)
+assert numpy.allclose(xrb, [v / UNIT_XRB for v in a], rtol=1e-15, atol=0)
+
+# Timing
+n = 1000000
+values = [rnd.getrandbits(100) for i in range(n)]
+hi, lo = amounts_from_ints(values)
+
+t0 = time.time()
+total = sum(values)
+t1 = time.time()
+assert amounts_sum(hi, lo) == total
+t2 = time.time()
+amounts_add(hi, lo, hi, lo)
+t3 = time.time()
+
+print('Sum of %d amounts: Python ints %.3fs, amounts_sum() %.3fs' % (n, t1 - t0, t2 - t1))
+print('Add %d amounts: amounts_add() %.3fs' % (n, t3 - t2))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# $ python3 t_async.py file.db
+import sys, os, time, asyncio
+scriptdir = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(scriptdir, '..'))
+
+from nanodb import NanoDatabase, GENESIS_ACCOUNT, GENESIS_OPEN_BLOCK_HASH
+from nanodb_async import AsyncNanoDatabase
+
+async def main(dbfile):
+    
+    async with AsyncNanoDatabase(dbfile, max_workers=4) as adb:
+        
+        genesis = await adb.account_from_address(GENESIS_ACCOUNT)
+        print(genesis, genesis.name())
+        
+        block = await adb.block_from_hash(GENESIS_OPEN_BLOCK_HASH)
+        assert block.id == 0
+        
+        # Fan out a bunch of independent lookups
+        t0 = time.time()
+        chain, unpocketed, length = await asyncio.gather(
+            adb.chain2(genesis, limit=50, reverse=True, start=-1),
+            adb.unpocketed(genesis, limit=50),
+            adb.chain_length(genesis))
+        t1 = time.time()
+        print('%d blocks, %d unpocketed, chain length %d (%.3f s)' % (len(chain), len(unpocketed), length, t1-t0))
+        
+        # Results must be the same as with the synchronous API
+        db = NanoDatabase(dbfile)
+        expected = db.account_from_id(genesis.id).chain2(limit=50, reverse=True, start=-1)
+        assert [b.id for b in chain] == [b.id for b in expected]
+        for a, b in zip(chain, expected):
+            assert a.hash() == b.hash() and a.balance() == b.balance() and a.amount() == b.amount()
+            assert (a.sister() is None) == (b.sister() is None)
+            
+        # Cancel a large number of queued lookups
+        tasks = [asyncio.ensure_future(adb.chain2(genesis)) for i in range(100)]
+        await asyncio.sleep(0.001)
+        for t in tasks:
+            t.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        print('%d of %d lookups cancelled' % (sum(isinstance(r, asyncio.CancelledError) for r in results), len(tasks)))
+        
+        # Pool is still usable after cancellation
+        assert (await adb.chain_length(genesis)) == length
+        print(adb.pool.stats())
+        
+asyncio.run(main(sys.argv[1]))
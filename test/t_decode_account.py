@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import sys, os, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rainumbers import account_decode, decode_account, decode_accounts, validate_account, encode_account
+from nanodb import KNOWN_ACCOUNTS
+
+def decode_account_per_character(address):
+    # Previous implementation, decoding one character at a time
+    number = 0
+    for character in address[4:]:
+        number = (number << 5) + ord(account_decode(character))
+    return (number >> 40).to_bytes(length=32, byteorder='big')
+    
+rnd = random.Random(1)
+keys = [bytes(32), bytes([255]*32)] + [rnd.getrandbits(256).to_bytes(32, 'big') for i in range(10000)]
+addresses = [encode_account(key) for key in keys]
+
+# Round trip
+for key, address in zip(keys, addresses):
+    assert decode_account(address) == key
+    assert decode_account('xrb-' + address[4:]) == key
+    assert validate_account(address)
+    
+for address in KNOWN_ACCOUNTS:
+    assert encode_account(decode_account(address)) == address
+    
+# Invalid addresses
+valid = addresses[2]
+invalid = [
+    (valid[:-1], 'invalid length'),
+    (valid + '1', 'invalid length'),
+    ('nano' + valid[4:], 'invalid prefix'),
+    (valid[:10] + 'l' + valid[11:], 'invalid character'),     # not in the alphabet
+    (valid[:10] + '0' + valid[11:], 'invalid character'),
+    (valid[:10] + '_' + valid[11:], 'invalid character'),     # accepted by int()
+    (valid[:10] + ' ' + valid[11:], 'invalid character'),
+    (valid[:10] + 'A' + valid[11:], 'invalid character'),
+    (valid[:10] + 'é' + valid[11:], 'invalid character'),
+    ('xrb_' + 'z' + valid[5:], 'value out of range'),
+    (valid[:-1] + ('1' if valid[-1] != '1' else '3'), 'invalid checksum'),
+    (None, 'invalid length'),
+]
+
+for address, reason in invalid:
+    assert not validate_account(address), address
+    try:
+        decode_account(address)
+        assert False, address
+    except ValueError as e:
+        assert reason in str(e), (address, str(e))
+        
+# Batch decoding
+batch = addresses[:100] + [address for address, reason in invalid] + addresses[100:200]
+accounts, errors = decode_accounts(batch)
+assert len(accounts) == len(batch)
+assert accounts[:100] == keys[:100]
+assert accounts[-100:] == keys[100:200]
+assert [(index, reason) for index, address, reason in errors] == [(100 + i, reason) for i, (address, reason) in enumerate(invalid)]
+assert all(accounts[index] is None for index, address, reason in errors)
+
+# Timing
+t0 = time.time()
+for address in addresses:
+    decode_account_per_character(address)
+t1 = time.time()
+for address in addresses:
+    decode_account(address)
+t2 = time.time()
+accounts, errors = decode_accounts(addresses)
+t3 = time.time()
+
+n = len(addresses)
+print('Per character (no validation): %.2f us/address' % ((t1 - t0) / n * 1e6))
+print('decode_account():              %.2f us/address' % ((t2 - t1) / n * 1e6))
+print('decode_accounts():             %.2f us/address' % ((t3 - t2) / n * 1e6))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# $ python3 t_graph.py file.db
+import sys, os, time
+scriptdir = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(scriptdir, '..'))
+
+from nanodb import NanoDatabase, AccountNotFound, GENESIS_ACCOUNT
+from nanograph import LatticeGraph
+
+BG_REP1 = 'xrb_39ymww61tksoddjh1e43mprw5r8uu1318it9z3agm7e6f96kg4ndqg9tuds4'
+BG_REP2 = 'xrb_31a51k53fdzam7bhrgi4b67py9o7wp33rec1hi7k6z1wsgh8oagqs7bui9p1'
+
+db = NanoDatabase(sys.argv[1])
+
+t0 = time.time()
+g = LatticeGraph(db)
+t1 = time.time()
+print(g, 'loaded in %.3f s' % (t1-t0))
+
+genesis = db.account_from_address(GENESIS_ACCOUNT)
+
+# Everything depends on the genesis open block
+t0 = time.time()
+r = g.reachable(0)
+t1 = time.time()
+print('%d blocks reachable from genesis block (%.3f s)' % (len(r), t1-t0))
+cur = db.cursor()
+cur.execute('select count(*) from block_info')
+assert len(r) == next(cur)[0] - 1
+
+# Every consecutive pair of blocks in a path must be a previous->next
+# or send->receive/open edge
+def check_path(path, from_account, to_account):
+    assert path[0].account().id == from_account.id
+    assert path[-1].account().id == to_account.id
+    for a, b in zip(path, path[1:]):
+        n = a.next()
+        assert (n is not None and n.id == b.id) or (b.sister() is not None and b.sister().id == a.id)
+
+if len(sys.argv) > 2:
+    target = db.account_from_address(sys.argv[2])
+else:
+    try:
+        target = db.account_from_address(BG_REP2)
+    except AccountNotFound:
+        # Not a live network database, use the account of the most recent block
+        cur.execute('select account from block_info order by global_index desc limit 1')
+        target = db.account_from_id(next(cur)[0])
+
+t0 = time.time()
+path = g.path(genesis, target)
+t1 = time.time()
+print('Path genesis -> %s: %d blocks (%.3f s)' % (target, len(path), t1-t0))
+for b in path:
+    print('   ', b, b.account())
+check_path(path, genesis, target)
+
+# Hop-bounded search backwards from the last block in the path
+blocks, hops = g.bfs(path[-1], max_hops=3, backward=True)
+assert hops[0] == 0 and hops.max() <= 3
+assert path[-2].id in blocks[hops == 1]
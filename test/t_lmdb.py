@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# $ python3 t_lmdb.py data.ldb file.db
+# Compares the LMDB backend against a database converted from the same LMDB file
+import sys, os, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from nanodb import NanoDatabase, GENESIS_ACCOUNT
+from nanolmdb import LMDBDatabase, RequiresConvertedDB
+
+ldb = LMDBDatabase(sys.argv[1])
+db = NanoDatabase(sys.argv[2])
+
+print(ldb.stats())
+
+def hash_or_none(block):
+    return block.hash() if block is not None else None
+    
+cur = db.cursor()
+ids = [row[0] for row in cur.execute('select id from blocks')]
+random.Random(1).shuffle(ids)
+
+t0 = time.time()
+n = 0
+for id in ids[:2000]:
+    block = db.block_from_id(id)
+    lblock = ldb.block_from_hash(block.hash())
+    assert lblock.type == block.type
+    assert hash_or_none(lblock.previous()) == hash_or_none(block.previous())
+    assert hash_or_none(lblock.next()) == hash_or_none(block.next())
+    assert lblock.account().address == block.account().address
+    assert lblock.balance() == block.balance(), (block, lblock.balance(), block.balance())
+    assert lblock.amount() == block.amount(), (block, lblock.amount(), block.amount())
+    if block.type == 'send':
+        assert lblock.destination().address == block.destination().address
+    n += 1
+print('%d blocks OK (%.3fs)' % (n, time.time() - t0))
+
+for address, in list(cur.execute('select address from accounts a, account_info i where a.id = i.account'))[:500]:
+    account = db.account_from_address(address)
+    laccount = ldb.account_from_address(address)
+    assert laccount.first_block().hash() == account.first_block().hash()
+    assert laccount.last_block().hash() == account.last_block().hash()
+    assert laccount.chain_length() == account.chain_length()
+    assert laccount.balance() == account.last_block().balance()
+    assert laccount.pending_total() == account.pending_total()
+    assert set(b.hash() for b in laccount.unpocketed()) == set(b.hash() for b in account.unpocketed())
+print('Accounts OK')
+
+genesis = ldb.account_from_address(GENESIS_ACCOUNT)
+assert [b.hash() for b in genesis.chain(limit=10)] == [b.hash() for b in db.account_from_address(GENESIS_ACCOUNT).chain(limit=10)]
+
+# Block locator, with and without Bloom filters
+from nanolmdb import BlockLocator
+hashes = [db.block_from_id(id).hash() for id in ids[:1000]]
+keys = [bytes.fromhex(h) for h in hashes] + [bytes([i]*32) for i in range(100)]
+for bloom in (False, True):
+    locator = BlockLocator(ldb.env, bloom=bloom)
+    single = [locator.locate(key) for key in keys]
+    many = locator.locate_many(keys)
+    assert [r[0] if r else None for r in single] == [r[0] if r else None for r in many]
+    assert [r[0] for r in many[:1000]] == [db.block_from_hash(h).type for h in hashes]
+    assert many[1000:] == [None] * 100
+    locator.close()
+print('Block locator OK')
+
+for f in (lambda: genesis.first_block().global_index(), lambda: ldb.top_accounts()):
+    try:
+        f()
+        assert False
+    except RequiresConvertedDB as e:
+        print('RequiresConvertedDB: %s' % e)
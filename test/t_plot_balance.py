@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
-import sys
+# $ python3 t_plot_balance.py file.db [num_points]
+import sys, os, time
+scriptdir = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(scriptdir, '..'))
+
 from nanodb import NanoDatabase
 
 BG_REP1 = 'xrb_39ymww61tksoddjh1e43mprw5r8uu1318it9z3agm7e6f96kg4ndqg9tuds4'
@@ -7,16 +11,22 @@ BG_REP2 = 'xrb_31a51k53fdzam7bhrgi4b67py9o7wp33rec1hi7k6z1wsgh8oagqs7bui9p1'
 
 db = NanoDatabase(sys.argv[1])
 
+downsample = None
+if len(sys.argv) > 2:
+    downsample = int(sys.argv[2])
+
 account = db.account_from_address(BG_REP2)
 print(account)
 
-# only send blocks have an explicit balance
-blocks = account.chain('send')
-print(len(blocks))
-
+t0 = time.time()
+series = account.balance_series(downsample=downsample)
+t1 = time.time()
+print('%d points (%.3f s)' % (len(series['balance']), t1-t0))
 
-for i, b in enumerate(blocks):
-    #if b.type != 'send':
-    #    continue
+# Exact balance must match the one of the block
+last_block = account.last_block()
+if last_block is not None and downsample is None:
+    assert int(series['balance_hi'][-1]) * 2**64 + int(series['balance_lo'][-1]) == last_block.balance()
 
-    print(i, b.balance())
\ No newline at end of file
+for ci, gi, balance in zip(series['chain_index'], series['global_index'], series['balance']):
+    print(ci, gi, balance)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# $ python3 t_pool.py file.db
+import sys, os, time, threading
+scriptdir = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(scriptdir, '..'))
+
+from nanodb import NanoDatabasePool, PoolTimeout
+
+dbfile = sys.argv[1]
+
+def blocked_acquire(pool, free_slot):
+    """
+    Fill the pool, start an acquire() that has to wait, then free a slot
+    with free_slot(dbs) and check the waiting acquire() gets a connection
+    """
+    dbs = [pool.acquire() for i in range(pool.max_connections)]
+
+    result = []
+    def waiter():
+        t0 = time.time()
+        try:
+            result.append((pool.acquire(timeout=10), time.time() - t0))
+        except PoolTimeout as e:
+            result.append((None, time.time() - t0))
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    time.sleep(0.2)
+    assert len(result) == 0, 'acquire() should block on a full pool'
+
+    free_slot(dbs)
+    t.join()
+
+    db, waited = result[0]
+    assert db is not None, 'blocked acquire() timed out after %.1fs' % waited
+    assert waited < 5, waited
+    print('blocked acquire() returned after %.2fs' % waited)
+
+    return dbs + [db]
+
+# Slot freed by discarding a connection (e.g. after an interrupt)
+pool = NanoDatabasePool(dbfile, max_connections=2)
+def discard(dbs):
+    pool.release(dbs.pop(), discard=True)
+dbs = blocked_acquire(pool, discard)
+for db in dbs:
+    pool.release(db)
+pool.close()
+
+# Slot freed by a connection that fails to open: with one connection 
+# in use, the other slot is reserved by an acquire() whose open fails
+pool = NanoDatabasePool(dbfile, max_connections=2)
+db1 = pool.acquire()
+open_ = pool._open
+failures = []
+def failing_open():
+    if len(failures) == 0:
+        failures.append(1)
+        time.sleep(0.5)
+        raise OSError('simulated open failure')
+    return open_()
+pool._open = failing_open
+def fail():
+    try:
+        pool.acquire()
+    except OSError:
+        pass
+t = threading.Thread(target=fail)
+t.start()
+time.sleep(0.1)
+t0 = time.time()
+db2 = pool.acquire(timeout=10)
+waited = time.time() - t0
+t.join()
+assert len(failures) == 1
+assert waited < 5, waited
+print('acquire() after a failed open returned after %.2fs' % waited)
+pool.release(db1)
+pool.release(db2)
+pool.close()
+
+print('OK')